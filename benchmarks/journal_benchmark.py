@@ -0,0 +1,172 @@
+"""
+Benchmark of the order book service's write-ahead journal (group_3_app.orderbook_service.journal).
+
+Drives OrderBookService.insert_order and cancel_order with the same seeded request stream twice, without and with a
+journal, and reports the latency of each and the added cost per operation. The journal is group committed every
+--ops-per-commit operations, standing in for one event loop iteration, and the commits are timed separately.
+Then times recovery of a fresh service from the journal alone and from a snapshot followed by a journal tail.
+Broadcasts go nowhere, so only the service and the journal are measured.
+
+Run with: python benchmarks/journal_benchmark.py --output journal.json
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from generated.proto.common_pb2 import Side
+from generated.proto.order_book_pb2 import CancelOrderRequest, CreateOrderBookRequest, InsertOrderRequest
+from group_3_app.orderbook_service.journal import Journal
+from group_3_app.orderbook_service.orderbook_service import OrderBookService
+from order_book_benchmark import _git_commit, _summarise
+
+BOOKS = 8
+TICK_SIZE = 0.01
+MID_PRICE = 100.0
+
+
+class _NoBroadcast:
+    def broadcast_message(self, message_type: int, message) -> None:
+        pass
+
+
+def _requests(operations: int, cancel_share: float, seed: int) -> list:
+    """Inserts around a fixed mid, a few percent of them marketable, and cancels of earlier inserts by request index."""
+    rng = random.Random(seed)
+    requests = []
+    insert_indices = []
+    for _ in range(operations):
+        if insert_indices and rng.random() < cancel_share:
+            position = rng.randrange(len(insert_indices))
+            requests.append(insert_indices[position])
+            insert_indices[position] = insert_indices[-1]
+            insert_indices.pop()
+        else:
+            side = Side.BUY if rng.random() < 0.5 else Side.SELL
+            distance = rng.randint(-2, 50) * (-1 if side == Side.BUY else 1)
+            insert_indices.append(len(requests))
+            requests.append(InsertOrderRequest(order_book_id=rng.randint(1, BOOKS), side=side,
+                                               price=round(MID_PRICE + distance * TICK_SIZE, 2),
+                                               quantity=rng.randint(1, 20) * 10,
+                                               on_behalf_of_username=f"trader_{rng.randint(1, 20):02d}"))
+    return requests
+
+
+def _service(journal: Journal | None) -> OrderBookService:
+    service = OrderBookService(_NoBroadcast(), journal=journal)
+    for _ in range(BOOKS):
+        service.create_order_book(CreateOrderBookRequest(tick_size=TICK_SIZE))
+    return service
+
+
+def _drive(service: OrderBookService, requests: list, ops_per_commit: int) -> dict[str, list[int]]:
+    samples: dict[str, list[int]] = {"insert": [], "cancel": [], "commit": []}
+    order_ids: dict[int, tuple[int, int]] = {}
+    journal = service.journal
+    perf_counter_ns = time.perf_counter_ns
+    gc.collect()
+    gc.disable()
+    try:
+        for index, request in enumerate(requests):
+            if isinstance(request, int):
+                order_book_id, order_id = order_ids.get(request, (0, 0))
+                cancel = CancelOrderRequest(order_book_id=order_book_id, order_id=order_id)
+                start = perf_counter_ns()
+                service.cancel_order(cancel)
+                samples["cancel"].append(perf_counter_ns() - start)
+            else:
+                start = perf_counter_ns()
+                response = service.insert_order(request)
+                samples["insert"].append(perf_counter_ns() - start)
+                order_ids[index] = (request.order_book_id, response.order_id)
+            if journal is not None and index % ops_per_commit == ops_per_commit - 1:
+                start = perf_counter_ns()
+                journal.commit()
+                samples["commit"].append(perf_counter_ns() - start)
+    finally:
+        gc.enable()
+    return {operation: operation_samples for operation, operation_samples in samples.items() if operation_samples}
+
+
+def _time_recovery(directory: str, segment_size: int) -> dict:
+    journal = Journal(directory, segment_size)
+    service = OrderBookService(_NoBroadcast(), journal=journal)
+    start = time.perf_counter_ns()
+    records = service.recover()
+    elapsed_ns = time.perf_counter_ns() - start
+    journal.close()
+    return {"records": records, "resting_orders": sum(len(book.orders) for book in service.order_books.values()),
+            "seconds": round(elapsed_ns / 1e9, 4), "records_per_s": round(records / (elapsed_ns / 1e9))}
+
+
+def run(args: argparse.Namespace) -> dict:
+    requests = _requests(args.operations, args.cancels, args.seed)
+    results: dict = {"in_memory": {operation: _summarise(samples) for operation, samples
+                                   in _drive(_service(None), requests, args.ops_per_commit).items()}}
+    if args.directory is not None:
+        os.makedirs(args.directory, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        journal = Journal(directory, args.segment_size, sync=not args.no_sync)
+        service = _service(journal)
+        results["journalled"] = {operation: _summarise(samples) for operation, samples
+                                 in _drive(service, requests, args.ops_per_commit).items()}
+        journal.close()
+        results["overhead_us"] = {operation: {key: round(results["journalled"][operation][key]
+                                                         - results["in_memory"][operation][key], 3)
+                                              for key in ("mean_us", "p50_us", "p99_us")}
+                                  for operation in results["in_memory"]}
+        results["recovery_from_journal"] = _time_recovery(directory, args.segment_size)
+
+        journal = Journal(directory, args.segment_size)
+        service = OrderBookService(_NoBroadcast(), journal=journal)
+        service.recover()
+        service.write_snapshot()
+        _drive(service, _requests(args.operations // 10, args.cancels, args.seed + 1), args.ops_per_commit)
+        journal.close()
+        results["recovery_from_snapshot_and_tail"] = _time_recovery(directory, args.segment_size)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--operations", type=int, default=200_000, help="Timed requests")
+    parser.add_argument("--cancels", type=float, default=0.4, help="Share of cancels; the rest are inserts")
+    parser.add_argument("--ops-per-commit", type=int, default=64,
+                        help="Requests between group commits, i.e. handled per event loop iteration")
+    parser.add_argument("--segment-size", type=int, default=64 * 1024 * 1024)
+    parser.add_argument("--no-sync", action="store_true", help="Commit without msync, leaving writeback to the kernel")
+    parser.add_argument("--directory", help="Where to create the scratch journal; the default temporary directory "
+                                            "may be memory-backed, which hides the cost of msync")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", type=Path, help="Write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+    if args.ops_per_commit <= 0:
+        parser.error("--ops-per-commit must be positive")
+
+    results = {
+        "benchmark": "journal",
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "settings": {"operations": args.operations, "cancels": args.cancels, "ops_per_commit": args.ops_per_commit,
+                     "segment_size": args.segment_size, "sync": not args.no_sync, "seed": args.seed},
+        **run(args),
+    }
+    encoded = json.dumps(results, indent=2)
+    if args.output is None:
+        print(encoded)
+    else:
+        args.output.write_text(encoded + "\n")
+        print(f"Results written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
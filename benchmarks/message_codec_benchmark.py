@@ -0,0 +1,72 @@
+"""
+Micro-benchmark of frame encoding and sending in connection.message_codec.
+
+Compares the concatenating encoder (encode_message + send) against the header-only encoder that the
+send paths use with scatter/gather sendmsg or transport.writelines, for typical InsertOrderRequest and
+OnPriceDepthBook payloads.
+
+Run with: python benchmarks/message_codec_benchmark.py
+"""
+import argparse
+import socket
+import threading
+import timeit
+
+from connection import message_codec
+from generated.proto.common_pb2 import Side
+from generated.proto.info_pb2 import OnPriceDepthBook, PriceLevel
+from generated.proto.order_book_pb2 import InsertOrderRequest
+
+
+def _sample_payloads(depth_levels: int) -> dict[str, bytes]:
+    insert_order_request = InsertOrderRequest(request_id=123456, order_book_id=7, side=Side.SELL, price=101.25,
+                                              quantity=250, on_behalf_of_username="trader_01")
+    on_price_depth_book = OnPriceDepthBook(
+        instrument_symbol="ABCD", timestamp=1_700_000_000_000_000,
+        bids=[PriceLevel(price=100.0 - 0.05 * i, quantity=100 + i) for i in range(depth_levels)],
+        asks=[PriceLevel(price=100.05 + 0.05 * i, quantity=100 + i) for i in range(depth_levels)])
+    return {
+        "InsertOrderRequest": insert_order_request.SerializeToString(),
+        f"OnPriceDepthBook({depth_levels} levels)": on_price_depth_book.SerializeToString(),
+    }
+
+
+def _drain(socket_fd: socket.socket) -> None:
+    while socket_fd.recv(1 << 20):
+        pass
+
+
+def _report(name: str, payload_bytes: int, number: int, seconds: float) -> None:
+    print(f"{name:<48} {payload_bytes:>6} B  {seconds / number * 1e9:>9.1f} ns/frame")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--number", type=int, default=200_000, help="Frames per measurement")
+    parser.add_argument("--depth-levels", type=int, default=10, help="Price levels per side in OnPriceDepthBook")
+    args = parser.parse_args()
+
+    sender, receiver = socket.socketpair()
+    drain_thread = threading.Thread(target=_drain, args=(receiver,), daemon=True)
+    drain_thread.start()
+    header_buffer = bytearray(message_codec.HEADER_BYTES)
+
+    for name, payload in _sample_payloads(args.depth_levels).items():
+        print(f"--- {name}")
+        message_type = 12
+        _report("encode_message (concatenate)", len(payload), args.number, timeit.timeit(
+            lambda: message_codec.encode_message(message_type, payload), number=args.number))
+        _report("encode_header (header only)", len(payload), args.number, timeit.timeit(
+            lambda: message_codec.encode_header(message_type, len(payload)), number=args.number))
+        _report("encode_message + sendall", len(payload), args.number, timeit.timeit(
+            lambda: sender.sendall(message_codec.encode_message(message_type, payload)), number=args.number))
+        _report("send_message (sendmsg header + payload)", len(payload), args.number, timeit.timeit(
+            lambda: message_codec.send_message(sender, header_buffer, message_type, payload), number=args.number))
+
+    sender.close()
+    drain_thread.join()
+    receiver.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Micro-benchmark of the matching engine in group_3_app.common.order_book.
+
+Drives OrderBook.insert_order and cancel_order directly with seeded synthetic order flow at several book depths:
+passive inserts priced around a fixed mid (exponentially fewer orders further from the touch), aggressive orders
+sweeping one or more levels of the opposite side, and cancels of random resting orders (replaced by passive inserts
+while the book is below its starting size). Orders are built before the clock starts, so only the book call is
+timed. Reports throughput and p50/p99/p99.9 latency per operation type as JSON, and with --baseline the change
+against an earlier run of the same settings.
+
+Run with: python benchmarks/order_book_benchmark.py --output order_book.json
+"""
+import argparse
+import datetime
+import gc
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from generated.proto.common_pb2 import Side
+from group_3_app.common.order import Order
+from group_3_app.common.order_book import OrderBook
+
+MID_TICKS = 100_000
+TICK_SIZE = 0.01
+PASSIVE_INSERT = "passive_insert"
+AGGRESSIVE_SWEEP = "aggressive_sweep"
+CANCEL = "cancel"
+
+
+class _Flow:
+    """Seeded order flow against one book, keeping its depth roughly at the requested number of levels per side."""
+
+    def __init__(self, depth: int, orders_per_level: int, seed: int) -> None:
+        self.rng = random.Random(seed)
+        self.depth = depth
+        self.order_book = OrderBook(1, TICK_SIZE)
+        self.resting_order_ids: list[int] = []
+        self.next_order_id = 1
+        for distance in range(depth):
+            for _ in range(orders_per_level):
+                self.order_book.insert_order(self._order(Side.BUY, MID_TICKS - 1 - distance, self._passive_quantity()))
+                self.order_book.insert_order(self._order(Side.SELL, MID_TICKS + 1 + distance, self._passive_quantity()))
+                self.resting_order_ids.extend((self.next_order_id - 2, self.next_order_id - 1))
+
+    def _order(self, side: Side, price_ticks: int, quantity: int) -> Order:
+        order = Order(self.next_order_id, 1, self.next_order_id, side, price_ticks, quantity, "trader_01")
+        self.next_order_id += 1
+        return order
+
+    def _passive_quantity(self) -> int:
+        return self.rng.randint(1, 20) * 10
+
+    def passive_insert(self) -> Order:
+        # Most passive orders join the levels near the touch; the exponential tail keeps the deep levels populated
+        distance = min(int(self.rng.expovariate(4.0 / self.depth)), self.depth - 1)
+        if self.rng.random() < 0.5:
+            return self._order(Side.BUY, MID_TICKS - 1 - distance, self._passive_quantity())
+        return self._order(Side.SELL, MID_TICKS + 1 + distance, self._passive_quantity())
+
+    def aggressive_sweep(self) -> Order:
+        side = Side.BUY if self.rng.random() < 0.5 else Side.SELL
+        levels = 1 + min(int(self.rng.expovariate(1.0)), 4)
+        opposite_side = Side.SELL if side == Side.BUY else Side.BUY
+        book_levels = self.order_book.get_price_levels(opposite_side, levels)
+        if not book_levels:
+            return self.passive_insert()
+        quantity = sum(level.quantity for level in book_levels)
+        return self._order(side, book_levels[-1].price_ticks, max(1, quantity - self.rng.randint(0, book_levels[-1].quantity - 1)))
+
+    def cancel_target(self) -> int | None:
+        resting_order_ids = self.resting_order_ids
+        while resting_order_ids:
+            index = self.rng.randrange(len(resting_order_ids))
+            order_id = resting_order_ids[index]
+            resting_order_ids[index] = resting_order_ids[-1]
+            resting_order_ids.pop()
+            if self.order_book.get_order(order_id) is not None:
+                return order_id
+        return None
+
+
+def _percentile(sorted_samples: list[int], fraction: float) -> float:
+    return sorted_samples[min(len(sorted_samples) - 1, int(fraction * len(sorted_samples)))] / 1e3
+
+
+def _summarise(samples_ns: list[int]) -> dict[str, float]:
+    samples_ns.sort()
+    total_ns = sum(samples_ns)
+    return {
+        "count": len(samples_ns),
+        "throughput_ops_per_s": round(len(samples_ns) / (total_ns / 1e9)) if total_ns else 0,
+        "mean_us": round(total_ns / len(samples_ns) / 1e3, 3),
+        "p50_us": round(_percentile(samples_ns, 0.5), 3),
+        "p99_us": round(_percentile(samples_ns, 0.99), 3),
+        "p99.9_us": round(_percentile(samples_ns, 0.999), 3),
+    }
+
+
+def run_depth(depth: int, operations: int, orders_per_level: int, mix: tuple[float, float], seed: int) -> dict:
+    flow = _Flow(depth, orders_per_level, seed)
+    order_book = flow.order_book
+    samples: dict[str, list[int]] = {PASSIVE_INSERT: [], AGGRESSIVE_SWEEP: [], CANCEL: []}
+    passive_share, sweep_share = mix
+    target_orders = len(order_book.orders)
+    perf_counter_ns = time.perf_counter_ns
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(operations):
+            draw = flow.rng.random()
+            if draw >= passive_share + sweep_share and len(order_book.orders) < target_orders:
+                draw = 0.0  # Refill with a passive insert instead of cancelling, so the book keeps its depth
+            if draw < passive_share + sweep_share:
+                operation = PASSIVE_INSERT if draw < passive_share else AGGRESSIVE_SWEEP
+                order = flow.passive_insert() if operation == PASSIVE_INSERT else flow.aggressive_sweep()
+                start = perf_counter_ns()
+                order_book.insert_order(order)
+                samples[operation].append(perf_counter_ns() - start)
+                if order.quantity > 0:
+                    flow.resting_order_ids.append(order.order_id)
+            else:
+                order_id = flow.cancel_target()
+                if order_id is None:
+                    continue
+                start = perf_counter_ns()
+                order_book.cancel_order(order_id)
+                samples[CANCEL].append(perf_counter_ns() - start)
+    finally:
+        gc.enable()
+    return {
+        "depth": depth,
+        "resting_orders_at_end": len(order_book.orders),
+        "bid_levels_at_end": len(order_book.get_price_levels(Side.BUY)),
+        "ask_levels_at_end": len(order_book.get_price_levels(Side.SELL)),
+        "operations": {operation: _summarise(samples_ns) for operation, samples_ns in samples.items() if samples_ns},
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _compare(results: dict, baseline: dict) -> None:
+    baseline_by_depth = {run["depth"]: run for run in baseline["runs"]}
+    if baseline["settings"] != results["settings"]:
+        print("warning: baseline was run with different settings", file=sys.stderr)
+    for run in results["runs"]:
+        baseline_run = baseline_by_depth.get(run["depth"])
+        if baseline_run is None:
+            continue
+        for operation, stats in run["operations"].items():
+            baseline_stats = baseline_run["operations"].get(operation)
+            if baseline_stats is None:
+                continue
+            changes = "  ".join(f"{key} {100 * (stats[key] / baseline_stats[key] - 1):+6.1f}%"
+                                for key in ("p50_us", "p99_us", "p99.9_us") if baseline_stats[key])
+            print(f"depth {run['depth']:>6} {operation:<17} vs {baseline.get('git_commit') or 'baseline'}: {changes}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--depths", type=int, nargs="+", default=[10, 100, 1_000, 10_000],
+                        help="Price levels per side the book is filled to before timing")
+    parser.add_argument("-n", "--operations", type=int, default=200_000, help="Timed operations per depth")
+    parser.add_argument("--orders-per-level", type=int, default=4)
+    parser.add_argument("--passive", type=float, default=0.5, help="Share of passive inserts")
+    parser.add_argument("--sweeps", type=float, default=0.1, help="Share of aggressive orders; the rest are cancels")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", type=Path, help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--baseline", type=Path, help="JSON results of an earlier run to compare latencies against")
+    args = parser.parse_args()
+    if args.passive < 0 or args.sweeps < 0 or args.passive + args.sweeps > 1:
+        parser.error("--passive and --sweeps must be non-negative and add up to at most 1")
+
+    results = {
+        "benchmark": "order_book",
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "settings": {"operations": args.operations, "orders_per_level": args.orders_per_level,
+                     "passive": args.passive, "sweeps": args.sweeps, "seed": args.seed},
+        "runs": [run_depth(depth, args.operations, args.orders_per_level, (args.passive, args.sweeps), args.seed)
+                 for depth in args.depths],
+    }
+    encoded = json.dumps(results, indent=2)
+    if args.output is None:
+        print(encoded)
+    else:
+        args.output.write_text(encoded + "\n")
+        print(f"Results written to {args.output}", file=sys.stderr)
+    if args.baseline is not None:
+        _compare(results, json.loads(args.baseline.read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Memory benchmark of resting orders in group_3_app.common.
+
+Measures, with tracemalloc, the bytes allocated per order for bare Order objects and for orders resting in an
+OrderBook, comparing the slotted Order (lazily created trade id list) against the previous plain class with a
+per-instance __dict__ and an eagerly allocated trade_ids list.
+
+Run with: python benchmarks/order_memory_benchmark.py
+"""
+import argparse
+import gc
+import random
+import tracemalloc
+from typing import Callable
+
+from generated.proto.common_pb2 import Side
+from group_3_app.common.order import Order
+from group_3_app.common.order_book import OrderBook
+
+
+class LegacyOrder:
+    """Order as it was before it had __slots__."""
+
+    def __init__(self, order_id: int, order_book_id: int, timestamp: int, side: Side, price_ticks: int, quantity: int,
+                 on_behalf_of_username: str = None) -> None:
+        self.order_id = order_id
+        self.order_book_id = order_book_id
+        self.timestamp = timestamp
+        self.side = side
+        self.price_ticks = price_ticks
+        self.quantity = quantity
+        self.trade_ids = []
+        self.on_behalf_of_username = on_behalf_of_username
+
+    def add_trade_id(self, trade_id: int) -> None:
+        self.trade_ids.append(trade_id)
+
+
+def _measure(build: Callable[[], object]) -> tuple[int, object]:
+    gc.collect()
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    kept = build()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return allocated - baseline, kept
+
+
+def _orders(order_class: type, count: int, seed: int) -> list:
+    rng = random.Random(seed)
+    return [order_class(order_id, 1, 1_700_000_000_000_000 + order_id, Side.BUY if order_id % 2 else Side.SELL,
+                        rng.randint(9_000, 9_500) if order_id % 2 else rng.randint(10_500, 11_000), rng.randint(1, 100),
+                        "trader_01")
+            for order_id in range(count)]
+
+
+def _resting_book(order_class: type, count: int, seed: int) -> OrderBook:
+    # Bids and asks never cross, so every order rests
+    order_book = OrderBook(1, 0.01)
+    for order in _orders(order_class, count, seed):
+        order_book.insert_order(order)
+    return order_book
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--orders", type=int, default=200_000, help="Resting orders per measurement")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    for name, order_class in (("legacy (__dict__, eager trade_ids)", LegacyOrder), ("slotted (lazy trade_ids)", Order)):
+        orders_bytes, _ = _measure(lambda: _orders(order_class, args.orders, args.seed))
+        book_bytes, _ = _measure(lambda: _resting_book(order_class, args.orders, args.seed))
+        print(f"{name:<36} orders: {orders_bytes / args.orders:>7.1f} B/order   "
+              f"resting in book: {book_bytes / args.orders:>7.1f} B/order")
+
+
+if __name__ == "__main__":
+    main()
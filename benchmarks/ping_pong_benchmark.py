@@ -0,0 +1,98 @@
+"""
+Ping-pong benchmark of the selectors (TcpConnectionManager) and asyncio (AsyncioConnectionManager) backends.
+
+Each backend serves the sample_app PingPongClientHandlerFactory on localhost from a background thread.
+A blocking client then measures round-trip latency one frame at a time, and burst throughput with many
+frames in flight.
+
+Run with: python benchmarks/ping_pong_benchmark.py
+"""
+import argparse
+import asyncio
+import socket
+import statistics
+import threading
+import time
+
+from connection import message_codec
+from connection.asyncio_connection_manager import AsyncioConnectionManager
+from connection.ip_address import IpAddress
+from connection.tcp_connection_manager import TcpConnectionManager
+from sample_app.connection_handler import PingPongClientHandlerFactory
+
+
+def _serve_selectors(ip_address: IpAddress, ready: threading.Event, stop: threading.Event) -> None:
+    with TcpConnectionManager() as connection_manager:
+        with connection_manager.listen(ip_address, PingPongClientHandlerFactory()):
+            ready.set()
+            while not stop.is_set():
+                connection_manager.wait_for_events(0.05)
+
+
+def _serve_asyncio(ip_address: IpAddress, ready: threading.Event, stop: threading.Event) -> None:
+    async def serve() -> None:
+        async with await AsyncioConnectionManager().listen(ip_address, PingPongClientHandlerFactory()):
+            ready.set()
+            while not stop.is_set():
+                await asyncio.sleep(0.05)
+    asyncio.run(serve())
+
+
+def _read_frames(client: socket.socket, reader: message_codec.MessageReader, count: int) -> None:
+    received = 0
+    while received < count:
+        reader.receive(client)
+        received += sum(1 for _ in reader.messages())
+
+
+def _run_client(ip_address: IpAddress, round_trips: int, burst: int, payload_size: int) -> dict[str, float]:
+    frame = message_codec.encode_message(1, b"x" * payload_size)
+    reader = message_codec.MessageReader()
+    with socket.create_connection((ip_address.host, ip_address.port)) as client:
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        latencies_ns = []
+        for _ in range(round_trips):
+            start_ns = time.perf_counter_ns()
+            client.sendall(frame)
+            _read_frames(client, reader, 1)
+            latencies_ns.append(time.perf_counter_ns() - start_ns)
+
+        start_ns = time.perf_counter_ns()
+        sender = threading.Thread(target=client.sendall, args=(frame * burst,))
+        sender.start()
+        _read_frames(client, reader, burst)
+        sender.join()
+        burst_seconds = (time.perf_counter_ns() - start_ns) / 1e9
+
+    latencies_ns.sort()
+    return {
+        "rtt_p50_us": latencies_ns[len(latencies_ns) // 2] / 1e3,
+        "rtt_p99_us": latencies_ns[int(len(latencies_ns) * 0.99)] / 1e3,
+        "rtt_mean_us": statistics.fmean(latencies_ns) / 1e3,
+        "burst_msgs_per_sec": burst / burst_seconds,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=51400)
+    parser.add_argument("--round-trips", type=int, default=5_000)
+    parser.add_argument("--burst", type=int, default=50_000)
+    parser.add_argument("--payload-size", type=int, default=64)
+    args = parser.parse_args()
+
+    for offset, (backend, serve) in enumerate((("selectors", _serve_selectors), ("asyncio", _serve_asyncio))):
+        ip_address = IpAddress(args.host, args.port + offset)
+        ready, stop = threading.Event(), threading.Event()
+        server_thread = threading.Thread(target=serve, args=(ip_address, ready, stop), daemon=True)
+        server_thread.start()
+        ready.wait()
+        results = _run_client(ip_address, args.round_trips, args.burst, args.payload_size)
+        stop.set()
+        server_thread.join()
+        print(f"{backend:<10} " + "  ".join(f"{name}={value:,.1f}" for name, value in results.items()))
+
+
+if __name__ == "__main__":
+    main()
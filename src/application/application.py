@@ -2,6 +2,7 @@ from abc import ABC, abstractmethod
 import argparse
 from datetime import datetime
 import logging
+import logging.handlers
 from pathlib import Path
 import signal
 import sys
@@ -9,6 +10,8 @@ from types import FrameType
 from typing import Any
 import jsonschema
 import json
+from application.hot_path_logging import LoggingMode, MessageTypeSampler, start_background_logging
+from connection.fan_out import FanOutWriterPool
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +24,8 @@ class BaseApplication(ABC):
         
         self._init_args_parser()
         self._args = self._parser.parse_args()
+        self._log_listener: logging.handlers.QueueListener | None = None
+        self._writer_pool: FanOutWriterPool | None = None
         self._config_file = self._find_config_file_path()
         self._config = _load_json(self._config_file)
         self._validate_config()
@@ -39,12 +44,27 @@ class BaseApplication(ABC):
             logger.exception("Oops, something went wrong.")
             logger.error("Shutting down")
             raise SystemExit(1)
+        finally:
+            if self._writer_pool is not None:
+                self._writer_pool.close()
+            if self._log_listener is not None:
+                self._log_listener.stop()
     
     @abstractmethod
     def _start(self) -> None:
         """This method should be implemented by the subclass to start the application."""
         pass
 
+    def _fan_out_writer_pool(self) -> FanOutWriterPool | None:
+        """
+        The writer pool that broadcasting services hand subscriber sends to, with the fanOutWriters config key's number
+        of threads, or None if that is 0. Created on first use and closed when run() returns.
+        """
+        num_writers = self._config.get("fanOutWriters", 0)
+        if num_writers and self._writer_pool is None:
+            self._writer_pool = FanOutWriterPool(num_writers)
+        return self._writer_pool
+
     def _init_args_parser(self) -> None:
         self._parser = argparse.ArgumentParser()
         self._parser.add_argument("-c", "--config", help="(String) Path to config file to load", default=None)
@@ -66,16 +86,28 @@ class BaseApplication(ABC):
         log_level_str = self._config["logLevel"]
         log_directory = Path(self._config["logDirectory"])
         log_file = log_directory / f"{self._app_name}_{datetime.now():%Y%m%d_%H%M%S}.log"
-        logging.basicConfig(
-            format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S",
-            level=_get_log_level(log_level_str),
-            handlers=[
-                logging.FileHandler(log_file),
-                logging.StreamHandler()
-            ]
-        )
-        logger.info(f"Logging initialized. Log file: {log_file}")
+        logging_config = self._config.get("logging", {})
+        logging_mode = LoggingMode(logging_config.get("mode", LoggingMode.STANDARD.value))
+        sample_every = {int(message_type): rate for message_type, rate in logging_config.get("sampleEvery", {}).items()}
+        handlers: list[logging.Handler] = [
+            logging.FileHandler(log_file),
+            logging.StreamHandler()
+        ]
+        formatter = logging.Formatter(fmt="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+                                      datefmt="%Y-%m-%d %H:%M:%S")
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        if logging_mode == LoggingMode.LOW_LATENCY:
+            # Sampled once on the queue handler, before the records fan out to the handlers
+            self._log_listener = start_background_logging(handlers, _get_log_level(log_level_str),
+                                                          MessageTypeSampler(sample_every))
+        else:
+            # A sampler counts every record it sees, so each handler needs its own to keep the same records
+            for handler in handlers:
+                handler.addFilter(MessageTypeSampler(sample_every))
+            logging.basicConfig(level=_get_log_level(log_level_str), handlers=handlers)
+        logger.info(f"Logging initialized in {logging_mode.value} mode. Log file: {log_file}")
 
     def _register_signal_handlers(self) -> None:
         signal.signal(signal.SIGINT, handler=self._shutdown)
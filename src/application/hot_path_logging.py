@@ -0,0 +1,81 @@
+import dataclasses
+import logging
+import logging.handlers
+import queue
+from collections import defaultdict
+from enum import Enum
+
+from connection.message_codec import MESSAGE_TYPE_ATTRIBUTE
+
+_IMMUTABLE_ARG_TYPES = (int, float, str, bytes, bool, type(None), frozenset)
+
+
+class LoggingMode(Enum):
+    STANDARD = "standard"  # Handlers write synchronously on the calling thread
+    LOW_LATENCY = "lowLatency"  # Records are queued and formatted/written by a background thread
+
+
+class MessageTypeSampler(logging.Filter):
+    """
+    Lets through only one in every N records for each configured message type.
+    Records without a message_type attribute, or of types without a sampling rate, always pass.
+    """
+
+    def __init__(self, sample_every: dict[int, int]) -> None:
+        super().__init__()
+        self._sample_every = {message_type: rate for message_type, rate in sample_every.items() if rate > 1}
+        self._seen: defaultdict[int, int] = defaultdict(int)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message_type = getattr(record, MESSAGE_TYPE_ATTRIBUTE, None)
+        rate = self._sample_every.get(message_type)  # type: ignore[arg-type]
+        if rate is None:
+            return True
+        seen = self._seen[message_type]  # type: ignore[index]
+        self._seen[message_type] = seen + 1  # type: ignore[index]
+        return seen % rate == 0
+
+
+class DeferredFormattingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves message formatting to the listener thread whenever that is safe, i.e. when the
+    record has no exception attached and all its arguments are immutable. Other records are formatted
+    eagerly, as the standard QueueHandler does, so later mutation of an argument cannot change what is logged.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info or record.stack_info or not _has_immutable_args(record):
+            return super().prepare(record)
+        return record
+
+
+def start_background_logging(handlers: list[logging.Handler], log_level: int,
+                             record_filter: logging.Filter | None = None) -> logging.handlers.QueueListener:
+    """
+    Routes all root logger records through an unbounded queue to a QueueListener thread that owns the given handlers.
+    @return: The started listener; stop() it on shutdown to flush the remaining records.
+    """
+    queue_handler = DeferredFormattingQueueHandler(queue.SimpleQueue())
+    if record_filter is not None:
+        queue_handler.addFilter(record_filter)
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(log_level)
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def _has_immutable_args(record: logging.LogRecord) -> bool:
+    args = record.args
+    if not args:
+        return True
+    if isinstance(args, dict):
+        args = tuple(args.values())
+    return all(isinstance(arg, _IMMUTABLE_ARG_TYPES) or _is_frozen_dataclass(arg) for arg in args)
+
+
+def _is_frozen_dataclass(value: object) -> bool:
+    return dataclasses.is_dataclass(value) and value.__dataclass_params__.frozen  # type: ignore[union-attr]
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from connection.message_codec import MESSAGE_TYPE_ATTRIBUTE
+from connection import message_codec
+from connection.connection_handler import (DEFAULT_HIGH_WATER_MARK_BYTES, ConnectionHandler, ConnectionHandlerFactory,
+                                           ConnectionHandlerType, LambdaConnectionHandlerFactory, SlowConsumerPolicy)
+from connection.ip_address import IpAddress
+from connection.tcp_connection_manager import _LambdaConnectionHandlerFactory
+
+logger = logging.getLogger(__name__)
+
+
+class _FramingProtocol(asyncio.Protocol):
+    """Adapts an asyncio stream to the ConnectionHandler interface: splits data_received into frames."""
+
+    def __init__(self, handler_factory: ConnectionHandlerFactory, high_water_mark_bytes: int,
+                 slow_consumer_policy: SlowConsumerPolicy) -> None:
+        self.handler: ConnectionHandler | None = None
+        self._handler_factory = handler_factory
+        self._high_water_mark_bytes = high_water_mark_bytes
+        self._slow_consumer_policy = slow_consumer_policy
+        self._reader = message_codec.MessageReader()
+        self._transport: asyncio.Transport | None = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        assert isinstance(transport, asyncio.Transport)
+        host, port = transport.get_extra_info("peername")[:2]
+        ip_address = IpAddress(host=host, port=port)
+        logger.info(f"Connection established with {ip_address}")
+        self._transport = transport
+        self.handler = self._handler_factory.on_new_connection(
+            transport.get_extra_info("socket"), ip_address, transport.close)
+        self.handler._attach_transport(transport, self._high_water_mark_bytes, self._slow_consumer_policy)
+
+    def data_received(self, data: bytes) -> None:
+        assert self.handler is not None and self._transport is not None
+        self._reader.feed(data)
+        try:
+            for message_type, message in self._reader.messages():
+                logger.debug("Received message type %d with length %d", message_type, len(message),
+                             extra={MESSAGE_TYPE_ATTRIBUTE: message_type})
+                try:
+                    self.handler.handle_message(message_type, message)
+                except Exception:
+                    logger.exception(f"Error while handling message from {self.handler.ip_address}. Client will be disconnected")
+                    self._transport.abort()
+                    return
+                if self._transport.is_closing():
+                    logger.debug("Connection to %s closed while handling messages", self.handler.ip_address)
+                    return
+        except message_codec.FrameError as e:
+            logger.warning(f"Invalid frame from {self.handler.ip_address}: {str(e)}. Client will be disconnected")
+            self._transport.abort()
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        assert self.handler is not None
+        if exc is not None:
+            logger.warning(f"Connection to {self.handler.ip_address} lost: {exc}")
+        logger.info(f"Connection to {self.handler.ip_address} closed")
+        self.handler.on_disconnect()
+        self._handler_factory.on_connection_closed(self.handler)
+
+
+class AsyncioConnectionManager:
+    """
+    asyncio counterpart of TcpConnectionManager with the same listen/connect surface.
+    Existing ConnectionHandlerFactory and ConnectionHandler subclasses work unchanged: messages are framed
+    in data_received and sends go through transport.write buffering.
+    """
+
+    def __init__(self, high_water_mark_bytes: int = DEFAULT_HIGH_WATER_MARK_BYTES,
+                 slow_consumer_policy: SlowConsumerPolicy = SlowConsumerPolicy.DISCONNECT) -> None:
+        """
+        @param high_water_mark_bytes: Maximum bytes buffered by a connection's transport before it is disconnected.
+        @param slow_consumer_policy: Kept for parity with TcpConnectionManager; transports always disconnect.
+        """
+        self.high_water_mark_bytes = high_water_mark_bytes
+        self.slow_consumer_policy = slow_consumer_policy
+
+    async def listen(self, ip_address: IpAddress,
+                     handler_factory: ConnectionHandlerFactory | _LambdaConnectionHandlerFactory) -> asyncio.Server:
+        """
+        Starts a TCP/IP server on the specified host and port.
+        @return: The server; use it as an async context manager and await serve_forever() to keep it running.
+        """
+        if callable(handler_factory):
+            handler_factory = LambdaConnectionHandlerFactory(handler_factory)
+
+        logger.info(f"Starting server on {ip_address}")
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: _FramingProtocol(handler_factory, self.high_water_mark_bytes, self.slow_consumer_policy),
+            ip_address.host, ip_address.port, reuse_address=True)
+        logger.info(f"Listening on {ip_address}")
+        return server
+
+    async def connect(self, ip_address: IpAddress,
+                      handler_factory: ConnectionHandlerFactory[ConnectionHandlerType] | _LambdaConnectionHandlerFactory) -> ConnectionHandlerType:
+        if callable(handler_factory):
+            handler_factory = LambdaConnectionHandlerFactory(handler_factory)
+
+        logger.info(f"Connecting to {ip_address}")
+        loop = asyncio.get_running_loop()
+        try:
+            _, protocol = await loop.create_connection(
+                lambda: _FramingProtocol(handler_factory, self.high_water_mark_bytes, self.slow_consumer_policy),
+                ip_address.host, ip_address.port)
+        except OSError as e:
+            raise ConnectionError(f"Failed to connect to {ip_address}: {e}") from e
+        logger.info(f"Connected to {ip_address}")
+        assert protocol.handler is not None
+        return protocol.handler  # type: ignore
@@ -1,22 +1,56 @@
+import asyncio
 import logging
 import socket
+import threading
 from abc import ABC, abstractmethod
-from typing import Callable, Generic, Type, TypeVar
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum
+from itertools import islice
+from typing import Callable, Generic, Hashable, Type, TypeVar
 
 from connection import message_codec
+from connection.message_codec import MESSAGE_TYPE_ATTRIBUTE
 from connection.ip_address import IpAddress
+from connection.timer_wheel import SYSTEM_CLOCK, Clock
 from google.protobuf.message import Message
 
 logger = logging.getLogger(__name__)
 
 ProtoMessage = TypeVar('ProtoMessage', bound=Message)
 
+DEFAULT_HIGH_WATER_MARK_BYTES = 4 * 1024 * 1024
+MAX_FRAMES_PER_FLUSH = 64  # Queued frames gathered into a single sendmsg call
+
+
+class SlowConsumerPolicy(Enum):
+    """What to do with a connection whose outbound queue grows above the high-water mark."""
+    DISCONNECT = "disconnect"
+    CONFLATE = "conflate"  # Drop queued frames superseded by a newer frame with the same conflation key, then disconnect if still above the mark
+
+
+@dataclass(slots=True)
+class _OutboundFrame:
+    data: memoryview
+    conflation_key: Hashable | None  # None once the frame is partially sent, so it can never be dropped
+
+
 class ConnectionHandler(ABC):
     def __init__(self, socket_fd: socket.socket, ip_address: IpAddress, 
                  close_callback: Callable[[], None]) -> None:
         self.socket_fd = socket_fd
         self.ip_address = ip_address
         self.close_callback = close_callback
+        self.high_water_mark_bytes = DEFAULT_HIGH_WATER_MARK_BYTES
+        self.slow_consumer_policy = SlowConsumerPolicy.DISCONNECT
+        self._outbound_queue: deque[_OutboundFrame] = deque()
+        self._outbound_bytes = 0
+        self._write_interest_callback: Callable[[bool], None] | None = None
+        self._header_buffer = bytearray(message_codec.HEADER_BYTES)
+        self._transport: asyncio.WriteTransport | None = None  # Set when served by the asyncio backend
+        self._send_lock = threading.RLock()  # Writer threads and the event loop may both send on this connection
+        self._closing = False  # Set once this handler asked for its connection to be closed; later sends are dropped
+        self.clock: Clock = SYSTEM_CLOCK  # Replaced by the connection manager's per-iteration loop clock
 
     def __enter__(self):
         return self
@@ -33,28 +67,193 @@ class ConnectionHandler(ABC):
     def on_disconnect(self) -> None:
         pass
 
-    def send_message(self, message_type: int, message: ProtoMessage) -> None:
-        logger.info(f"Preparing to send message of type {message_type} to {self.ip_address}...")
-        logger.debug(f"Message: {message}")
+    @property
+    def outbound_bytes(self) -> int:
+        """Number of bytes queued for this connection but not yet accepted by the kernel."""
+        if self._transport is not None:
+            return self._transport.get_write_buffer_size()
+        return self._outbound_bytes
+
+    def send_message(self, message_type: int, message: ProtoMessage, conflation_key: Hashable | None = None) -> None:
+        """
+        Serializes and sends a message, queueing whatever the socket cannot take right now.
+        @param conflation_key: Frames sharing a key may be conflated if this consumer falls behind.
+        """
+        if self._closing:
+            return
+        logger.info("Preparing to send message of type %d to %s...", message_type, self.ip_address,
+                    extra={MESSAGE_TYPE_ATTRIBUTE: message_type})
+        logger.debug("Message: %s", message)
         try:
-            serialized_message = message.SerializeToString()
-            encoded_message = message_codec.encode_message(message_type, serialized_message)
-            self._send_message(encoded_message)
-            logger.info(f"Sent message successfully")
+            with self._send_lock:
+                self._send_frame(message_type, message.SerializeToString(), conflation_key)
+            logger.debug("Sent message successfully")
         except socket.error as e:
             logger.exception(f"Failed to send message to {self.ip_address}")
-            logger.info(f"Closing connection to {self.ip_address}...")
-            self.close_callback()
+            self._request_close()
+
+    def send_encoded_message(self, encoded_message: bytes, conflation_key: Hashable | None = None) -> None:
+        """
+        Sends an already encoded frame. Broadcasts use this to share one immutable frame between recipients.
+        """
+        if self._closing:
+            return
+        try:
+            with self._send_lock:
+                self._send_message(encoded_message, conflation_key)
+            logger.debug("Sent message successfully")
+        except socket.error as e:
+            logger.exception(f"Failed to send message to {self.ip_address}")
+            self._request_close()
+
+    def _send_frame(self, message_type: int, message: bytes, conflation_key: Hashable | None = None) -> None:
+        """Sends header and message with a single scatter/gather write, without concatenating them first."""
+        if self._transport is not None:
+            self._transport.writelines((message_codec.encode_header(message_type, len(message)), message))
+            self._check_transport_backlog()
+            return
+        if self._outbound_queue:
+            self._enqueue(memoryview(message_codec.encode_message(message_type, message)), conflation_key)
+            return
+        try:
+            sent_bytes = message_codec.send_message(self.socket_fd, self._header_buffer, message_type, message)
+        except BlockingIOError:
+            sent_bytes = 0
+        frame_bytes = message_codec.HEADER_BYTES + len(message)
+        if sent_bytes == frame_bytes:
+            return
+        logger.debug("Socket to %s accepted %d of %d bytes, queueing the rest", self.ip_address, sent_bytes, frame_bytes)
+        if sent_bytes < message_codec.HEADER_BYTES:
+            # The header buffer is reused by the next send, so the unsent part of it has to be copied
+            remainder = memoryview(bytes(self._header_buffer[sent_bytes:]) + message)
+        else:
+            remainder = memoryview(message)[sent_bytes - message_codec.HEADER_BYTES:]
+        self._enqueue(remainder, conflation_key if sent_bytes == 0 else None)
+
+    def _send_message(self, encoded_message: bytes, conflation_key: Hashable | None = None) -> None:
+        logger.debug("Sending message of %d bytes", len(encoded_message))
+        if self._transport is not None:
+            self._transport.write(encoded_message)
+            self._check_transport_backlog()
+            return
+        if self._outbound_queue:
+            # Preserve ordering behind frames that are already waiting for the socket
+            self._enqueue(memoryview(encoded_message), conflation_key)
+            return
+        try:
+            sent_bytes = self.socket_fd.send(encoded_message)
+        except BlockingIOError:
+            sent_bytes = 0
+        if sent_bytes < len(encoded_message):
+            logger.debug("Socket to %s accepted %d of %d bytes, queueing the rest",
+                         self.ip_address, sent_bytes, len(encoded_message))
+            self._enqueue(memoryview(encoded_message)[sent_bytes:], conflation_key if sent_bytes == 0 else None)
+
+    def flush_outbound_queue(self) -> None:
+        """Writes queued frames until the queue is empty or the socket would block. Called when the socket is writable."""
+        with self._send_lock:
+            self._flush_outbound_queue()
+
+    def _flush_outbound_queue(self) -> None:
+        queue = self._outbound_queue
+        try:
+            while queue:
+                sent_bytes = self.socket_fd.sendmsg([frame.data for frame in islice(queue, MAX_FRAMES_PER_FLUSH)])
+                self._outbound_bytes -= sent_bytes
+                while queue and sent_bytes >= len(queue[0].data):
+                    sent_bytes -= len(queue.popleft().data)
+                if sent_bytes:
+                    frame = queue[0]
+                    frame.data = frame.data[sent_bytes:]
+                    frame.conflation_key = None
+                    return
+        except BlockingIOError:
+            return
+        except socket.error:
+            logger.exception(f"Failed to flush outbound queue to {self.ip_address}")
+            self._request_close()
+            return
+        logger.debug("Outbound queue to %s drained", self.ip_address)
+        if self._write_interest_callback is not None:
+            self._write_interest_callback(False)
+
+    def _configure_outbound_queue(self, high_water_mark_bytes: int, slow_consumer_policy: SlowConsumerPolicy,
+                                  write_interest_callback: Callable[[bool], None]) -> None:
+        """Called by the connection manager to apply its limits and learn when to watch for writability."""
+        self.high_water_mark_bytes = high_water_mark_bytes
+        self.slow_consumer_policy = slow_consumer_policy
+        self._write_interest_callback = write_interest_callback
+        if self._outbound_queue:
+            write_interest_callback(True)
+
+    def _attach_transport(self, transport: asyncio.WriteTransport, high_water_mark_bytes: int,
+                          slow_consumer_policy: SlowConsumerPolicy) -> None:
+        """Called by the asyncio connection manager: writes then go through the transport's own buffering."""
+        self._transport = transport
+        self.high_water_mark_bytes = high_water_mark_bytes
+        self.slow_consumer_policy = slow_consumer_policy
+
+    def _check_transport_backlog(self) -> None:
+        assert self._transport is not None
+        buffered_bytes = self._transport.get_write_buffer_size()
+        if buffered_bytes > self.high_water_mark_bytes and not self._transport.is_closing():
+            # Frames already handed to the transport cannot be conflated, so both policies disconnect here
+            logger.warning(f"Transport to {self.ip_address} buffers {buffered_bytes} bytes, above the "
+                           f"high-water mark of {self.high_water_mark_bytes}. Disconnecting slow consumer")
+            self._transport.abort()
+
+    def _enqueue(self, data: memoryview, conflation_key: Hashable | None) -> None:
+        was_empty = not self._outbound_queue
+        self._outbound_queue.append(_OutboundFrame(data, conflation_key))
+        self._outbound_bytes += len(data)
+        if self._outbound_bytes > self.high_water_mark_bytes and not self._handle_slow_consumer():
+            return
+        if was_empty and self._write_interest_callback is not None:
+            self._write_interest_callback(True)
+
+    def _handle_slow_consumer(self) -> bool:
+        """
+        Applies the slow consumer policy once the outbound queue is above the high-water mark.
+        @return: True if the connection is kept open.
+        """
+        if self.slow_consumer_policy == SlowConsumerPolicy.CONFLATE:
+            self._conflate_outbound_queue()
+            if self._outbound_bytes <= self.high_water_mark_bytes:
+                return True
+        logger.warning(f"Outbound queue to {self.ip_address} holds {self._outbound_bytes} bytes, above the "
+                       f"high-water mark of {self.high_water_mark_bytes}. Disconnecting slow consumer")
+        self._outbound_queue.clear()
+        self._outbound_bytes = 0
+        self._request_close()
+        return False
+
+    def _request_close(self) -> None:
+        if self._closing:
+            return
+        self._closing = True
+        logger.info(f"Closing connection to {self.ip_address}...")
+        self.close_callback()
 
-    def _send_message(self, encoded_message: bytes) -> None:
-        logger.debug(f"Sending message of {len(encoded_message)} bytes")
-        self.socket_fd.sendall(encoded_message)
+    def _conflate_outbound_queue(self) -> None:
+        """Keeps only the newest queued frame for each conflation key."""
+        seen_keys: set[Hashable] = set()
+        kept_frames: deque[_OutboundFrame] = deque()
+        for frame in reversed(self._outbound_queue):
+            if frame.conflation_key is not None:
+                if frame.conflation_key in seen_keys:
+                    self._outbound_bytes -= len(frame.data)
+                    continue
+                seen_keys.add(frame.conflation_key)
+            kept_frames.appendleft(frame)
+        logger.info(f"Conflated outbound queue to {self.ip_address} from {len(self._outbound_queue)} "
+                    f"to {len(kept_frames)} frames")
+        self._outbound_queue = kept_frames
 
     @staticmethod
     def _deserialize_message(proto_message_type: type[ProtoMessage], message: bytes) -> ProtoMessage:
         proto_message = proto_message_type()
         proto_message.ParseFromString(message)
-        logger.debug(f"Deserialized message of type {proto_message_type.__name__}: {proto_message}")
+        logger.debug("Deserialized message of type %s: %s", proto_message_type.__name__, proto_message)
         return proto_message
     
 
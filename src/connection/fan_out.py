@@ -0,0 +1,75 @@
+import logging
+import queue
+import threading
+from typing import Hashable, Sequence
+
+from connection.connection_handler import ConnectionHandler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WRITER_THREADS = 4
+
+
+class FanOutWriterPool:
+    """
+    Takes subscriber writes off the publishing thread.
+    Each writer thread owns a fixed shard of connections (chosen by hashing the handler) and is the only writer
+    that sends published frames to them, so per-connection ordering is preserved. Publishing splits the recipients
+    by shard once and costs at most one queue put per writer; the writers share the encoded frame without copying it.
+    Handlers are thread-safe for sending, and connection managers defer closes and selector changes requested
+    by writer threads to their event loop thread.
+    """
+
+    def __init__(self, num_writers: int = DEFAULT_WRITER_THREADS, name: str = "fan-out-writer") -> None:
+        if num_writers < 1:
+            raise ValueError(f"A writer pool needs at least one writer, got {num_writers}")
+        self.num_writers = num_writers
+        self._queues: list[queue.SimpleQueue[tuple[bytes, Sequence[ConnectionHandler], Hashable | None] | None]] = [
+            queue.SimpleQueue() for _ in range(num_writers)]
+        self._threads = [threading.Thread(target=self._run_writer, args=(shard,), name=f"{name}-{shard}", daemon=True)
+                         for shard in range(num_writers)]
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"Started {num_writers} fan-out writer threads")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def publish(self, encoded_message: bytes, recipients: Sequence[ConnectionHandler],
+                conflation_key: Hashable | None = None) -> None:
+        """
+        Hands an encoded frame to the writers. Returns immediately; each writer sends it to its own shard of recipients.
+        Writers with no recipients in their shard are not woken.
+        """
+        num_writers = self.num_writers
+        if num_writers == 1:
+            if recipients:
+                self._queues[0].put((encoded_message, tuple(recipients), conflation_key))
+            return
+        shards: list[list[ConnectionHandler]] = [[] for _ in range(num_writers)]
+        for connection_handler in recipients:
+            shards[hash(connection_handler) % num_writers].append(connection_handler)
+        for writer_queue, shard_recipients in zip(self._queues, shards):
+            if shard_recipients:
+                writer_queue.put((encoded_message, shard_recipients, conflation_key))
+
+    def close(self) -> None:
+        """Stops the writers after they have sent everything already published."""
+        for writer_queue in self._queues:
+            writer_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        logger.info("Fan-out writer threads stopped")
+
+    def _run_writer(self, shard: int) -> None:
+        writer_queue = self._queues[shard]
+        while (job := writer_queue.get()) is not None:
+            encoded_message, recipients, conflation_key = job
+            for connection_handler in recipients:
+                try:
+                    connection_handler.send_encoded_message(encoded_message, conflation_key)
+                except Exception:
+                    logger.exception(f"Writer {shard} failed to send to {connection_handler.ip_address}")
@@ -1,12 +1,39 @@
 import logging
 import socket
-from typing import Literal
+import struct
+from typing import Iterator, Literal
 
 logger = logging.getLogger(__name__)
 
 BYTE_ORDER: Literal['little', 'big'] = 'big'
 MESSAGE_SIZE_BYTES = 4
 MESSAGE_TYPE_BYTES = 4
+HEADER_BYTES = MESSAGE_SIZE_BYTES + MESSAGE_TYPE_BYTES
+
+DEFAULT_READ_BUFFER_SIZE = 64 * 1024
+MIN_RECV_BYTES = 4 * 1024
+MAX_MESSAGE_BYTES = 16 * 1024 * 1024
+
+# Attribute set through `extra` on hot-path log records so they can be sampled per message type
+MESSAGE_TYPE_ATTRIBUTE = "message_type"
+
+_HEADER = struct.Struct(('>' if BYTE_ORDER == 'big' else '<') + 'II')
+
+
+class FrameError(ValueError):
+    """Raised when a peer sends a frame length that no valid frame can have. The stream cannot be resynchronised,
+    so the connection must be closed."""
+
+
+def check_frame_length(msg_len: int, max_message_bytes: int = MAX_MESSAGE_BYTES) -> None:
+    """
+    @param msg_len: The length field of a frame header, which counts the message type and the message.
+    @raise FrameError: If the length cannot even hold the message type, or exceeds max_message_bytes.
+    """
+    if msg_len < MESSAGE_TYPE_BYTES:
+        raise FrameError(f"Frame length {msg_len} is shorter than the {MESSAGE_TYPE_BYTES} byte message type")
+    if msg_len > max_message_bytes + MESSAGE_TYPE_BYTES:
+        raise FrameError(f"Frame length {msg_len} exceeds the {max_message_bytes} byte message limit")
 
 
 def encode_message(message_type: int, message: bytes) -> bytes:
@@ -17,6 +44,21 @@ def encode_message(message_type: int, message: bytes) -> bytes:
     return output_stream
 
 
+def encode_header(message_type: int, message_length: int) -> bytes:
+    """Returns the 8-byte frame header for a message of message_length bytes."""
+    return _HEADER.pack(message_length + MESSAGE_TYPE_BYTES, message_type)
+
+
+def send_message(socket_fd: socket.socket, header_buffer: bytearray, message_type: int, message: bytes) -> int:
+    """
+    Sends one frame with scatter/gather I/O: the header is packed into the reusable header_buffer and sent
+    together with the message, without joining them.
+    @return: The number of bytes accepted by the socket, which may be less than HEADER_BYTES + len(message).
+    """
+    _HEADER.pack_into(header_buffer, 0, len(message) + MESSAGE_TYPE_BYTES, message_type)
+    return socket_fd.sendmsg((header_buffer, message))
+
+
 def read_message(socket_fd: socket.socket) -> tuple[int, bytes]:
     raw_msg_len = socket_fd.recv(MESSAGE_SIZE_BYTES)
     if not raw_msg_len:
@@ -24,6 +66,7 @@ def read_message(socket_fd: socket.socket) -> tuple[int, bytes]:
 
     msg_len = int.from_bytes(raw_msg_len, byteorder=BYTE_ORDER)
     logger.debug(f"Received expected message length: {msg_len}")
+    check_frame_length(msg_len)
 
     raw_msg = socket_fd.recv(msg_len)
     logger.debug(f"Actual message length: {len(raw_msg)}")
@@ -31,3 +74,98 @@ def read_message(socket_fd: socket.socket) -> tuple[int, bytes]:
     message_type = int.from_bytes(raw_msg[:MESSAGE_TYPE_BYTES], byteorder=BYTE_ORDER)
     message = raw_msg[MESSAGE_TYPE_BYTES:]
     return message_type, message
+
+
+class MessageReader:
+    """
+    Per-connection receive buffer that turns a byte stream into complete frames.
+    Each call to receive() drains what the socket has available with recv_into, then
+    messages() yields every complete frame. Incomplete frames stay buffered until the
+    rest of their bytes arrive. A frame header with an impossible length raises FrameError
+    before any buffer is grown for it.
+    """
+
+    def __init__(self, buffer_size: int = DEFAULT_READ_BUFFER_SIZE, max_message_bytes: int = MAX_MESSAGE_BYTES) -> None:
+        self._max_message_bytes = max_message_bytes
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # First unconsumed byte
+        self._end = 0  # One past the last received byte
+
+    @property
+    def buffered_bytes(self) -> int:
+        return self._end - self._start
+
+    def receive(self, socket_fd: socket.socket) -> int:
+        """
+        Reads everything currently available on a non-blocking socket into the buffer.
+        @return: The number of bytes received.
+        @raise BrokenPipeError: If the peer closed the connection.
+        @raise FrameError: If the buffered frame header has an invalid length.
+        """
+        total_received = 0
+        while True:
+            self._reserve(max(MIN_RECV_BYTES, self._required_bytes()))
+            free_bytes = len(self._buffer) - self._end
+            try:
+                received = socket_fd.recv_into(self._view[self._end:], free_bytes)
+            except BlockingIOError:
+                break
+            if received == 0:
+                if total_received:
+                    break
+                raise BrokenPipeError("No data on socket")
+            self._end += received
+            total_received += received
+            if received < free_bytes:
+                break
+        return total_received
+
+    def feed(self, data: bytes) -> None:
+        """Appends bytes that were received by other means, e.g. an asyncio transport."""
+        self._reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def messages(self) -> Iterator[tuple[int, bytes]]:
+        """
+        Yields (message_type, message) for every complete frame currently buffered.
+        @raise FrameError: If a frame header has an invalid length.
+        """
+        view = self._view
+        while self._end - self._start >= HEADER_BYTES:
+            msg_len, message_type = _HEADER.unpack_from(view, self._start)
+            check_frame_length(msg_len, self._max_message_bytes)
+            frame_end = self._start + MESSAGE_SIZE_BYTES + msg_len
+            if frame_end > self._end:
+                break
+            message = bytes(view[self._start + HEADER_BYTES:frame_end])
+            self._start = frame_end
+            yield message_type, message
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def _required_bytes(self) -> int:
+        """Bytes still missing from the partial frame at the head of the buffer, if its header is known."""
+        if self._end - self._start < MESSAGE_SIZE_BYTES:
+            return 1
+        msg_len = int.from_bytes(self._view[self._start:self._start + MESSAGE_SIZE_BYTES], byteorder=BYTE_ORDER)
+        check_frame_length(msg_len, self._max_message_bytes)
+        return max(1, self._start + MESSAGE_SIZE_BYTES + msg_len - self._end)
+
+    def _reserve(self, required_bytes: int) -> None:
+        """Makes room for at least required_bytes after the buffered data, compacting or growing the buffer."""
+        if len(self._buffer) - self._end >= required_bytes:
+            return
+        buffered_bytes = self._end - self._start
+        if len(self._buffer) - buffered_bytes >= required_bytes:
+            self._view[:buffered_bytes] = self._view[self._start:self._end]
+        else:
+            new_size = max(2 * len(self._buffer), buffered_bytes + required_bytes)
+            logger.debug(f"Growing receive buffer to {new_size} bytes")
+            new_buffer = bytearray(new_size)
+            new_buffer[:buffered_bytes] = self._view[self._start:self._end]
+            self._view.release()
+            self._buffer = new_buffer
+            self._view = memoryview(self._buffer)
+        self._start, self._end = 0, buffered_bytes
@@ -0,0 +1,62 @@
+import logging
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from connection.message_codec import MESSAGE_TYPE_ATTRIBUTE
+from google.protobuf.message import Message
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class _Route:
+    proto_type: type[Message]
+    handler: Callable[[Any], None]
+    pooled_message: Message | None  # Reused for every frame of this type, None if the handler keeps the message
+
+
+class MessageDispatcher:
+    """
+    Maps (service, message_type) to a proto class and a bound handler, so dispatch is one dict lookup.
+    The service name tells apart protocols whose message type numbers overlap, e.g. a handler that serves
+    info clients and also consumes the order book feed.
+
+    By default each route parses into one pooled message instance (ParseFromString clears it first), so no
+    proto is allocated per frame. Handlers that keep a reference to the message after returning, e.g. by
+    storing a request until its response arrives, must be registered with reuse_message=False.
+    """
+
+    def __init__(self) -> None:
+        self._routes: dict[tuple[str, int], _Route] = {}
+        self.unknown_message_counts: Counter[tuple[str, int]] = Counter()
+
+    def register(self, service: str, message_type: int, proto_type: type[Message], handler: Callable[[Any], None],
+                 reuse_message: bool = True) -> None:
+        route_key = (service, message_type)
+        if route_key in self._routes:
+            raise ValueError(f"A handler is already registered for {service} message type {message_type}")
+        self._routes[route_key] = _Route(proto_type, handler, proto_type() if reuse_message else None)
+
+    def dispatch(self, service: str, message_type: int, message: bytes) -> bool:
+        """
+        Parses the frame into its registered proto type and calls the handler.
+        @return: False if no handler is registered for the message type.
+        """
+        route = self._routes.get((service, message_type))
+        if route is None:
+            self._on_unknown_message(service, message_type)
+            return False
+        proto_message = route.pooled_message
+        if proto_message is None:
+            proto_message = route.proto_type()
+        proto_message.ParseFromString(message)
+        route.handler(proto_message)
+        return True
+
+    def _on_unknown_message(self, service: str, message_type: int) -> None:
+        count = self.unknown_message_counts[(service, message_type)] + 1
+        self.unknown_message_counts[(service, message_type)] = count
+        if count & (count - 1) == 0:  # Log the 1st, 2nd, 4th, 8th... occurrence only
+            logger.warning("Received %d message(s) of unknown %s message type %d", count, service, message_type,
+                           extra={MESSAGE_TYPE_ATTRIBUTE: message_type})
@@ -3,10 +3,15 @@ import socket
 import selectors
 import errno
 import logging
+import queue
+import threading
 from typing import Callable
+from connection.message_codec import MESSAGE_TYPE_ATTRIBUTE
 from connection import message_codec
-from connection.connection_handler import ConnectionHandler, ConnectionHandlerFactory, ConnectionHandlerType
+from connection.connection_handler import (DEFAULT_HIGH_WATER_MARK_BYTES, ConnectionHandler, ConnectionHandlerFactory,
+                                           ConnectionHandlerType, SlowConsumerPolicy)
 from connection.ip_address import IpAddress
+from connection.timer_wheel import DEFAULT_TICK_NS, LoopClock, Timer, TimerWheel
 from enum import Enum
 
 logger = logging.getLogger(__name__)
@@ -28,13 +33,15 @@ class _TcpServerContextManager:
 class _ConnectionType(Enum):
     SERVER = 1
     CLIENT = 2
+    WAKEUP = 3
 
 
 @dataclass
 class _ConnectionData:
     connection_type: _ConnectionType
-    handler_factory: ConnectionHandlerFactory
+    handler_factory: ConnectionHandlerFactory | None  # Not used for the wakeup socket
     handler: ConnectionHandler | None = None  # Only used for client connections
+    reader: message_codec.MessageReader | None = None  # Only used for client connections
 
 
 _LambdaConnectionHandlerFactory = Callable[[socket.socket, IpAddress, Callable[[], None]], ConnectionHandlerType]
@@ -53,14 +60,82 @@ class _LambdaConnectionHandlerFactoryWrapper(ConnectionHandlerFactory[Connection
 
 
 class TcpConnectionManager:
-    def __init__(self) -> None:
+    def __init__(self, high_water_mark_bytes: int = DEFAULT_HIGH_WATER_MARK_BYTES,
+                 slow_consumer_policy: SlowConsumerPolicy = SlowConsumerPolicy.DISCONNECT,
+                 timer_tick_ns: int = DEFAULT_TICK_NS) -> None:
+        """
+        @param high_water_mark_bytes: Maximum bytes queued for a single connection before the slow consumer policy applies.
+        @param slow_consumer_policy: Whether to disconnect or conflate connections whose outbound queue exceeds the mark.
+        @param timer_tick_ns: Resolution of timers scheduled with call_later and call_every.
+        """
         self.socket_selector = selectors.DefaultSelector()
+        self.clock = LoopClock()  # Updated once per wait_for_events iteration and shared with every handler
+        self.timers = TimerWheel(self.clock.monotonic_ns, timer_tick_ns)
+        self.high_water_mark_bytes = high_water_mark_bytes
+        self.slow_consumer_policy = slow_consumer_policy
+        self._loop_thread_id: int | None = None  # Thread running wait_for_events, once it has been called
+        self._pending_callbacks: queue.SimpleQueue[Callable[[], None]] = queue.SimpleQueue()
+        self._iteration_callbacks: list[Callable[[], None]] = []
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self.socket_selector.register(self._wakeup_receiver, selectors.EVENT_READ,
+                                      data=_ConnectionData(_ConnectionType.WAKEUP, None))
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback) -> None:
         self.socket_selector.close()
+        self._wakeup_receiver.close()
+        self._wakeup_sender.close()
+
+    def call_soon_threadsafe(self, callback: Callable[[], None]) -> None:
+        """
+        Runs callback on the event loop thread during its next wait_for_events iteration, waking it up if needed.
+        Safe to call from any thread, e.g. writer threads that need to close a connection.
+        """
+        self._pending_callbacks.put(callback)
+        try:
+            self._wakeup_sender.send(b"\0")
+        except BlockingIOError:
+            pass  # Plenty of wakeups already pending
+
+    def call_later(self, delay_in_seconds: float, callback: Callable[[], None]) -> Timer:
+        """
+        Runs callback on the event loop thread once the delay has passed. Must be called from the event loop thread.
+        @return: A timer that can be cancelled.
+        """
+        return self.timers.schedule(self._scheduling_time_ns() + int(delay_in_seconds * 1e9), callback)
+
+    def call_every(self, interval_in_seconds: float, callback: Callable[[], None]) -> Timer:
+        """
+        Runs callback on the event loop thread every interval until the returned timer is cancelled.
+        Must be called from the event loop thread.
+        """
+        interval_ns = int(interval_in_seconds * 1e9)
+        return self.timers.schedule(self._scheduling_time_ns() + interval_ns, callback, interval_ns)
+
+    def add_iteration_callback(self, callback: Callable[[], None]) -> None:
+        """
+        Runs callback at the end of every wait_for_events iteration, after all socket events and timers of that
+        iteration have been handled, e.g. to flush updates that were coalesced while handling them.
+        """
+        self._iteration_callbacks.append(callback)
+
+    def remove_iteration_callback(self, callback: Callable[[], None]) -> None:
+        self._iteration_callbacks.remove(callback)
+
+    def _scheduling_time_ns(self) -> int:
+        if self._loop_thread_id is None:
+            return self.clock.update()  # Set-up code before the loop starts; the cached reading may be stale
+        return self.clock.monotonic_ns
+
+    def _run_in_loop_thread(self, callback: Callable[[], None]) -> None:
+        if self._loop_thread_id is None or self._loop_thread_id == threading.get_ident():
+            callback()
+        else:
+            self.call_soon_threadsafe(callback)
 
     def listen(self, ip_address: IpAddress, handler_factory: ConnectionHandlerFactory | _LambdaConnectionHandlerFactory) -> _TcpServerContextManager:
         """
@@ -101,14 +176,21 @@ class TcpConnectionManager:
 
     def wait_for_events(self, timeout_in_seconds: float | None = NO_TIMEOUT) -> int:
         """
-        Check for events on the server socket and client sockets.
+        Check for events on the server socket and client sockets, then run the timers that are due and
+        finally the iteration callbacks.
         Call this method in a loop to keep the server running.
         @param timeout_in_seconds: The time in seconds to wait for events before returning. Zero means non-blocking.
+                                   The wait is cut short when a timer is due earlier.
         @return: The number of events that occurred.
         """
-        logger.debug(f"Checking for socket events with timeout {timeout_in_seconds}")
+        self._loop_thread_id = threading.get_ident()
+        next_timer_ns = self.timers.next_timeout_ns(self.clock.monotonic_ns)
+        if next_timer_ns is not None and (timeout_in_seconds is None or next_timer_ns < timeout_in_seconds * 1e9):
+            timeout_in_seconds = next_timer_ns / 1e9
+        logger.debug("Checking for socket events with timeout %s", timeout_in_seconds)
         events = self.socket_selector.select(timeout=timeout_in_seconds)
-        logger.debug(f"Received {len(events)} events")
+        now_ns = self.clock.update()
+        logger.debug("Received %d events", len(events))
         for key, mask in events:
             assert isinstance(key.data, _ConnectionData)
             connection_data = key.data
@@ -116,13 +198,35 @@ class TcpConnectionManager:
                 assert isinstance(key.fileobj, socket.socket)
                 assert connection_data.handler_factory is not None
                 self._accept_client(key.fileobj, connection_data.handler_factory)
-            elif mask & selectors.EVENT_READ:
-                self._read_from_socket(key)
+            elif connection_data.connection_type == _ConnectionType.WAKEUP:
+                self._run_pending_callbacks()
             else:
-                raise ValueError(f"Unexpected event mask {mask}")
-        logger.debug(f"Done checking for socket events")
+                if mask & selectors.EVENT_READ:
+                    self._read_from_socket(key)
+                if mask & selectors.EVENT_WRITE and key.fileobj.fileno() != -1:  # type: ignore
+                    self._write_to_socket(key)
+        self.timers.advance(now_ns)
+        for callback in self._iteration_callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Error while running end of iteration callback")
+        logger.debug("Done checking for socket events")
         return len(events)
 
+    def _run_pending_callbacks(self) -> None:
+        try:
+            while self._wakeup_receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while not self._pending_callbacks.empty():
+            callback = self._pending_callbacks.get_nowait()
+            try:
+                callback()
+            except Exception:
+                logger.exception("Error while running callback scheduled from another thread")
+
     def _accept_client(self, socket_fd: socket.socket, handler_factory: ConnectionHandlerFactory) -> None:
         client_socket, address_info = socket_fd.accept()
         logger.info(f"Accepted connection from {address_info}")
@@ -136,11 +240,16 @@ class TcpConnectionManager:
         logger.debug(f"Setting up client connection with {ip_address}")
         client_socket_fd.setblocking(False)
         
-        close_callback = lambda: self._close_socket(client_socket_fd, ip_address)
+        close_callback = lambda: self._run_in_loop_thread(lambda: self._close_socket(client_socket_fd, ip_address))
         client_connection = handler_factory.on_new_connection(client_socket_fd, ip_address, close_callback)
+        client_connection.clock = self.clock
         
-        connection_data = _ConnectionData(_ConnectionType.CLIENT, handler_factory, handler=client_connection)
+        connection_data = _ConnectionData(_ConnectionType.CLIENT, handler_factory, handler=client_connection,
+                                          reader=message_codec.MessageReader())
         self.socket_selector.register(client_socket_fd, selectors.EVENT_READ, data=connection_data)
+        client_connection._configure_outbound_queue(
+            self.high_water_mark_bytes, self.slow_consumer_policy,
+            lambda enabled: self._run_in_loop_thread(lambda: self._set_write_interest(client_socket_fd, enabled)))
         
         logger.debug(f"Done setting up client connection with {ip_address}")
         return client_connection
@@ -150,27 +259,57 @@ class TcpConnectionManager:
         connection_data: _ConnectionData = key.data
         assert connection_data.connection_type == _ConnectionType.CLIENT
         assert connection_data.handler is not None
+        assert connection_data.reader is not None
         client_connection = connection_data.handler
         ip_address = client_connection.ip_address
-        logger.debug(f"Reading from socket of {ip_address}")
+        logger.debug("Reading from socket of %s", ip_address)
         
         try:
-            message_type, message = message_codec.read_message(socket_fd)
-            logger.debug(f"Received message type {message_type} with length {len(message)}")
-        except (BrokenPipeError, ConnectionResetError) as e:
+            received_bytes = connection_data.reader.receive(socket_fd)
+            logger.debug("Received %d bytes", received_bytes)
+        except (BrokenPipeError, ConnectionResetError, message_codec.FrameError) as e:
             logger.warning(f"Error while reading from {ip_address}: {str(e)}. Client will be disconnected")
             self._close_socket(socket_fd, ip_address)
             return
 
         try:
-            client_connection.handle_message(message_type, message)
-        except Exception as e:
-            logger.exception(f"Error while handling message from {ip_address}. Client will be disconnected")
+            for message_type, message in connection_data.reader.messages():
+                logger.debug("Received message type %d with length %d", message_type, len(message),
+                             extra={MESSAGE_TYPE_ATTRIBUTE: message_type})
+                try:
+                    client_connection.handle_message(message_type, message)
+                except Exception as e:
+                    logger.exception(f"Error while handling message from {ip_address}. Client will be disconnected")
+                    self._close_socket(socket_fd, ip_address)
+                    return
+                if socket_fd.fileno() == -1:
+                    logger.debug("Connection to %s closed while handling messages", ip_address)
+                    return
+        except message_codec.FrameError as e:
+            logger.warning(f"Invalid frame from {ip_address}: {str(e)}. Client will be disconnected")
             self._close_socket(socket_fd, ip_address)
             return
-        logger.debug(f"Done handling message")
+        logger.debug("Done handling messages")
+
+    def _write_to_socket(self, key: selectors.SelectorKey) -> None:
+        connection_data: _ConnectionData = key.data
+        assert connection_data.handler is not None
+        logger.debug("Flushing outbound queue to %s", connection_data.handler.ip_address)
+        connection_data.handler.flush_outbound_queue()
+
+    def _set_write_interest(self, socket_fd: socket.socket, enabled: bool) -> None:
+        """Watches the socket for writability only while its connection has queued output."""
+        if socket_fd.fileno() == -1:
+            return
+        key = self.socket_selector.get_key(socket_fd)
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if enabled else selectors.EVENT_READ
+        if key.events != events:
+            self.socket_selector.modify(socket_fd, events, data=key.data)
 
     def _close_socket(self, socket_fd: socket.socket, ip_address: IpAddress) -> None:
+        if socket_fd.fileno() == -1:
+            logger.debug(f"Socket on {ip_address} already closed")
+            return
         logger.debug(f"Closing socket on {ip_address}...")
         connection_data: _ConnectionData = self.socket_selector.get_key(socket_fd).data
         self.socket_selector.unregister(socket_fd)
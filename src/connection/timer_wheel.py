@@ -0,0 +1,240 @@
+import logging
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TICK_NS = 1_000_000  # 1 ms
+_LEVEL_0_BITS = 8  # 256 ticks
+_LEVEL_N_BITS = 6  # 64 slots on each coarser level
+_NUM_LEVELS = 4  # 2**26 ticks, about 18.6 hours with 1 ms ticks; later deadlines wait in the overflow list
+
+
+class SystemClock:
+    """Reads the system clocks on every access. Used when no event loop owns the clock."""
+
+    @property
+    def monotonic_ns(self) -> int:
+        return time.monotonic_ns()
+
+    @property
+    def wall_ns(self) -> int:
+        return time.time_ns()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def time(self) -> float:
+        return time.time()
+
+
+class LoopClock:
+    """
+    Monotonic and wall clock readings captured once per event loop iteration, so that every handler and timer
+    run in that iteration sees the same time without making its own clock calls. Same interface as SystemClock.
+    """
+    __slots__ = ("monotonic_ns", "wall_ns")
+
+    def __init__(self) -> None:
+        self.monotonic_ns = time.monotonic_ns()
+        self.wall_ns = time.time_ns()
+
+    def update(self) -> int:
+        """
+        Captures new readings. Called by the event loop once per iteration.
+        @return: The new monotonic reading in nanoseconds.
+        """
+        self.wall_ns = time.time_ns()
+        self.monotonic_ns = monotonic_ns = time.monotonic_ns()
+        return monotonic_ns
+
+    def monotonic(self) -> float:
+        return self.monotonic_ns / 1e9
+
+    def time(self) -> float:
+        return self.wall_ns / 1e9
+
+
+SYSTEM_CLOCK = SystemClock()
+
+Clock = SystemClock | LoopClock
+
+
+class Timer:
+    """Handle to a scheduled callback. Cancelling is O(1); the wheel drops cancelled timers when it reaches them."""
+    __slots__ = ("deadline_ns", "callback", "interval_ns", "cancelled", "_wheel")
+
+    def __init__(self, wheel: "TimerWheel", deadline_ns: int, callback: Callable[[], None], interval_ns: int | None) -> None:
+        self.deadline_ns = deadline_ns
+        self.callback = callback
+        self.interval_ns = interval_ns
+        self.cancelled = False
+        self._wheel = wheel
+
+    def cancel(self) -> None:
+        if not self.cancelled:
+            self.cancelled = True
+            self._wheel._active_timers -= 1
+
+
+class TimerWheel:
+    """
+    Hierarchical timing wheel. The finest level has 256 slots of one tick each, every coarser level has 64 slots
+    each spanning a whole turn of the level below, and timers further out than the coarsest level wait in an
+    overflow list. Scheduling and cancelling are O(1); when a finer level wraps around, the matching slot of the
+    next level is cascaded down. Timers never fire early: a deadline is rounded up to the next tick.
+    """
+
+    def __init__(self, now_ns: int, tick_ns: int = DEFAULT_TICK_NS) -> None:
+        """
+        @param now_ns: Current monotonic time, the wheel's starting point.
+        @param tick_ns: Resolution of the wheel.
+        """
+        if tick_ns <= 0:
+            raise ValueError(f"Timer wheel tick must be positive, got {tick_ns}")
+        self.tick_ns = tick_ns
+        self._current_tick = now_ns // tick_ns
+        self._levels: list[list[list[Timer]]] = [[[] for _ in range(1 << _LEVEL_0_BITS)]] + [
+            [[] for _ in range(1 << _LEVEL_N_BITS)] for _ in range(_NUM_LEVELS - 1)]
+        self._overflow: list[Timer] = []
+        self._due: list[Timer] = []  # Scheduled at or before the current tick, fired on the next advance
+        self._active_timers = 0
+        self._wake_tick: int | None = None  # Cached result of next_timeout_ns: no timer is due before this tick
+
+    def __len__(self) -> int:
+        """Number of scheduled timers that have not fired or been cancelled."""
+        return self._active_timers
+
+    def schedule(self, deadline_ns: int, callback: Callable[[], None], interval_ns: int | None = None) -> Timer:
+        """
+        @param deadline_ns: Monotonic time at which to run the callback.
+        @param interval_ns: If set, the callback runs again every interval until the timer is cancelled.
+        """
+        if interval_ns is not None and interval_ns <= 0:
+            raise ValueError(f"Timer interval must be positive, got {interval_ns}")
+        timer = Timer(self, deadline_ns, callback, interval_ns)
+        self._active_timers += 1
+        self._insert(timer)
+        return timer
+
+    def _insert(self, timer: Timer) -> None:
+        expiry_tick = -(-timer.deadline_ns // self.tick_ns)
+        delta = expiry_tick - self._current_tick
+        if delta <= 0:
+            self._due.append(timer)
+            return
+        if self._wake_tick is not None and expiry_tick < self._wake_tick:
+            self._wake_tick = expiry_tick
+        shift = _LEVEL_0_BITS
+        if delta < 1 << shift:
+            self._levels[0][expiry_tick & ((1 << _LEVEL_0_BITS) - 1)].append(timer)
+            return
+        for level in range(1, _NUM_LEVELS):
+            if delta < 1 << (shift + _LEVEL_N_BITS):
+                self._levels[level][(expiry_tick >> shift) & ((1 << _LEVEL_N_BITS) - 1)].append(timer)
+                return
+            shift += _LEVEL_N_BITS
+        self._overflow.append(timer)
+
+    def advance(self, now_ns: int) -> int:
+        """
+        Runs the callbacks of all timers whose deadline is at or before now_ns.
+        @return: The number of callbacks run.
+        """
+        target_tick = now_ns // self.tick_ns
+        fired = self._fire(self._due, now_ns) if self._due else 0
+        if self._active_timers == 0:
+            if target_tick > self._current_tick:
+                self._clear()  # Only cancelled timers left, so the wheel can jump straight to now
+                self._current_tick = target_tick
+                self._wake_tick = None
+            return fired
+        level_0_mask = (1 << _LEVEL_0_BITS) - 1
+        level_0 = self._levels[0]
+        while self._current_tick < target_tick:
+            self._current_tick = tick = self._current_tick + 1
+            slot = tick & level_0_mask
+            if slot == 0:
+                self._cascade(tick)
+                if self._due:  # Timers cascaded down on their exact expiry tick
+                    fired += self._fire(self._due, now_ns)
+            if level_0[slot]:
+                fired += self._fire(level_0[slot], now_ns)
+        if self._wake_tick is not None and self._wake_tick <= self._current_tick:
+            self._wake_tick = None
+        return fired
+
+    def _cascade(self, tick: int) -> None:
+        # Level 1 wraps whenever level 0 does; each further level also wraps if the one below it is at slot 0.
+        # Re-insert from the coarsest wrapped level down so timers settle in finer slots before those are cascaded.
+        level_mask = (1 << _LEVEL_N_BITS) - 1
+        shift = _LEVEL_0_BITS
+        wrapped_levels = 1
+        while wrapped_levels < _NUM_LEVELS - 1 and (tick >> shift) & level_mask == 0:
+            wrapped_levels += 1
+            shift += _LEVEL_N_BITS
+        if wrapped_levels == _NUM_LEVELS - 1 and (tick >> shift) & level_mask == 0:
+            overflow, self._overflow = self._overflow, []
+            self._reinsert(overflow)
+        for level in range(wrapped_levels, 0, -1):
+            slot_index = (tick >> (_LEVEL_0_BITS + (level - 1) * _LEVEL_N_BITS)) & level_mask
+            timers = self._levels[level][slot_index]
+            self._levels[level][slot_index] = []
+            self._reinsert(timers)
+
+    def _reinsert(self, timers: list[Timer]) -> None:
+        for timer in timers:
+            if not timer.cancelled:
+                self._insert(timer)
+
+    def _fire(self, timers: list[Timer], now_ns: int) -> int:
+        expired = timers.copy()
+        timers.clear()
+        fired = 0
+        for timer in expired:
+            if timer.cancelled:
+                continue
+            if timer.interval_ns is None:
+                timer.cancelled = True
+                self._active_timers -= 1
+            else:
+                timer.deadline_ns += timer.interval_ns
+                if timer.deadline_ns <= now_ns:  # Fell behind, skip the missed runs
+                    timer.deadline_ns = now_ns + timer.interval_ns
+                self._insert(timer)
+            fired += 1
+            try:
+                timer.callback()
+            except Exception:
+                logger.exception("Error while running timer callback")
+        return fired
+
+    def _clear(self) -> None:
+        for level in self._levels:
+            for slot in level:
+                slot.clear()
+        self._overflow.clear()
+
+    def next_timeout_ns(self, now_ns: int) -> int | None:
+        """
+        Upper bound on the time until the next timer is due, suitable as a select timeout.
+        Exact for timers in the finest level; otherwise the time until that level next cascades.
+        @return: None if no timers are scheduled, 0 if some are already due.
+        """
+        if self._active_timers == 0:
+            return None
+        if self._due:
+            return 0
+        if self._wake_tick is None:
+            self._wake_tick = self._find_wake_tick()
+        return max(0, self._wake_tick * self.tick_ns - now_ns)
+
+    def _find_wake_tick(self) -> int:
+        level_0 = self._levels[0]
+        level_0_mask = (1 << _LEVEL_0_BITS) - 1
+        current_tick = self._current_tick
+        next_cascade_tick = ((current_tick >> _LEVEL_0_BITS) + 1) << _LEVEL_0_BITS
+        for tick in range(current_tick + 1, next_cascade_tick):
+            if any(not timer.cancelled for timer in level_0[tick & level_0_mask]):
+                return tick
+        return next_cascade_tick
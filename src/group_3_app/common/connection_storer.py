@@ -1,11 +1,39 @@
+import logging
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Hashable, Iterable, Optional, TypeVar
+from connection.message_codec import MESSAGE_TYPE_ATTRIBUTE
+from connection import message_codec
+from connection.fan_out import FanOutWriterPool
 from group_3_app.connection_handler import ConnectionHandler
 from google.protobuf.message import Message
-from typing import TypeVar
 ProtoMessage = TypeVar('ProtoMessage', bound=Message)
+logger = logging.getLogger(__name__)
+
+@dataclass
+class BroadcastCounter:
+    """Recipients and bytes of the most recent broadcast, plus running totals."""
+    broadcasts: int = 0
+    recipients: int = 0
+    bytes_sent: int = 0
+    last_message_type: int = -1
+    last_recipients: int = 0
+    last_frame_bytes: int = 0
+
+    def record(self, message_type: int, recipients: int, frame_bytes: int):
+        self.broadcasts += 1
+        self.recipients += recipients
+        self.bytes_sent += recipients * frame_bytes
+        self.last_message_type = message_type
+        self.last_recipients = recipients
+        self.last_frame_bytes = frame_bytes
 
 class ConnectionStorer(ABC):
 
+    def __init__(self):
+        self.broadcast_counter = BroadcastCounter()
+        self.writer_pool: Optional[FanOutWriterPool] = None
+
     @abstractmethod
     def add_connection_handler(self, connection_handler: ConnectionHandler):
         return
@@ -17,3 +45,35 @@ class ConnectionStorer(ABC):
     @abstractmethod
     def broadcast_message(self, message_type: int, message: ProtoMessage):
         return
+
+    def _broadcast_encoded(self, connection_handlers: Iterable[ConnectionHandler], message_type: int, message: ProtoMessage, conflation_key: Optional[Hashable]=None) -> bytes:
+        """
+        Serializes and encodes the message once, then sends the same frame to every handler.
+        With a writer pool the sends happen on its writer threads and this returns as soon as the frame is queued.
+        """
+        encoded_message = message_codec.encode_message(message_type, message.SerializeToString())
+        recipients = tuple(connection_handlers)
+        if self.writer_pool is not None:
+            self.writer_pool.publish(encoded_message, recipients, conflation_key)
+        else:
+            for connection_handler in recipients:
+                connection_handler.send_encoded_message(encoded_message, conflation_key)
+        self.broadcast_counter.record(message_type, len(recipients), len(encoded_message))
+        logger.debug('Broadcast message type %d: %d bytes to %d recipients', message_type, len(encoded_message), len(recipients), extra={MESSAGE_TYPE_ATTRIBUTE: message_type})
+        return encoded_message
+
+    def _broadcast_compactable(self, connection_handlers: Iterable[ConnectionHandler], compact_connection_handlers: Iterable[ConnectionHandler], message_type: int, message: ProtoMessage, conflation_key: Optional[Hashable]=None):
+        """
+        Broadcasts a message naming its instrument by both symbol and order book id: as is to connection_handlers, and
+        without the symbol to the compact_connection_handlers that negotiated compact instrument ids. Each variant is
+        encoded once, and only if it has recipients. The message is left as it was given.
+        """
+        if connection_handlers:
+            self._broadcast_encoded(connection_handlers, message_type, message, conflation_key)
+        if compact_connection_handlers:
+            instrument_symbol = message.instrument_symbol
+            message.ClearField('instrument_symbol')
+            try:
+                self._broadcast_encoded(compact_connection_handlers, message_type, message, conflation_key)
+            finally:
+                message.instrument_symbol = instrument_symbol
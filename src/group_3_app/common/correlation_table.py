@@ -0,0 +1,106 @@
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Generic, Hashable, List, Optional, Tuple, TypeVar
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+logger = logging.getLogger(__name__)
+DEFAULT_REQUEST_TIMEOUT_SECONDS = 5.0
+# How often the services that own tables run expire() from their event loop, which bounds how late a timeout is
+EXPIRY_INTERVAL_SECONDS = 0.1
+
+@dataclass(frozen=True)
+class CorrelationTableMetrics:
+    name: str
+    occupancy: int
+    peak_occupancy: int
+    inserted: int
+    completed: int
+    expired: int
+
+class CorrelationTable(Generic[K, V]):
+    """
+    Pending requests keyed by correlation id, removed explicitly with complete() when the answer arrives.
+    Entries are kept in insertion order, which with a single timeout is also deadline order, so expiry only
+    looks at the oldest entries. Expired entries are handed to on_timeout, e.g. to answer the original client.
+    Expiry runs on every insert, and must also be driven by a timer through expire() so that the last requests before
+    a quiet spell time out too; the owning services register it with their event loop in schedule_expiry().
+    With timeout_seconds None entries never expire and live until completed.
+    """
+
+    def __init__(self, name: str, timeout_seconds: Optional[float]=DEFAULT_REQUEST_TIMEOUT_SECONDS, on_timeout: Optional[Callable[[K, V], None]]=None, clock: Callable[[], float]=time.monotonic):
+        if timeout_seconds is not None and timeout_seconds <= 0:
+            raise ValueError(f'Correlation table {name} timeout must be positive, got {timeout_seconds}')
+        self.name = name
+        self.timeout_seconds = timeout_seconds
+        self.on_timeout = on_timeout
+        self.clock = clock
+        self.__entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self.__peak_occupancy = 0
+        self.__inserted = 0
+        self.__completed = 0
+        self.__expired = 0
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self.__entries
+
+    def insert(self, key: K, value: V):
+        if key in self.__entries:
+            raise KeyError(f'Correlation id {key} is already pending in {self.name}')
+        now = self.clock()
+        if self.timeout_seconds is not None:
+            self.expire(now)
+            deadline = now + self.timeout_seconds
+        else:
+            deadline = float('inf')
+        self.__entries[key] = (deadline, value)
+        self.__inserted += 1
+        if len(self.__entries) > self.__peak_occupancy:
+            self.__peak_occupancy = len(self.__entries)
+
+    def items(self) -> List[Tuple[K, V]]:
+        """Pending entries oldest first, copied so that they can be completed while going through them"""
+        return [(key, entry[1]) for key, entry in self.__entries.items()]
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self.__entries.get(key)
+        return None if entry is None else entry[1]
+
+    def complete(self, key: K) -> Optional[V]:
+        """Removes and returns the pending value, or None if it is unknown, e.g. because it already timed out"""
+        entry = self.__entries.pop(key, None)
+        if entry is None:
+            return None
+        self.__completed += 1
+        return entry[1]
+
+    def expire(self, now: Optional[float]=None) -> int:
+        """Removes every entry whose deadline has passed, oldest first, and returns how many were removed"""
+        if self.timeout_seconds is None:
+            return 0
+        if now is None:
+            now = self.clock()
+        entries = self.__entries
+        expired = 0
+        while entries:
+            key, (deadline, value) = next(iter(entries.items()))
+            if deadline > now:
+                break
+            del entries[key]
+            expired += 1
+            if self.on_timeout is not None:
+                try:
+                    self.on_timeout(key, value)
+                except Exception:
+                    logger.exception(f'Timeout callback of {self.name} failed for correlation id {key}')
+        if expired:
+            self.__expired += expired
+            logger.warning('%d request(s) timed out in %s', expired, self.name)
+        return expired
+
+    def metrics(self) -> CorrelationTableMetrics:
+        return CorrelationTableMetrics(self.name, len(self.__entries), self.__peak_occupancy, self.__inserted, self.__completed, self.__expired)
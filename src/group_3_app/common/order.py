@@ -1,14 +1,27 @@
-from typing import List, Optional
+from typing import List, Optional, Sequence
 from generated.proto.common_pb2 import Side
+_NO_TRADE_IDS = ()
 
 class Order:
+    """Slotted to keep resting orders small; the trade id list is only created once the order trades"""
+    __slots__ = ('order_id', 'order_book_id', 'timestamp', 'side', 'price_ticks', 'quantity', 'on_behalf_of_username', '_trade_ids')
 
-    def __init__(self, order_id: int, order_book_id: int, timestamp: int, side: Side, price: float, quantity: int, on_behalf_of_username: str=None):
+    def __init__(self, order_id: int, order_book_id: int, timestamp: int, side: Side, price_ticks: int, quantity: int, on_behalf_of_username: str=None):
         self.order_id = order_id
         self.order_book_id = order_book_id
         self.timestamp = timestamp
         self.side = side
-        self.price = price
+        self.price_ticks = price_ticks
         self.quantity = quantity
-        self.trade_ids = []
+        self._trade_ids: Optional[List[int]] = None
         self.on_behalf_of_username = on_behalf_of_username
+
+    @property
+    def trade_ids(self) -> Sequence[int]:
+        return _NO_TRADE_IDS if self._trade_ids is None else self._trade_ids
+
+    def add_trade_id(self, trade_id: int):
+        if self._trade_ids is None:
+            self._trade_ids = [trade_id]
+        else:
+            self._trade_ids.append(trade_id)
@@ -1,33 +1,206 @@
-from typing import List, Dict
+import heapq
+import itertools
+from collections import deque
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, Set
 from group_3_app.common.order import Order
 from group_3_app.common.trade import Trade
 from generated.proto.common_pb2 import Side
 
+class BookLevel(NamedTuple):
+    price_ticks: int
+    quantity: int
+
+class _PriceLevel:
+    """FIFO queue of the orders resting at one price. Cancelled or filled orders are removed lazily from the queue."""
+    __slots__ = ('orders', 'quantity', 'live_orders')
+
+    def __init__(self):
+        self.orders: Deque[Order] = deque()
+        self.quantity = 0
+        self.live_orders = 0
+
 class OrderBook:
+    """
+    Price-time priority limit order book working on integer price ticks; see common.price for the conversions.
+    Each side maps a price tick to a FIFO price level, and a heap of ticks tracks the best price (stale
+    ticks of emptied levels are skipped when they reach the top, and the heap is rebuilt from the levels once stale
+    ticks behind the top outnumber live ones). The order id index makes cancels O(1):
+    a cancelled order stays in its level's queue until matching reaches it or the level is compacted.
+    """
 
-    def __init__(self, order_book_id: int, tick_size: float):
+    def __init__(self, order_book_id: int, tick_size: float, trade_id_generator: Optional[Callable[[], int]]=None, track_dirty_levels: bool=False):
+        """track_dirty_levels records which price levels changed, for publishers of incremental depth (see take_dirty_levels)"""
         self.id = order_book_id
         self.tick_size = tick_size
-        self.bids = []
-        self.asks = []
-        self.orders = {}
+        self.trade_id_generator = trade_id_generator or itertools.count(1).__next__
+        self.orders: Dict[int, Order] = {}
+        self.__levels = {Side.BUY: {}, Side.SELL: {}}
+        self.__bid_heap: List[int] = []
+        self.__ask_heap: List[int] = []
+        self.__dirty_ticks: Optional[Dict[Side, Set[int]]] = {Side.BUY: set(), Side.SELL: set()} if track_dirty_levels else None
 
     def insert_order(self, order: Order) -> List[Trade]:
-        print(f'Inserting order: {order}')
-        raise ValueError(f'Order price {order.price} does not conform to tick size {self.tick_size}') if round(order.price / self.tick_size) * self.tick_size != order.price else typing
+        """
+        Matches the order against the opposite side, then rests whatever quantity is left.
+        order.quantity is updated to the remaining quantity.
+        """
+        if order.side not in self.__levels:
+            raise ValueError(f'Unknown order side: {order.side}')
+        if order.quantity <= 0:
+            raise ValueError(f'Order quantity must be positive, got {order.quantity}')
+        if order.order_id in self.orders:
+            raise ValueError(f'Order {order.order_id} is already in order book {self.id}')
+        trades = self._match_order(order, order.price_ticks)
+        if order.quantity > 0:
+            self.__rest_order(order, order.price_ticks)
+        return trades
 
-    def _match_order(self, order: Order) -> List[Trade]:
+    def _match_order(self, order: Order, tick: int) -> List[Trade]:
         trades = []
         remaining_quantity = order.quantity
-        book = self.asks if order.side == Side.BUY else self.bids
-        sorted_book = sorted(book, key=lambda o: (o.price, o.timestamp) if order.side == Side.BUY else (-o.price, o.timestamp))
-        for counter_order in sorted_book:
-            if remaining_quantity == 0:
+        if order.side == Side.BUY:
+            opposite_side, opposite_heap, limit_key = (Side.SELL, self.__ask_heap, tick)
+        else:
+            opposite_side, opposite_heap, limit_key = (Side.BUY, self.__bid_heap, -tick)
+        opposite_levels = self.__levels[opposite_side]
+        orders = self.orders
+        while remaining_quantity > 0:
+            best = self.__peek_best(opposite_heap, opposite_levels, opposite_side)
+            if best is None or best > limit_key:
                 break
+            level_tick = best if opposite_side == Side.SELL else -best
+            level = opposite_levels[level_tick]
+            queue = level.orders
+            while remaining_quantity > 0 and queue:
+                resting_order = queue[0]
+                if orders.get(resting_order.order_id) is not resting_order:
+                    queue.popleft()
+                    continue
+                traded_quantity = min(remaining_quantity, resting_order.quantity)
+                trades.append(self.__trade(order, resting_order, level_tick, traded_quantity))
+                remaining_quantity -= traded_quantity
+                resting_order.quantity -= traded_quantity
+                level.quantity -= traded_quantity
+                if resting_order.quantity == 0:
+                    queue.popleft()
+                    del orders[resting_order.order_id]
+                    level.live_orders -= 1
+            if level.live_orders == 0:
+                del opposite_levels[level_tick]
+            if self.__dirty_ticks is not None:
+                self.__dirty_ticks[opposite_side].add(level_tick)
         order.quantity = remaining_quantity
         return trades
 
-    def cancel_order(self, order: Order) -> bool:
-        if order.order_id not in self.orders:
-            pass
-        return False
+    def __trade(self, order: Order, resting_order: Order, tick: int, quantity: int) -> Trade:
+        trade_id = self.trade_id_generator()
+        order.add_trade_id(trade_id)
+        resting_order.add_trade_id(trade_id)
+        if order.side == Side.BUY:
+            buy_order_id, sell_order_id = (order.order_id, resting_order.order_id)
+        else:
+            buy_order_id, sell_order_id = (resting_order.order_id, order.order_id)
+        return Trade(trade_id, self.id, order.timestamp, buy_order_id, sell_order_id, tick, quantity, order.side)
+
+    def __rest_order(self, order: Order, tick: int):
+        levels = self.__levels[order.side]
+        level = levels.get(tick)
+        if level is None:
+            level = levels[tick] = _PriceLevel()
+            if order.side == Side.BUY:
+                heap, key = (self.__bid_heap, -tick)
+            else:
+                heap, key = (self.__ask_heap, tick)
+            heapq.heappush(heap, key)
+            if len(heap) > 2 * len(levels) + 16:
+                heap[:] = levels if order.side == Side.SELL else [-level_tick for level_tick in levels]
+                heapq.heapify(heap)
+        level.orders.append(order)
+        level.quantity += order.quantity
+        if self.__dirty_ticks is not None:
+            self.__dirty_ticks[order.side].add(tick)
+        level.live_orders += 1
+        self.orders[order.order_id] = order
+
+    def cancel_order(self, order_id: int) -> Optional[Order]:
+        """Removes a resting order. Returns it with its remaining quantity, or None if it is not in the book."""
+        order = self.orders.get(order_id)
+        if order is None:
+            return None
+        self.__remove_quantity(order, order.quantity)
+        return order
+
+    def reduce_order(self, order_id: int, quantity: int) -> Optional[Order]:
+        """
+        Takes quantity off a resting order without matching, e.g. to mirror a trade reported by the order book service.
+        The order leaves the book once nothing is left. Returns None if the order is not in the book.
+        """
+        order = self.orders.get(order_id)
+        if order is None:
+            return None
+        quantity = min(quantity, order.quantity)
+        self.__remove_quantity(order, quantity)
+        order.quantity -= quantity
+        return order
+
+    def __remove_quantity(self, order: Order, quantity: int):
+        tick = order.price_ticks
+        levels = self.__levels[order.side]
+        level = levels[tick]
+        level.quantity -= quantity
+        if self.__dirty_ticks is not None:
+            self.__dirty_ticks[order.side].add(tick)
+        if quantity < order.quantity:
+            return
+        del self.orders[order.order_id]
+        level.live_orders -= 1
+        if level.live_orders == 0:
+            del levels[tick]
+        elif len(level.orders) > 2 * level.live_orders + 16:
+            orders = self.orders
+            level.orders = deque((queued for queued in level.orders if orders.get(queued.order_id) is queued))
+
+    def __peek_best(self, heap: List[int], levels: Dict[int, _PriceLevel], side: Side) -> Optional[int]:
+        while heap:
+            key = heap[0]
+            if (key if side == Side.SELL else -key) in levels:
+                return key
+            heapq.heappop(heap)
+        return None
+
+    def get_best_bid(self) -> Optional[BookLevel]:
+        best = self.__peek_best(self.__bid_heap, self.__levels[Side.BUY], Side.BUY)
+        if best is None:
+            return None
+        return BookLevel(-best, self.__levels[Side.BUY][-best].quantity)
+
+    def get_best_ask(self) -> Optional[BookLevel]:
+        best = self.__peek_best(self.__ask_heap, self.__levels[Side.SELL], Side.SELL)
+        if best is None:
+            return None
+        return BookLevel(best, self.__levels[Side.SELL][best].quantity)
+
+    def get_price_levels(self, side: Side, limit: Optional[int]=None) -> List[BookLevel]:
+        """Aggregated levels of one side, best price first; at most limit levels if given"""
+        levels = self.__levels[side]
+        if side == Side.BUY:
+            ticks = sorted(levels, reverse=True) if limit is None else heapq.nlargest(limit, levels)
+        else:
+            ticks = sorted(levels) if limit is None else heapq.nsmallest(limit, levels)
+        return [BookLevel(tick, levels[tick].quantity) for tick in ticks]
+
+    def take_dirty_levels(self, side: Side) -> List[BookLevel]:
+        """
+        Returns the current aggregated quantity of every level of one side that changed since the last call,
+        with quantity 0 for levels that are now empty, and starts tracking afresh.
+        """
+        dirty_ticks = self.__dirty_ticks[side]
+        if not dirty_ticks:
+            return []
+        levels = self.__levels[side]
+        changed = [BookLevel(tick, levels[tick].quantity if tick in levels else 0) for tick in dirty_ticks]
+        dirty_ticks.clear()
+        return changed
+
+    def get_order(self, order_id: int) -> Optional[Order]:
+        return self.orders.get(order_id)
@@ -0,0 +1,17 @@
+PRICE_TOLERANCE = 1e-09
+PRICE_DECIMALS = 10
+
+def to_ticks(price: float, tick_size: float) -> int:
+    """
+    Converts a price to a whole number of ticks. Prices are converted once where they enter a service;
+    matching, level keys and risk amounts then work on these integers.
+    Raises ValueError if the price is not a multiple of the tick size, allowing for binary floating point error.
+    """
+    ticks = round(price / tick_size)
+    if abs(ticks * tick_size - price) > PRICE_TOLERANCE * max(1.0, abs(price)):
+        raise ValueError(f'Order price {price} does not conform to tick size {tick_size}')
+    return ticks
+
+def to_price(ticks: int, tick_size: float) -> float:
+    """Converts ticks back to a price for outbound messages, e.g. 3 ticks of 0.1 to 0.3 rather than 0.30000000000000004"""
+    return round(ticks * tick_size, PRICE_DECIMALS)
@@ -0,0 +1,4 @@
+# Protocol names used as the service part of MessageDispatcher routes
+INFO_SERVICE = 'info'
+ORDER_BOOK_SERVICE = 'order_book'
+RISK_LIMITS_SERVICE = 'risk_limits'
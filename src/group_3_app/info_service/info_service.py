@@ -1,98 +1,402 @@
-from typing import List
+from dataclasses import dataclass
+from enum import Enum
+from functools import partial
+from typing import Dict, List, Optional, Tuple
 from group_3_app.common.order import Order
-from group_3_app.common.order_book import OrderBook
-from generated.proto.common_pb2 import Instrument, LoginRequest, LoginResponse
-from generated.proto.info_pb2 import CreateInstrumentRequest, CreateInstrumentResponse, OrderBookSubscribeRequest, OrderBookSubscribeResponse, SubscriptionType, OnPriceDepthBook, OnTopOfBook, OnInstrument, PriceLevel, MessageType
-from generated.proto.order_book_pb2 import CreateOrderBookResponse, CreateOrderBookRequest, OnOrderInserted, OnOrderCancelled, CreateOrderBookRequest, MessageType as OrderBookServiceMessageType
+from group_3_app.common.order_book import BookLevel, OrderBook
+from group_3_app.common.price import to_price, to_ticks
+from generated.proto.common_pb2 import Instrument, LoginRequest, LoginResponse, Side
+from generated.proto.info_pb2 import BarsRequest, BarsResponse, CreateInstrumentRequest, CreateInstrumentResponse, OrderBookSubscribeRequest, OrderBookSubscribeResponse, OrderBookUnsubscribeRequest, OrderBookUnsubscribeResponse, SubscriptionType, OnPriceDepthBook, OnTopOfBook, OnInstrument, OnPriceLevelsChanged, PriceLevel, MessageType
+from generated.proto.order_book_pb2 import CreateOrderBookResponse, CreateOrderBookRequest, OnOrderBookCreated, OnOrderBookSnapshot, OnOrderInserted, OnOrderCancelled, OnOrdersInserted, OnOrdersCancelled, CreateOrderBookRequest, MessageType as OrderBookServiceMessageType
 from generated.proto.info_pb2 import OnTrade as InfoOnTrade
 from generated.proto.order_book_pb2 import OnTrade as OBOnTrade
 from generated.proto.order_book_pb2 import MessageType as OrderBookServiceMessageType
-import time
 import logging
 import sys
-from group_3_app.info_service.subscriptions import PDSubscriptions, TOBSubscriptions
-from group_3_app.common.connection_storer import ConnectionStorer
+from group_3_app.info_service.subscriptions import SubscriptionManager
+from group_3_app.info_service.trade_tape import TradeTapes
+from group_3_app.info_service.shared_top_of_book import SharedTopOfBookWriter
+from group_3_app.common.connection_storer import ConnectionStorer, ProtoMessage
+from group_3_app.common.correlation_table import CorrelationTable, CorrelationTableMetrics, DEFAULT_REQUEST_TIMEOUT_SECONDS, EXPIRY_INTERVAL_SECONDS
+from connection.fan_out import FanOutWriterPool
+from connection.tcp_connection_manager import TcpConnectionManager
+from connection.timer_wheel import SYSTEM_CLOCK, Clock
 logger = logging.getLogger(__name__)
+DEFAULT_PRICE_DEPTH_LEVELS = 10
+DEFAULT_REPLAY_RING_SIZE = 1024
+MAX_BARS = 100000
+ORDER_BOOK_SERVICE_USERNAME = 'info_service'
+
+class PriceDepthMode(Enum):
+    SNAPSHOT = 'snapshot'  # OnPriceDepthBook with the top price_depth_levels levels, sent when one of them changed
+    INCREMENTAL = 'incremental'  # OnPriceLevelsChanged with only the levels that changed
+
+class ConflationMode(Enum):
+    IMMEDIATE = 'immediate'  # Published on every change of the order book
+    PER_ITERATION = 'perIteration'  # Latest state published once at the end of each event loop iteration
+    INTERVAL = 'interval'  # Latest state published at most once every interval_seconds
+
+@dataclass(frozen=True)
+class ConflationPolicy:
+    mode: ConflationMode = ConflationMode.IMMEDIATE
+    interval_seconds: float = 0.0
+
+    def __post_init__(self):
+        if self.mode == ConflationMode.INTERVAL and self.interval_seconds <= 0:
+            raise ValueError(f'Conflation interval must be positive, got {self.interval_seconds}')
 
 class InfoService:
 
-    def __init__(self, connection_storer: ConnectionStorer):
+    def __init__(self, connection_storer: ConnectionStorer, writer_pool: FanOutWriterPool=None, request_timeout_seconds: float=DEFAULT_REQUEST_TIMEOUT_SECONDS, clock: Clock=SYSTEM_CLOCK, price_depth_mode: PriceDepthMode=PriceDepthMode.SNAPSHOT, price_depth_levels: int=DEFAULT_PRICE_DEPTH_LEVELS, conflation: Optional[Dict[SubscriptionType, ConflationPolicy]]=None, replay_ring_size: int=DEFAULT_REPLAY_RING_SIZE, trade_tape_directory: Optional[str]=None, shared_top_of_book: Optional[SharedTopOfBookWriter]=None):
+        """
+        conflation sets per subscription type how order book changes are published, immediately by default.
+        Conflated updates are flushed by the callbacks that schedule_conflation_flushes registers with the event loop.
+        replay_ring_size is how many incremental depth updates per instrument are kept for returning subscribers.
+        trade_tape_directory is where the trade tapes that bars are computed from spill to once they are large.
+        shared_top_of_book, if given, is also written with every change of a best bid or ask, without conflation.
+        """
+        self.clock = clock
+        self.price_depth_mode = price_depth_mode
+        self.price_depth_levels = price_depth_levels
         self.orderbook_connection_handler = None
-        self.tob_subscribers = TOBSubscriptions()
-        self.pd_subscribers = PDSubscriptions()
+        self.subscriptions = SubscriptionManager({SubscriptionType.PRICE_DEPTH_BOOK: replay_ring_size} if price_depth_mode == PriceDepthMode.INCREMENTAL else None)
+        self.trade_sequence_numbers: Dict[str, int] = {}
+        self.trade_tapes = TradeTapes(trade_tape_directory)
+        self.shared_top_of_book = shared_top_of_book
         self.connection_storer = connection_storer
+        self.__use_writer_pool(writer_pool)
+        self.conflation = {SubscriptionType.TOP_OF_BOOK: ConflationPolicy(), SubscriptionType.PRICE_DEPTH_BOOK: ConflationPolicy()}
+        self.conflation.update(conflation or {})
+        self.__pending_order_book_ids: Dict[SubscriptionType, Dict[int, None]] = {subscription_type: {} for subscription_type in self.conflation}
         self.top_of_books = {}
+        # Bids and asks of the last OnPriceDepthBook of each book in snapshot mode
+        self.published_price_depths: Dict[int, Tuple[List[BookLevel], List[BookLevel]]] = {}
         self.order_books = {}
         self.order_book_ids_to_instruments = {}
+        self.instruments_to_order_book_ids = {}
         self.order_ids_to_order_book_ids = {}
+        # Sequence number of the last change applied from the order book service, None while waiting for snapshots
+        self.order_book_sequence_number: Optional[int] = None
         self.next_create_order_book_request_id = 0
-        self.create_order_book_request_id_to_create_instrument_request = {}
+        self.create_order_book_requests = CorrelationTable('info create order book requests', request_timeout_seconds, self.__on_create_order_book_request_timeout, clock.monotonic)
+
+    def __use_writer_pool(self, writer_pool: FanOutWriterPool):
+        """Subscriber fan-out (top of book, depth and trades) is published once to the writer pool instead of written inline"""
+        if writer_pool is None:
+            return
+        self.subscriptions.writer_pool = writer_pool
+        self.connection_storer.writer_pool = writer_pool
+        logger.info(f'Info service fanning out market data through {writer_pool.num_writers} writer threads')
 
-    def login_request(self, login_request: LoginRequest) -> LoginResponse:
-        message = LoginResponse(request_id=login_request.request_id, error_message='')
+    def login_to_order_book_service(self):
+        """The order book service answers with a snapshot of every book, which replaces this service's view of it"""
+        self.orderbook_connection_handler.send_message(OrderBookServiceMessageType.LOGIN_REQUEST, LoginRequest(request_id=0, username=ORDER_BOOK_SERVICE_USERNAME))
+
+    def login_request(self, login_request: LoginRequest, connection_handler) -> LoginResponse:
+        compact_instrument_ids = login_request.compact_instrument_ids
+        if connection_handler.compact_instrument_ids != compact_instrument_ids:
+            connection_handler.compact_instrument_ids = compact_instrument_ids
+            self.subscriptions.refresh_connection_handler(connection_handler)
+            self.connection_storer.refresh_connection_handler(connection_handler)
+        message = LoginResponse(request_id=login_request.request_id, error_message='', compact_instrument_ids=compact_instrument_ids)
         return message
 
     def create_instrument_request(self, create_instrument_request: CreateInstrumentRequest):
-        self.create_order_book_request_id_to_create_instrument_request[self.next_create_order_book_request_id] = create_instrument_request
+        self.create_order_book_requests.insert(self.next_create_order_book_request_id, create_instrument_request)
         self.send_create_order_book_request(create_instrument_request)
 
     def create_order_book_response(self, create_order_book_response: CreateOrderBookResponse):
-        create_instrument_request = self.create_order_book_request_id_to_create_instrument_request[create_order_book_response.request_id]
+        create_instrument_request = self.create_order_book_requests.complete(create_order_book_response.request_id)
+        if create_instrument_request is None:
+            logger.warning(f'Dropping create order book response for unknown or timed out request {create_order_book_response.request_id}')
+            return
         order_book_id = create_order_book_response.order_book_id
         new_instrument = create_instrument_request.instrument
         logger.info(f'New Instrument: {new_instrument}')
-        tick_size = create_instrument_request.tick_size
-        self.__add_new_instrument_mappings(new_instrument, order_book_id, tick_size)
-        created_timestamp = int(time.time() * 1000000)
-        message = OnInstrument(instrument=new_instrument, created_timestamp=created_timestamp, tick_size=tick_size, order_book_id=order_book_id)
+        created_timestamp = self.clock.wall_ns // 1000
+        self.__mirror_order_book(new_instrument, order_book_id, create_instrument_request.tick_size, created_timestamp)
+        self.__respond_to_create_instrument_request(create_instrument_request, order_book_id, created_timestamp)
+
+    def __mirror_order_book(self, instrument: Instrument, order_book_id: int, tick_size: float, created_timestamp: int):
+        """
+        Mirrors a book and tells clients of its instrument, on whichever of the create order book response, the
+        OnOrderBookCreated broadcast or the book's snapshot comes first
+        """
+        if order_book_id in self.order_books:
+            return
+        self.__add_new_instrument_mappings(instrument, order_book_id, tick_size)
+        message = OnInstrument(instrument=instrument, created_timestamp=created_timestamp, tick_size=tick_size, order_book_id=order_book_id)
         self.connection_storer.broadcast_message(MessageType.ON_INSTRUMENT, message)
         logger.debug('info service clients notified of new instrument')
-        self.__respond_to_create_instrument_request(create_instrument_request, order_book_id, created_timestamp)
 
     def __add_new_instrument_mappings(self, new_instrument: Instrument, order_book_id: int, tick_size: int) -> Instrument:
         instrument_symbol = new_instrument.symbol
-        self.order_books[order_book_id] = OrderBook(order_book_id, tick_size)
-        self.top_of_books[order_book_id] = (None, None)
+        if order_book_id not in self.order_books:  # Already mirrored if a snapshot overtook the create order book response
+            self.order_books[order_book_id] = OrderBook(order_book_id, tick_size, track_dirty_levels=True)
+            self.top_of_books[order_book_id] = (None, None)
+            if self.shared_top_of_book is not None:
+                self.shared_top_of_book.add_order_book(order_book_id, tick_size)
         self.order_book_ids_to_instruments[order_book_id] = instrument_symbol
+        self.instruments_to_order_book_ids[instrument_symbol] = order_book_id
         logger.info(f'new instrument -{instrument_symbol}- added to info service')
 
     def __respond_to_create_instrument_request(self, create_instrument_request: CreateInstrumentRequest, order_book_id: int, created_timestamp: int):
         create_instrument_response = CreateInstrumentResponse(request_id=create_instrument_request.request_id, error_message='', created_timestamp=created_timestamp, order_book_id=order_book_id)
-        instrument_request_connection_handler = self.connection_storer.create_instrument_request_id_to_connection_handler[create_instrument_request.request_id]
+        instrument_request_connection_handler = self.connection_storer.create_instrument_request_id_to_connection_handler.pop(create_instrument_request.request_id)
         instrument_request_connection_handler.send_message(MessageType.CREATE_INSTRUMENT_RESPONSE, create_instrument_response)
         logger.info(f'Info Service sent create instrument response for order book id {order_book_id}')
 
-    def order_book_subscribe_request(self, order_book_subscribe_request: OrderBookSubscribeRequest) -> OrderBookSubscribeResponse:
-        if order_book_subscribe_request.subscription_type == SubscriptionType.TOP_OF_BOOK:
-            logger.info('new top of book subscriber added')
+    def __on_create_order_book_request_timeout(self, create_order_book_request_id: int, create_instrument_request: CreateInstrumentRequest):
+        create_instrument_response = CreateInstrumentResponse(request_id=create_instrument_request.request_id, error_message='Timed out waiting for the order book service')
+        instrument_request_connection_handler = self.connection_storer.create_instrument_request_id_to_connection_handler.pop(create_instrument_request.request_id, None)
+        if instrument_request_connection_handler is not None:
+            instrument_request_connection_handler.send_message(MessageType.CREATE_INSTRUMENT_RESPONSE, create_instrument_response)
+
+    def request_table_metrics(self) -> List[CorrelationTableMetrics]:
+        return [self.create_order_book_requests.metrics()]
+
+    def order_book_subscribe_request(self, order_book_subscribe_request: OrderBookSubscribeRequest, connection_handler) -> OrderBookSubscribeResponse:
+        if self.subscriptions.subscribe(order_book_subscribe_request.instrument_symbol, order_book_subscribe_request.subscription_type, connection_handler):
+            logger.info('new %s subscriber added', SubscriptionType.Name(order_book_subscribe_request.subscription_type))
         return OrderBookSubscribeResponse(request_id=order_book_subscribe_request.request_id, error_message='')
 
+    def order_book_catch_up(self, order_book_subscribe_request: OrderBookSubscribeRequest) -> List[Tuple[int, ProtoMessage]]:
+        """
+        (message type, message) of what a subscriber is sent before live updates: the incremental depth updates after
+        its last_sequence_number while the replay ring still holds them, otherwise the current state. Nothing if it is
+        up to date. A last_sequence_number ahead of the stream, from before a restart of this service, counts as none.
+        """
+        instrument_symbol = order_book_subscribe_request.instrument_symbol
+        subscription_type = order_book_subscribe_request.subscription_type
+        last_sequence_number = order_book_subscribe_request.last_sequence_number
+        ring = self.subscriptions.replay_ring(instrument_symbol, subscription_type)
+        if last_sequence_number and last_sequence_number == ring.sequence_number:
+            return []
+        if subscription_type == SubscriptionType.TOP_OF_BOOK:
+            return [ring.updates[-1]] if ring.updates else []
+        if last_sequence_number and last_sequence_number < ring.sequence_number and self.price_depth_mode == PriceDepthMode.INCREMENTAL:
+            missed = ring.since(last_sequence_number)
+            if missed is not None:
+                logger.info('Replaying %d depth updates of %s', len(missed), instrument_symbol)
+                return missed
+        snapshot = self.price_depth_snapshot(instrument_symbol)
+        return [] if snapshot is None else [(MessageType.ON_PRICE_DEPTH_BOOK, snapshot)]
+
+    def bars_request(self, bars_request: BarsRequest) -> BarsResponse:
+        if bars_request.instrument_symbol not in self.instruments_to_order_book_ids:
+            return BarsResponse(request_id=bars_request.request_id, error_message='Unknown instrument')
+        if bars_request.interval <= 0 or bars_request.end_timestamp <= bars_request.start_timestamp:
+            return BarsResponse(request_id=bars_request.request_id, error_message='Interval and time range must be positive')
+        if (bars_request.end_timestamp - bars_request.start_timestamp) // bars_request.interval >= MAX_BARS:
+            return BarsResponse(request_id=bars_request.request_id, error_message=f'More than {MAX_BARS} intervals requested')
+        response = BarsResponse(request_id=bars_request.request_id, error_message='')
+        tape = self.trade_tapes[bars_request.instrument_symbol]
+        if tape is None:
+            return response
+        bars = tape.bars(bars_request.start_timestamp, bars_request.end_timestamp, bars_request.interval)
+        for column, values in zip(bars._fields, bars):
+            getattr(response, column).extend(values.tolist())
+        return response
+
+    def order_book_unsubscribe_request(self, order_book_unsubscribe_request: OrderBookUnsubscribeRequest, connection_handler) -> OrderBookUnsubscribeResponse:
+        if not self.subscriptions.unsubscribe(order_book_unsubscribe_request.instrument_symbol, order_book_unsubscribe_request.subscription_type, connection_handler):
+            return OrderBookUnsubscribeResponse(request_id=order_book_unsubscribe_request.request_id, error_message='Not subscribed')
+        return OrderBookUnsubscribeResponse(request_id=order_book_unsubscribe_request.request_id, error_message='')
+
+    def remove_subscriber(self, connection_handler):
+        """Drops every subscription of a connection that closed"""
+        removed = self.subscriptions.remove_connection_handler(connection_handler)
+        if removed:
+            logger.info('Removed %d subscriptions of a closed connection', removed)
+
+    def on_order_book_snapshot(self, snapshot: OnOrderBookSnapshot):
+        """
+        Brings the mirror of one book in line with the order book service's snapshot of it, learning the book's instrument
+        if this service was restarted since it was created. The mirror is changed order by order, so that dirty level
+        tracking and top of book see exactly what moved, and changes up to the snapshot's sequence number are skipped.
+        """
+        order_book_id = snapshot.order_book_id
+        if order_book_id == 0:
+            self.order_book_sequence_number = snapshot.sequence_number
+            return
+        if order_book_id not in self.order_books:
+            if not snapshot.instrument.symbol:
+                logger.warning(f'Ignoring snapshot of order book {order_book_id}, which has no instrument')
+                self.order_book_sequence_number = snapshot.sequence_number
+                return
+            self.__mirror_order_book(snapshot.instrument, order_book_id, snapshot.tick_size, self.clock.wall_ns // 1000)
+        order_book = self.order_books[order_book_id]
+        quantities = dict(zip(snapshot.order_ids, snapshot.quantities))
+        for order_id in [order_id for order_id in order_book.orders if order_id not in quantities]:
+            order_book.cancel_order(order_id)
+            self.order_ids_to_order_book_ids.pop(order_id, None)
+        for order_id, side, price_ticks, quantity, timestamp in zip(snapshot.order_ids, snapshot.sides, snapshot.price_ticks, snapshot.quantities, snapshot.timestamps):
+            order = order_book.get_order(order_id)
+            if order is not None and order.quantity < quantity:
+                order_book.cancel_order(order_id)  # Only a mirror that missed changes holds less than the snapshot
+                order = None
+            if order is None:
+                order_book.insert_order(Order(order_id, order_book_id, timestamp, side, price_ticks, quantity))
+                self.order_ids_to_order_book_ids[order_id] = order_book_id
+            elif order.quantity > quantity:
+                order_book.reduce_order(order_id, order.quantity - quantity)
+        self.order_book_sequence_number = snapshot.sequence_number
+        logger.info(f'Order book {order_book_id} synchronised with {len(order_book.orders)} resting orders at sequence number {snapshot.sequence_number}')
+        self.__on_order_book_changed(order_book)
+
+    def __in_sequence(self, sequence_number: int) -> bool:
+        """
+        Whether to apply a change of the order book service: changes are skipped while waiting for snapshots and when
+        a snapshot already reflects them, and a gap in the sequence asks for fresh snapshots.
+        """
+        last_sequence_number = self.order_book_sequence_number
+        if last_sequence_number is None or sequence_number <= last_sequence_number:
+            return False
+        if sequence_number != last_sequence_number + 1:
+            logger.warning(f'Missed order book changes {last_sequence_number + 1} to {sequence_number - 1}, resynchronising')
+            self.order_book_sequence_number = None
+            self.login_to_order_book_service()
+            return False
+        self.order_book_sequence_number = sequence_number
+        return True
+
+    def on_order_book_created(self, on_order_book_created: OnOrderBookCreated):
+        """
+        Mirrors the new book, so that its changes can be applied even if the create order book response timed out
+        here, or the book was created by another client of the order book service
+        """
+        if not self.__in_sequence(on_order_book_created.sequence_number):
+            return
+        if on_order_book_created.instrument.symbol:
+            self.__mirror_order_book(on_order_book_created.instrument, on_order_book_created.order_book_id, on_order_book_created.tick_size, self.clock.wall_ns // 1000)
+
     def on_order_inserted(self, on_order_inserted: OnOrderInserted):
+        if not self.__in_sequence(on_order_inserted.sequence_number):
+            return
+        if on_order_inserted.quantity == 0:
+            return
+        self.__on_order_book_changed(self.__insert_order(on_order_inserted))
+
+    def __insert_order(self, on_order_inserted: OnOrderInserted) -> OrderBook:
         order_book_id = on_order_inserted.order_book_id
         self.order_ids_to_order_book_ids[on_order_inserted.order_id] = order_book_id
-        logger.info(f'Adding new order to order book with id {order_book_id}')
+        logger.info('Adding new order to order book with id %d', order_book_id)
         order_book = self.order_books[order_book_id]
-        order_book.insert_order()
-        logger.info(f'Order added to order book with id {order_book_id}')
-        if self.__update_top_of_book(order_book):
-            logger.info('Inserting order caused top of book to change')
-            self.__on_top_of_book(order_book_id)
-        self.__on_price_depth_book()
+        order_book.insert_order(Order(on_order_inserted.order_id, order_book_id, on_order_inserted.timestamp, on_order_inserted.side, to_ticks(on_order_inserted.price, order_book.tick_size), on_order_inserted.quantity))
+        logger.info('Order added to order book with id %d', order_book_id)
+        return order_book
 
     def on_order_cancelled(self, on_order_cancelled: OnOrderCancelled):
-        order_book_id = self.order_ids_to_order_book_ids[on_order_cancelled.order_id]
+        if not self.__in_sequence(on_order_cancelled.sequence_number):
+            return
+        order_book = self.__cancel_order(on_order_cancelled.order_id)
+        if order_book is not None:
+            self.__on_order_book_changed(order_book)
+
+    def __cancel_order(self, order_id: int) -> Optional[OrderBook]:
+        order_book_id = self.order_ids_to_order_book_ids.pop(order_id, None)
+        if order_book_id is None:
+            logger.warning('Cancelled order %d is not resting in any known order book', order_id)
+            return None
         order_book = self.order_books[order_book_id]
-        logger.info(f'Cancelling order in order book with id {order_book_id}')
-        order_book.cancel_order()
-        if self.__update_top_of_book(order_book):
-            logger.info('Cancelling order cause top of book to change')
-            self.__on_top_of_book(order_book_id)
-        self.__on_price_depth_book()
+        logger.info('Cancelling order in order book with id %d', order_book_id)
+        order_book.cancel_order(order_id)
+        return order_book
 
     def on_trade(self, ob_on_trade: OBOnTrade) -> None:
-        logger.info(f'Info Service broadcasting on trade message for trade id {ob_on_trade.trade_id}')
-        message = InfoOnTrade(trade_id=ob_on_trade.trade_id, instrument_symbol=self.order_book_ids_to_instruments[ob_on_trade.order_book_id], timestamp=ob_on_trade.timestamp, price=ob_on_trade.price, quantity=ob_on_trade.quantity, aggressor_side=ob_on_trade.aggressor_side)
+        if not self.__in_sequence(ob_on_trade.sequence_number):
+            return
+        self.__on_order_book_changed(self.__trade(ob_on_trade))
+
+    def __trade(self, ob_on_trade: OBOnTrade) -> OrderBook:
+        logger.info('Info Service broadcasting on trade message for trade id %d', ob_on_trade.trade_id)
+        instrument_symbol = self.order_book_ids_to_instruments[ob_on_trade.order_book_id]
+        sequence_number = self.trade_sequence_numbers[instrument_symbol] = self.trade_sequence_numbers.get(instrument_symbol, 0) + 1
+        message = InfoOnTrade(trade_id=ob_on_trade.trade_id, instrument_symbol=instrument_symbol, timestamp=ob_on_trade.timestamp, price=ob_on_trade.price, quantity=ob_on_trade.quantity, aggressor_side=ob_on_trade.aggressor_side, sequence_number=sequence_number, order_book_id=ob_on_trade.order_book_id)
         self.connection_storer.broadcast_message(MessageType.ON_TRADE, message)
+        self.trade_tapes.append(instrument_symbol, ob_on_trade.timestamp, ob_on_trade.price, ob_on_trade.quantity, ob_on_trade.aggressor_side)
+        passive_order_id = ob_on_trade.sell_order_id if ob_on_trade.aggressor_side == Side.BUY else ob_on_trade.buy_order_id
+        order_book = self.order_books[ob_on_trade.order_book_id]
+        passive_order = order_book.reduce_order(passive_order_id, ob_on_trade.quantity)
+        if passive_order is not None and passive_order.quantity == 0:
+            del self.order_ids_to_order_book_ids[passive_order_id]
+        return order_book
+
+    def on_orders_inserted(self, on_orders_inserted: OnOrdersInserted):
+        """Applies a batch insert to the mirrored books, publishing each changed book once at the end"""
+        if not self.__in_sequence(on_orders_inserted.sequence_number):
+            return
+        changed_order_books = {}
+        trades = on_orders_inserted.trades
+        next_trade = 0
+        for on_order_inserted in on_orders_inserted.orders:
+            order_id = on_order_inserted.order_id
+            while next_trade < len(trades) and order_id == (trades[next_trade].buy_order_id if trades[next_trade].aggressor_side == Side.BUY else trades[next_trade].sell_order_id):
+                order_book = self.__trade(trades[next_trade])
+                changed_order_books[order_book.id] = order_book
+                next_trade += 1
+            if on_order_inserted.quantity > 0:
+                order_book = self.__insert_order(on_order_inserted)
+                changed_order_books[order_book.id] = order_book
+        for order_book in changed_order_books.values():
+            self.__on_order_book_changed(order_book)
+
+    def on_orders_cancelled(self, on_orders_cancelled: OnOrdersCancelled):
+        if not self.__in_sequence(on_orders_cancelled.sequence_number):
+            return
+        changed_order_books = {}
+        for order_id in on_orders_cancelled.order_ids:
+            order_book = self.__cancel_order(order_id)
+            if order_book is not None:
+                changed_order_books[order_book.id] = order_book
+        for order_book in changed_order_books.values():
+            self.__on_order_book_changed(order_book)
+
+    def __on_order_book_changed(self, order_book: OrderBook) -> None:
+        if self.shared_top_of_book is not None:
+            self.shared_top_of_book.publish(order_book.id, self.clock.wall_ns // 1000, order_book.get_best_bid(), order_book.get_best_ask())
+        if self.conflation[SubscriptionType.TOP_OF_BOOK].mode == ConflationMode.IMMEDIATE:
+            self.__publish_top_of_book(order_book)
+        else:
+            self.__pending_order_book_ids[SubscriptionType.TOP_OF_BOOK][order_book.id] = None
+        if self.conflation[SubscriptionType.PRICE_DEPTH_BOOK].mode == ConflationMode.IMMEDIATE:
+            self.__on_price_depth_book(order_book)
+        else:
+            # The book keeps accumulating its dirty levels until the flush takes them
+            self.__pending_order_book_ids[SubscriptionType.PRICE_DEPTH_BOOK][order_book.id] = None
+
+    def schedule_expiry(self, connection_manager: TcpConnectionManager) -> None:
+        """Registers the expiry of pending create order book requests with the event loop that feeds this service"""
+        connection_manager.call_every(EXPIRY_INTERVAL_SECONDS, self.create_order_book_requests.expire)
+
+    def schedule_conflation_flushes(self, connection_manager: TcpConnectionManager) -> None:
+        """Registers the flush of every conflated subscription type with the event loop that feeds this service"""
+        for subscription_type, policy in self.conflation.items():
+            flush = partial(self.flush_conflated_updates, subscription_type)
+            if policy.mode == ConflationMode.PER_ITERATION:
+                connection_manager.add_iteration_callback(flush)
+            elif policy.mode == ConflationMode.INTERVAL:
+                connection_manager.call_every(policy.interval_seconds, flush)
+            else:
+                continue
+            logger.info(f'Info service conflating {SubscriptionType.Name(subscription_type)} updates {policy.mode.value}')
+
+    def flush_conflated_updates(self, subscription_type: Optional[SubscriptionType]=None) -> None:
+        """Publishes the latest state of every order book that changed since the last flush, for one or all subscription types"""
+        subscription_types = self.conflation if subscription_type is None else (subscription_type,)
+        for subscription_type in subscription_types:
+            pending_order_book_ids = self.__pending_order_book_ids[subscription_type]
+            if not pending_order_book_ids:
+                continue
+            self.__pending_order_book_ids[subscription_type] = {}
+            publish = self.__publish_top_of_book if subscription_type == SubscriptionType.TOP_OF_BOOK else self.__on_price_depth_book
+            for order_book_id in pending_order_book_ids:
+                publish(self.order_books[order_book_id])
+
+    def __publish_top_of_book(self, order_book: OrderBook) -> None:
+        if self.__update_top_of_book(order_book):
+            logger.info('Order book change caused top of book to change')
+            self.__on_top_of_book(order_book.id)
 
     def __update_top_of_book(self, order_book: OrderBook) -> bool:
         logger.debug('Info service checking for update to top of book')
@@ -101,28 +405,91 @@ class InfoService:
         old_best_bid, old_best_ask = self.top_of_books[order_book.id]
         if new_best_bid != old_best_bid or new_best_ask != old_best_ask:
             self.top_of_books[order_book.id] = (new_best_bid, new_best_ask)
-        return True
+            return True
+        return False
 
     def __on_top_of_book(self, order_book_id: int) -> None:
-        timestamp = int(time.time() * 1000000)
+        timestamp = self.clock.wall_ns // 1000
         instrument_symbol = self.order_book_ids_to_instruments[order_book_id]
-        new_best_bid = self.top_of_books[order_book_id][0]
-        new_best_ask = self.top_of_books[order_book_id][1]
-        bid_price_level = PriceLevel(price=new_best_bid.price, quantity=new_best_bid.quantity)
-        ask_price_level = PriceLevel(price=new_best_ask.price, quantity=new_best_ask.quantity)
-        message = OnTopOfBook(instrument_symbol=instrument_symbol, timestamp=timestamp, best_bid=bid_price_level, best_ask=ask_price_level)
+        new_best_bid, new_best_ask = self.top_of_books[order_book_id]
+        message = OnTopOfBook(instrument_symbol=instrument_symbol, timestamp=timestamp, order_book_id=order_book_id)
+        tick_size = self.order_books[order_book_id].tick_size
+        if new_best_bid is not None:
+            message.best_bid.price = to_price(new_best_bid.price_ticks, tick_size)
+            message.best_bid.quantity = new_best_bid.quantity
+        if new_best_ask is not None:
+            message.best_ask.price = to_price(new_best_ask.price_ticks, tick_size)
+            message.best_ask.quantity = new_best_ask.quantity
         logger.info('Info Service multi casting a change in top of book')
-        self.tob_subscribers.broadcast_message(MessageType.ON_TOP_OF_BOOK, message, instrument_symbol)
+        self.subscriptions.broadcast_message(MessageType.ON_TOP_OF_BOOK, message, instrument_symbol, SubscriptionType.TOP_OF_BOOK, (MessageType.ON_TOP_OF_BOOK, order_book_id))
 
     def __on_price_depth_book(self, order_book: OrderBook) -> None:
-        order_book_id = order_book.id
-        instrument_symbol = self.order_book_ids_to_instruments[order_book_id]
-        timestamp = int(time.time() * 1000000)
-        message = OnPriceDepthBook(instrument_symbol=instrument_symbol, timestamp=timestamp, bids=order_book.bids, asks=order_book.asks)
+        dirty_bids = order_book.take_dirty_levels(Side.BUY)
+        dirty_asks = order_book.take_dirty_levels(Side.SELL)
+        if not dirty_bids and not dirty_asks:
+            return
+        instrument_symbol = self.order_book_ids_to_instruments[order_book.id]
+        if self.price_depth_mode == PriceDepthMode.INCREMENTAL:
+            tick_size = order_book.tick_size
+            message = OnPriceLevelsChanged(instrument_symbol=instrument_symbol, order_book_id=order_book.id, timestamp=self.clock.wall_ns // 1000, bids=[PriceLevel(price=to_price(level.price_ticks, tick_size), quantity=level.quantity) for level in dirty_bids], asks=[PriceLevel(price=to_price(level.price_ticks, tick_size), quantity=level.quantity) for level in dirty_asks])
+            logger.info('Info Service multi casting %d changed price levels', len(dirty_bids) + len(dirty_asks))
+            self.subscriptions.broadcast_message(MessageType.ON_PRICE_LEVELS_CHANGED, message, instrument_symbol, SubscriptionType.PRICE_DEPTH_BOOK)
+            return
+        published = self.published_price_depths.get(order_book.id)
+        if published is None:
+            bids = order_book.get_price_levels(Side.BUY, self.price_depth_levels)
+            asks = order_book.get_price_levels(Side.SELL, self.price_depth_levels)
+            changed = self.__changed_within(dirty_bids, bids, Side.BUY) or self.__changed_within(dirty_asks, asks, Side.SELL)
+        else:
+            bids = self.__top_levels(order_book, Side.BUY, dirty_bids, published[0])
+            asks = self.__top_levels(order_book, Side.SELL, dirty_asks, published[1])
+            changed = bids is not published[0] or asks is not published[1]
+        self.published_price_depths[order_book.id] = (bids, asks)
+        if not changed:
+            return
         logger.info('Info Service multi casting a change in price depth book')
-        self.pd_subscribers.broadcast_message(MessageType.ON_PRICE_DEPTH_BOOK, message)
+        self.subscriptions.broadcast_message(MessageType.ON_PRICE_DEPTH_BOOK, self.__price_depth_book(order_book, bids, asks), instrument_symbol, SubscriptionType.PRICE_DEPTH_BOOK, (MessageType.ON_PRICE_DEPTH_BOOK, order_book.id))
+
+    def __top_levels(self, order_book: OrderBook, side: Side, dirty_levels: List[BookLevel], published_levels: List[BookLevel]) -> List[BookLevel]:
+        """
+        The top levels of one side, only taken from the book again if a changed level is or may now be one of them.
+        Otherwise the published levels are still current and are returned as they are.
+        """
+        if not self.__changed_within(dirty_levels, published_levels, side):
+            return published_levels
+        return order_book.get_price_levels(side, self.price_depth_levels)
+
+    def __changed_within(self, dirty_levels, top_levels, side: Side) -> bool:
+        """Whether a changed level is one of the published top levels, or was before it emptied"""
+        if not dirty_levels:
+            return False
+        if len(top_levels) < self.price_depth_levels:
+            return True
+        worst_ticks = top_levels[-1].price_ticks
+        if side == Side.BUY:
+            return any((level.price_ticks >= worst_ticks for level in dirty_levels))
+        return any((level.price_ticks <= worst_ticks for level in dirty_levels))
+
+    def __price_depth_book(self, order_book: OrderBook, bids, asks) -> OnPriceDepthBook:
+        tick_size = order_book.tick_size
+        return OnPriceDepthBook(instrument_symbol=self.order_book_ids_to_instruments[order_book.id], order_book_id=order_book.id, timestamp=self.clock.wall_ns // 1000, bids=[PriceLevel(price=to_price(level.price_ticks, tick_size), quantity=level.quantity) for level in bids], asks=[PriceLevel(price=to_price(level.price_ticks, tick_size), quantity=level.quantity) for level in asks])
+
+    def price_depth_snapshot(self, instrument_symbol: str) -> Optional[OnPriceDepthBook]:
+        """
+        Depth sent to a new subscriber before any update: the top levels in snapshot mode, the whole book in
+        incremental mode so that changed levels can be applied to it. Stamped with the sequence number of the last
+        depth update published, which it reflects.
+        """
+        order_book_id = self.instruments_to_order_book_ids.get(instrument_symbol)
+        if order_book_id is None:
+            return None
+        order_book = self.order_books[order_book_id]
+        limit = self.price_depth_levels if self.price_depth_mode == PriceDepthMode.SNAPSHOT else None
+        snapshot = self.__price_depth_book(order_book, order_book.get_price_levels(Side.BUY, limit), order_book.get_price_levels(Side.SELL, limit))
+        snapshot.sequence_number = self.subscriptions.replay_ring(instrument_symbol, SubscriptionType.PRICE_DEPTH_BOOK).sequence_number
+        return snapshot
 
     def send_create_order_book_request(self, instrument_request):
-        create_order_book_request = CreateOrderBookRequest(request_id=self.next_create_order_book_request_id, tick_size=instrument_request.tick_size)
+        create_order_book_request = CreateOrderBookRequest(request_id=self.next_create_order_book_request_id, tick_size=instrument_request.tick_size, instrument=instrument_request.instrument)
         self.next_create_order_book_request_id += 1
         self.orderbook_connection_handler.send_message(OrderBookServiceMessageType.CREATE_ORDER_BOOK_REQUEST, create_order_book_request)
@@ -1,55 +1,130 @@
+import itertools
 import logging
 import socket
-from typing import Callable, List
+from typing import Callable, Dict, List
 from connection.connection_handler import ConnectionHandler, ConnectionHandlerFactory
 from connection.ip_address import IpAddress
 from connection import message_codec
+from connection.message_codec import MESSAGE_TYPE_ATTRIBUTE
 from group_3_app.info_service.info_service import InfoService
-from generated.proto.info_pb2 import MessageType, CreateInstrumentRequest, OrderBookSubscribeRequest, SubscriptionType
-from generated.proto.common_pb2 import LoginRequest
+from generated.proto.info_pb2 import MessageType, BarsRequest, CreateInstrumentRequest, OrderBookSubscribeRequest, OrderBookUnsubscribeRequest, SubscriptionType
+from generated.proto.common_pb2 import LoginRequest, LoginResponse
 from generated.proto.order_book_pb2 import MessageType as OrderBookServiceMessageType
-from generated.proto.order_book_pb2 import OnOrderInserted, OnOrderCancelled, CreateOrderBookResponse
+from generated.proto.order_book_pb2 import OnOrderBookCreated, OnOrderBookSnapshot, OnOrderInserted, OnOrderCancelled, OnOrdersInserted, OnOrdersCancelled, CreateOrderBookResponse
 from generated.proto.order_book_pb2 import OnTrade as ObOnTrade
 from group_3_app.common.connection_storer import ConnectionStorer
+from group_3_app.common.service_names import INFO_SERVICE, ORDER_BOOK_SERVICE
+from connection.message_dispatcher import MessageDispatcher
 logger = logging.getLogger(__name__)
+# Broadcasts that name their instrument by both symbol and order book id, and go without the symbol to compact connections
+COMPACT_MESSAGE_TYPES = frozenset((MessageType.ON_TOP_OF_BOOK, MessageType.ON_PRICE_DEPTH_BOOK, MessageType.ON_PRICE_LEVELS_CHANGED, MessageType.ON_TRADE))
 
 class InfoServiceConnectionHandler(ConnectionHandler):
 
-    def __init__(self, socket_fd: socket.socket, ip_address: IpAddress, close_callback: Callable[[], None], service: InfoService):
+    def __init__(self, socket_fd: socket.socket, ip_address: IpAddress, close_callback: Callable[[], None], service: InfoService, protocol: str=INFO_SERVICE):
+        """protocol is INFO_SERVICE for info clients and ORDER_BOOK_SERVICE for the info service's own connection to the order book feed"""
         super().__init__(socket_fd, ip_address, close_callback)
         self.service = service
+        self.protocol = protocol
+        # Whether market data names instruments by order book id only, as negotiated at login
+        self.compact_instrument_ids = False
+        self.dispatcher = MessageDispatcher()
+        self.dispatcher.register(INFO_SERVICE, MessageType.LOGIN_REQUEST, LoginRequest, self.__on_login_request)
+        self.dispatcher.register(INFO_SERVICE, MessageType.CREATE_INSTRUMENT_REQUEST, CreateInstrumentRequest, self.__on_create_instrument_request, reuse_message=False)
+        self.dispatcher.register(INFO_SERVICE, MessageType.ORDER_BOOK_SUBSCRIBE_REQUEST, OrderBookSubscribeRequest, self.__on_order_book_subscribe_request)
+        self.dispatcher.register(INFO_SERVICE, MessageType.ORDER_BOOK_UNSUBSCRIBE_REQUEST, OrderBookUnsubscribeRequest, self.__on_order_book_unsubscribe_request)
+        self.dispatcher.register(INFO_SERVICE, MessageType.BARS_REQUEST, BarsRequest, self.__on_bars_request)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.LOGIN_RESPONSE, LoginResponse, self.__on_login_response)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.CREATE_ORDER_BOOK_RESPONSE, CreateOrderBookResponse, self.service.create_order_book_response)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.ON_ORDER_BOOK_SNAPSHOT, OnOrderBookSnapshot, self.service.on_order_book_snapshot)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.ON_ORDER_BOOK_CREATED, OnOrderBookCreated, self.service.on_order_book_created)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.ON_ORDER_INSERTED, OnOrderInserted, self.service.on_order_inserted)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.ON_ORDER_CANCELLED, OnOrderCancelled, self.service.on_order_cancelled)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.ON_TRADE, ObOnTrade, self.service.on_trade)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.ON_ORDERS_INSERTED, OnOrdersInserted, self.service.on_orders_inserted)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.ON_ORDERS_CANCELLED, OnOrdersCancelled, self.service.on_orders_cancelled)
 
     def handle_message(self, message_type: int, message: bytes) -> None:
         """Handles incoming messages."""
-        logger.info(f'Received message of type {message_type} from {self.ip_address}')
-        if message_type == MessageType.LOGIN_REQUEST:
-            login_request = self._deserialize_message(LoginRequest, message)
-            response = self.service.login_request(login_request)
-            logger.info(f"User '{login_request.username}' logged in from {self.ip_address}")
-            self.send_message(MessageType.LOGIN_RESPONSE, response)
+        logger.info('Received message of type %d from %s', message_type, self.ip_address, extra={MESSAGE_TYPE_ATTRIBUTE: message_type})
+        self.dispatcher.dispatch(self.protocol, message_type, message)
         return None
 
+    def __on_login_request(self, login_request: LoginRequest) -> None:
+        response = self.service.login_request(login_request, self)
+        logger.info(f"User '{login_request.username}' logged in from {self.ip_address}")
+        self.send_message(MessageType.LOGIN_RESPONSE, response)
+
+    def __on_login_response(self, login_response: LoginResponse) -> None:
+        if login_response.error_message:
+            logger.error(f'Login to order book service failed: {login_response.error_message}')
+        else:
+            logger.info('Logged in to order book service')
+
+    def __on_create_instrument_request(self, create_instrument_request: CreateInstrumentRequest) -> None:
+        self.service.connection_storer.add_create_instrument_request_connection_handler(create_instrument_request.request_id, self)
+        self.service.create_instrument_request(create_instrument_request)
+
+    def __on_order_book_subscribe_request(self, order_book_subscribe_request: OrderBookSubscribeRequest) -> None:
+        response = self.service.order_book_subscribe_request(order_book_subscribe_request, self)
+        self.send_message(MessageType.ORDER_BOOK_SUBSCRIBE_RESPONSE, response)
+        for message_type, message in self.service.order_book_catch_up(order_book_subscribe_request):
+            self.__send_market_data(message_type, message)
+
+    def __send_market_data(self, message_type: int, message) -> None:
+        """Sends a message naming its instrument by symbol and order book id, leaving the symbol out in compact mode"""
+        if not self.compact_instrument_ids:
+            self.send_message(message_type, message)
+            return
+        instrument_symbol = message.instrument_symbol
+        message.ClearField('instrument_symbol')
+        try:
+            self.send_message(message_type, message)
+        finally:
+            message.instrument_symbol = instrument_symbol
+
+    def __on_order_book_unsubscribe_request(self, order_book_unsubscribe_request: OrderBookUnsubscribeRequest) -> None:
+        response = self.service.order_book_unsubscribe_request(order_book_unsubscribe_request, self)
+        self.send_message(MessageType.ORDER_BOOK_UNSUBSCRIBE_RESPONSE, response)
+
+    def __on_bars_request(self, bars_request: BarsRequest) -> None:
+        self.send_message(MessageType.BARS_RESPONSE, self.service.bars_request(bars_request))
+
     def on_disconnect(self) -> None:
         """Handles cleanup when a client disconnects."""
         logger.info(f'Client {self.ip_address} disconnected')
+        self.service.remove_subscriber(self)
 
 class InfoServiceConnectionHandlerFactory(ConnectionHandlerFactory[InfoServiceConnectionHandler], ConnectionStorer):
 
     def __init__(self):
-        self.connection_handlers = []
+        super().__init__()
+        self.connection_handlers: Dict[ConnectionHandler, None] = {}
+        self.compact_connection_handlers: Dict[ConnectionHandler, None] = {}
         self.create_instrument_request_id_to_connection_handler = {}
         self.service = None
 
     def add_connection_handler(self, connection_handler: ConnectionHandler):
-        self.connection_handlers.append(connection_handler)
+        self.connection_handlers[connection_handler] = None
 
     def remove_connection_handler(self, connection_handler: ConnectionHandler):
-        self.connection_handlers.remove(connection_handler)
+        self.connection_handlers.pop(connection_handler, None)
+        self.compact_connection_handlers.pop(connection_handler, None)
+
+    def refresh_connection_handler(self, connection_handler: InfoServiceConnectionHandler):
+        """Files a connection under compact or full instrument ids, after it negotiated them at login"""
+        self.remove_connection_handler(connection_handler)
+        if connection_handler.compact_instrument_ids:
+            self.compact_connection_handlers[connection_handler] = None
+        else:
+            self.connection_handlers[connection_handler] = None
 
     def broadcast_message(self, message_type, message):
-        logger.info(f'Info Service braodcasting message: {message}')
-        for connection_handler in self.connection_handlers:
-            connection_handler.send_message(message_type, message)
+        logger.info('Info Service broadcasting message of type %d', message_type, extra={MESSAGE_TYPE_ATTRIBUTE: message_type})
+        if message_type in COMPACT_MESSAGE_TYPES:
+            self._broadcast_compactable(self.connection_handlers, self.compact_connection_handlers, message_type, message)
+        else:
+            self._broadcast_encoded(itertools.chain(self.connection_handlers, self.compact_connection_handlers), message_type, message)
 
     def add_create_instrument_request_connection_handler(self, create_instrument_request_id: int, connection_handler: ConnectionHandler):
         self.create_instrument_request_id_to_connection_handler[create_instrument_request_id] = connection_handler
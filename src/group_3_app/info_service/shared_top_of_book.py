@@ -0,0 +1,142 @@
+import logging
+import mmap
+import os
+import struct
+from typing import Dict, NamedTuple, Optional, Tuple
+from group_3_app.common.order_book import BookLevel
+logger = logging.getLogger(__name__)
+DEFAULT_CAPACITY = 4096
+MAX_READ_ATTEMPTS = 1000000
+_MAGIC = b'OPTXTOB1'
+# Magic, slot size, number of slots
+_HEADER = struct.Struct('<8sII')
+# Each slot takes a cache line of its own: the version, then the top of book it guards
+_SLOT_SIZE = 64
+_VERSION = struct.Struct('<Q')
+_TOP_OF_BOOK = struct.Struct('<qdqqqq')
+_HEADER_SIZE = _SLOT_SIZE
+
+class SharedTopOfBookError(Exception):
+    pass
+
+class SharedTopOfBook(NamedTuple):
+    """
+    Top of book of one order book as last published. Prices are in ticks of tick_size (see common.price) and an empty
+    side has a quantity of 0. version counts the updates of the slot, twice each.
+    """
+    version: int
+    timestamp: int
+    tick_size: float
+    bid_price_ticks: int
+    bid_quantity: int
+    ask_price_ticks: int
+    ask_quantity: int
+
+class SharedTopOfBookWriter:
+    """
+    Publishes the top of book of every order book into a file that processes on the same host map, e.g. one under
+    /dev/shm, so that they poll it with plain memory reads instead of decoding OnTopOfBook frames off a socket.
+
+    The file is a header, then one fixed slot per order book indexed by order book id (slot 0 is unused). Each slot
+    is a seqlock: its version is made odd before the top of book is written and even again after, so a reader
+    that saw the same even version before and after its read knows nothing changed under it. There is one writer,
+    the info service's event loop thread. The three stores go out in program order, which readers may rely on
+    under the x86-64 memory model; the interpreter issues no fences.
+
+    A restarted writer never truncates the file under readers that still have it mapped, which would fault them on
+    their next read. It lays out a new file next to it and renames it into place, so existing readers keep the old,
+    no longer updated file until they reopen the path (see SharedTopOfBookReader.replaced).
+    """
+
+    def __init__(self, path: str, capacity: int=DEFAULT_CAPACITY):
+        """capacity is the highest order book id published; later books are skipped with a warning"""
+        self.path = path
+        self.capacity = capacity
+        size = _HEADER_SIZE + (capacity + 1) * _SLOT_SIZE
+        new_path = f'{path}.{os.getpid()}.new'
+        fd = os.open(new_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.__map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.__versions = [0] * (capacity + 1)
+        self.__published: Dict[int, Tuple[Optional[BookLevel], Optional[BookLevel]]] = {}
+        self.__tick_sizes: Dict[int, float] = {}
+        _HEADER.pack_into(self.__map, 0, _MAGIC, _SLOT_SIZE, capacity + 1)
+        os.replace(new_path, path)
+        logger.info(f'Publishing top of book for up to {capacity} order books to {path}')
+
+    def add_order_book(self, order_book_id: int, tick_size: float):
+        """Publishes an empty top of book for a new order book"""
+        if order_book_id > self.capacity:
+            logger.warning(f'Not publishing top of book of order book {order_book_id} to {self.path}, which has {self.capacity} slots')
+            return
+        self.__tick_sizes[order_book_id] = tick_size
+        self.__write(order_book_id, 0, None, None)
+
+    def publish(self, order_book_id: int, timestamp: int, best_bid: Optional[BookLevel], best_ask: Optional[BookLevel]):
+        """Writes the slot of the order book unless its best bid and ask are unchanged"""
+        if self.__published.get(order_book_id) == (best_bid, best_ask) or order_book_id not in self.__tick_sizes:
+            return
+        self.__write(order_book_id, timestamp, best_bid, best_ask)
+
+    def __write(self, order_book_id: int, timestamp: int, best_bid: Optional[BookLevel], best_ask: Optional[BookLevel]):
+        self.__published[order_book_id] = (best_bid, best_ask)
+        offset = _HEADER_SIZE + order_book_id * _SLOT_SIZE
+        version = self.__versions[order_book_id]
+        _VERSION.pack_into(self.__map, offset, version + 1)
+        _TOP_OF_BOOK.pack_into(self.__map, offset + _VERSION.size, timestamp, self.__tick_sizes[order_book_id], best_bid.price_ticks if best_bid else 0, best_bid.quantity if best_bid else 0, best_ask.price_ticks if best_ask else 0, best_ask.quantity if best_ask else 0)
+        _VERSION.pack_into(self.__map, offset, version + 2)
+        self.__versions[order_book_id] = version + 2
+
+    def close(self):
+        self.__map.close()
+
+class SharedTopOfBookReader:
+    """Reads consistent top of book snapshots from the file of a SharedTopOfBookWriter, without locks or system calls"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.__map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__inode = os.fstat(file.fileno()).st_ino
+        magic, slot_size, slots = _HEADER.unpack_from(self.__map, 0)
+        if magic != _MAGIC or slot_size != _SLOT_SIZE or len(self.__map) < _HEADER_SIZE + slots * slot_size:
+            self.__map.close()
+            raise SharedTopOfBookError(f'{path} is not a shared top of book file')
+        self.capacity = slots - 1
+
+    def replaced(self) -> bool:
+        """Whether a restarted writer has put a new file in place of this one, which this reader should reopen"""
+        try:
+            return os.stat(self.path).st_ino != self.__inode
+        except FileNotFoundError:
+            return False
+
+    def version(self, order_book_id: int) -> int:
+        """Changes whenever the order book's top of book is written, so polling it is the cheapest way to spot a change"""
+        return _VERSION.unpack_from(self.__map, self.__offset(order_book_id))[0]
+
+    def read(self, order_book_id: int) -> Optional[SharedTopOfBook]:
+        """The latest top of book of an order book, or None if it was never published"""
+        offset = self.__offset(order_book_id)
+        top_of_book_offset = offset + _VERSION.size
+        shared_map = self.__map
+        unpack_version = _VERSION.unpack_from
+        for _ in range(MAX_READ_ATTEMPTS):
+            version, = unpack_version(shared_map, offset)
+            if version & 1:
+                continue
+            top_of_book = _TOP_OF_BOOK.unpack_from(shared_map, top_of_book_offset)
+            if unpack_version(shared_map, offset)[0] == version:
+                return SharedTopOfBook(version, *top_of_book) if version else None
+        raise SharedTopOfBookError(f'Slot of order book {order_book_id} stayed mid-update for {MAX_READ_ATTEMPTS} reads; has its writer died?')
+
+    def __offset(self, order_book_id: int) -> int:
+        if not 0 < order_book_id <= self.capacity:
+            raise SharedTopOfBookError(f'Order book id {order_book_id} is outside the {self.capacity} slots published')
+        return _HEADER_SIZE + order_book_id * _SLOT_SIZE
+
+    def close(self):
+        self.__map.close()
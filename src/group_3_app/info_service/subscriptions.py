@@ -1,25 +1,137 @@
+import itertools
+from collections import deque
 from group_3_app.connection_handler import ConnectionHandler
-from typing import List
-from group_3_app.common.connection_storer import ConnectionStorer
+from typing import Deque, Dict, Hashable, List, Optional, Tuple
+from generated.proto.info_pb2 import SubscriptionType
+from group_3_app.common.connection_storer import ConnectionStorer, ProtoMessage
+SubscriptionKey = Tuple[str, SubscriptionType]
 
-class SubscriptionStorer(ConnectionStorer):
+class ReplayRing:
+    """
+    Sequence number of one market data stream and its most recent updates, oldest first. Updates are kept as messages
+    and only encoded again if replayed, so keeping them costs the publisher nothing but an append.
+    """
+    __slots__ = ('sequence_number', 'updates')
 
-    def __init__(self):
-        self.connection_handlers = {}
+    def __init__(self, capacity: int):
+        self.sequence_number = 0
+        self.updates: Deque[Tuple[int, ProtoMessage]] = deque(maxlen=capacity)
 
-    def add_connection_handler(self, instrument_symbol: str, connection_handler: ConnectionHandler):
-        self.connection_handlers[instrument_symbol].append(connection_handler)
+    def since(self, last_sequence_number: int) -> Optional[List[Tuple[int, ProtoMessage]]]:
+        """(message type, message) of every update after last_sequence_number, or None if some of them are no longer kept"""
+        missed = self.sequence_number - last_sequence_number
+        if missed <= 0:
+            return []
+        if missed > len(self.updates):
+            return None
+        return list(itertools.islice(self.updates, len(self.updates) - missed, None))
 
-    def remove_connection_handler(self, instrument_symbol: str, connection_handler: ConnectionHandler):
-        self.connection_handlers[instrument_symbol].remove(connection_handler)
+class SubscriptionManager(ConnectionStorer):
+    """
+    Subscribers of every (instrument symbol, subscription type), in subscription order, with the reverse index of every
+    connection's subscriptions. Dicts serve as ordered sets, so subscribe and unsubscribe are O(1) and dropping a
+    connection costs one step per subscription it holds rather than a scan of every instrument.
+    Broadcasts go to tuples of the subscribers that want full and compact instrument ids, built once and kept until
+    the subscribers change.
 
-    def broadcast_message(self, message_type: int, message, instrument_symbol: str):
-        subscribed_handlers = self.connection_handlers[instrument_symbol]
-        for connection_handler in subscribed_handlers:
-            connection_handler.send_message(message_type, message)
+    Every broadcast is numbered per (instrument symbol, subscription type) and kept in that stream's replay ring, whether
+    or not anyone is subscribed, so that a returning subscriber can be sent what it missed.
+    """
 
-class TOBSubscriptions(SubscriptionStorer):
-    __static_attributes__ = ()
+    def __init__(self, replay_capacities: Optional[Dict[SubscriptionType, int]]=None):
+        """
+        replay_capacities sets per subscription type how many recent updates are kept for replay, only the latest by
+        default, which is all a stream of full state updates needs
+        """
+        super().__init__()
+        self.replay_capacities = replay_capacities or {}
+        self.__rings: Dict[SubscriptionKey, ReplayRing] = {}
+        self.__subscribers: Dict[SubscriptionKey, Dict[ConnectionHandler, None]] = {}
+        self.__subscriptions: Dict[ConnectionHandler, Dict[SubscriptionKey, None]] = {}
+        self.__recipients: Dict[SubscriptionKey, Tuple[Tuple[ConnectionHandler, ...], Tuple[ConnectionHandler, ...]]] = {}
 
-class PDSubscriptions(SubscriptionStorer):
-    __static_attributes__ = ()
+    def __len__(self) -> int:
+        """Number of connections with at least one subscription"""
+        return len(self.__subscriptions)
+
+    def subscribe(self, instrument_symbol: str, subscription_type: SubscriptionType, connection_handler: ConnectionHandler) -> bool:
+        """Returns False if the connection was already subscribed"""
+        key = (instrument_symbol, subscription_type)
+        subscribers = self.__subscribers.setdefault(key, {})
+        if connection_handler in subscribers:
+            return False
+        subscribers[connection_handler] = None
+        self.__subscriptions.setdefault(connection_handler, {})[key] = None
+        self.__recipients.pop(key, None)
+        return True
+
+    def unsubscribe(self, instrument_symbol: str, subscription_type: SubscriptionType, connection_handler: ConnectionHandler) -> bool:
+        """Returns False if the connection was not subscribed"""
+        key = (instrument_symbol, subscription_type)
+        subscriptions = self.__subscriptions.get(connection_handler)
+        if subscriptions is None or key not in subscriptions:
+            return False
+        del subscriptions[key]
+        if not subscriptions:
+            del self.__subscriptions[connection_handler]
+        self.__remove_subscriber(key, connection_handler)
+        return True
+
+    def __remove_subscriber(self, key: SubscriptionKey, connection_handler: ConnectionHandler):
+        subscribers = self.__subscribers[key]
+        del subscribers[connection_handler]
+        if not subscribers:
+            del self.__subscribers[key]
+        self.__recipients.pop(key, None)
+
+    def add_connection_handler(self, connection_handler: ConnectionHandler):
+        """Connections are tracked from their first subscription"""
+        return
+
+    def remove_connection_handler(self, connection_handler: ConnectionHandler) -> int:
+        """Drops every subscription of a connection, e.g. once it disconnected. Returns how many it had."""
+        subscriptions = self.__subscriptions.pop(connection_handler, None)
+        if subscriptions is None:
+            return 0
+        for key in subscriptions:
+            self.__remove_subscriber(key, connection_handler)
+        return len(subscriptions)
+
+    def refresh_connection_handler(self, connection_handler: ConnectionHandler):
+        """Call when a connection switches to or from compact instrument ids after subscribing"""
+        for key in self.__subscriptions.get(connection_handler, ()):
+            self.__recipients.pop(key, None)
+
+    def subscribers(self, instrument_symbol: str, subscription_type: SubscriptionType) -> Tuple[ConnectionHandler, ...]:
+        return tuple(self.__subscribers.get((instrument_symbol, subscription_type), ()))
+
+    def __build_recipients(self, key: SubscriptionKey) -> Tuple[Tuple[ConnectionHandler, ...], Tuple[ConnectionHandler, ...]]:
+        subscribers = self.__subscribers.get(key, ())
+        recipients = self.__recipients[key] = (tuple(subscriber for subscriber in subscribers if not subscriber.compact_instrument_ids), tuple(subscriber for subscriber in subscribers if subscriber.compact_instrument_ids))
+        return recipients
+
+    def replay_ring(self, instrument_symbol: str, subscription_type: SubscriptionType) -> ReplayRing:
+        key = (instrument_symbol, subscription_type)
+        ring = self.__rings.get(key)
+        if ring is None:
+            ring = self.__rings[key] = ReplayRing(self.replay_capacities.get(subscription_type, 1))
+        return ring
+
+    def broadcast_message(self, message_type: int, message, instrument_symbol: str, subscription_type: SubscriptionType, conflation_key: Optional[Hashable]=None):
+        """
+        Stamps the message with the next sequence number of its stream, keeps it for replay and sends it to the subscribers,
+        without its instrument symbol to those that negotiated compact instrument ids.
+        conflation_key is given for messages that carry a full state, such as top of book, so that a subscriber
+        whose queue is backed up only keeps the latest one; deltas must not be conflated.
+        """
+        key = (instrument_symbol, subscription_type)
+        ring = self.__rings.get(key)
+        if ring is None:
+            ring = self.replay_ring(instrument_symbol, subscription_type)
+        ring.sequence_number += 1
+        message.sequence_number = ring.sequence_number
+        ring.updates.append((message_type, message))
+        recipients = self.__recipients.get(key)
+        if recipients is None:
+            recipients = self.__build_recipients(key)
+        self._broadcast_compactable(recipients[0], recipients[1], message_type, message, conflation_key)
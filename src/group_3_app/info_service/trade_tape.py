@@ -0,0 +1,121 @@
+import logging
+import os
+from typing import Dict, NamedTuple, Optional
+import numpy as np
+from generated.proto.common_pb2 import Side
+logger = logging.getLogger(__name__)
+DEFAULT_INITIAL_CAPACITY = 1024
+DEFAULT_SPILL_ROWS = 1 << 20
+COLUMNS = (('timestamps', np.int64), ('prices', np.float64), ('quantities', np.int64), ('aggressor_sides', np.int8))
+
+class Bars(NamedTuple):
+    """One entry per bar in each column, oldest first"""
+    start_timestamps: np.ndarray
+    opens: np.ndarray
+    highs: np.ndarray
+    lows: np.ndarray
+    closes: np.ndarray
+    volumes: np.ndarray
+    vwaps: np.ndarray
+    trade_counts: np.ndarray
+    buy_volumes: np.ndarray
+BAR_DTYPES = (np.int64, np.float64, np.float64, np.float64, np.float64, np.int64, np.float64, np.int64, np.int64)
+
+class TradeTape:
+    """
+    Trades of one instrument in arrival order, one NumPy array per column, so that bars are computed with a handful of
+    vectorized operations over a slice rather than a loop over trades. Arrays double when full. Past spill_rows they
+    are memory-mapped files in spill_directory, if given, so a long session's tape lives in the page cache rather than
+    on the heap. Spilled files only back the arrays: a tape starts empty and overwrites them.
+    """
+
+    def __init__(self, name: str, spill_directory: Optional[str]=None, initial_capacity: int=DEFAULT_INITIAL_CAPACITY, spill_rows: int=DEFAULT_SPILL_ROWS):
+        self.name = name
+        self.spill_directory = spill_directory
+        self.spill_rows = spill_rows
+        self.length = 0
+        self.last_timestamp = 0
+        self.spilled = False
+        self.timestamps, self.prices, self.quantities, self.aggressor_sides = [np.empty(initial_capacity, dtype) for _, dtype in COLUMNS]
+
+    def __len__(self) -> int:
+        return self.length
+
+    def append(self, timestamp: int, price: float, quantity: int, aggressor_side: Side):
+        """
+        Trades are stamped by the one order book service, so timestamps only go back if its wall clock is stepped back.
+        Such a trade is filed at the previous timestamp to keep the column sorted for searching.
+        """
+        index = self.length
+        if index == len(self.timestamps):
+            self.__grow()
+        if timestamp < self.last_timestamp:
+            timestamp = self.last_timestamp
+        self.last_timestamp = timestamp
+        self.timestamps[index] = timestamp
+        self.prices[index] = price
+        self.quantities[index] = quantity
+        self.aggressor_sides[index] = aggressor_side
+        self.length = index + 1
+
+    def __grow(self):
+        capacity = 2 * len(self.timestamps)
+        if self.spill_directory is None or capacity <= self.spill_rows:
+            for name, _ in COLUMNS:
+                column = getattr(self, name)
+                grown = np.empty(capacity, column.dtype)
+                grown[:self.length] = column[:self.length]
+                setattr(self, name, grown)
+            return
+        if not self.spilled:
+            logger.info('Spilling trade tape %s of %d trades to %s', self.name, self.length, self.spill_directory)
+        for name, _ in COLUMNS:
+            column = getattr(self, name)
+            path = os.path.join(self.spill_directory, f'{self.name}.{name}')
+            with open(path, 'r+b' if self.spilled else 'w+b') as file:
+                file.truncate(capacity * column.itemsize)
+            grown = np.memmap(path, column.dtype, 'r+', shape=(capacity,))
+            if not self.spilled:
+                grown[:self.length] = column[:self.length]
+            setattr(self, name, grown)
+        self.spilled = True
+
+    def bars(self, start_timestamp: int, end_timestamp: int, interval: int) -> Bars:
+        """
+        Bars of every interval from start_timestamp that holds trades before end_timestamp. Intervals without trades
+        are left out, so the start timestamps say which interval each bar is.
+        """
+        length = self.length
+        first = int(np.searchsorted(self.timestamps[:length], start_timestamp, 'left'))
+        end = int(np.searchsorted(self.timestamps[:length], end_timestamp, 'left'))
+        timestamps = self.timestamps[first:end]
+        prices = self.prices[first:end]
+        quantities = self.quantities[first:end]
+        if not len(timestamps):
+            return Bars(*(np.empty(0, dtype) for dtype in BAR_DTYPES))
+        buckets = (timestamps - start_timestamp) // interval
+        firsts = np.flatnonzero(np.diff(buckets)) + 1
+        firsts = np.concatenate(([0], firsts))
+        ends = np.append(firsts[1:], len(timestamps))
+        volumes = np.add.reduceat(quantities, firsts)
+        buy_quantities = np.where(self.aggressor_sides[first:end] == Side.BUY, quantities, 0)
+        return Bars(start_timestamps=start_timestamp + buckets[firsts] * interval, opens=prices[firsts], highs=np.maximum.reduceat(prices, firsts), lows=np.minimum.reduceat(prices, firsts), closes=prices[ends - 1], volumes=volumes, vwaps=np.add.reduceat(prices * quantities, firsts) / volumes, trade_counts=ends - firsts, buy_volumes=np.add.reduceat(buy_quantities, firsts))
+
+class TradeTapes:
+    """The trade tape of every instrument that traded, created on its first trade"""
+
+    def __init__(self, spill_directory: Optional[str]=None, spill_rows: int=DEFAULT_SPILL_ROWS):
+        if spill_directory is not None:
+            os.makedirs(spill_directory, exist_ok=True)
+        self.spill_directory = spill_directory
+        self.spill_rows = spill_rows
+        self.__tapes: Dict[str, TradeTape] = {}
+
+    def __getitem__(self, instrument_symbol: str) -> Optional[TradeTape]:
+        return self.__tapes.get(instrument_symbol)
+
+    def append(self, instrument_symbol: str, timestamp: int, price: float, quantity: int, aggressor_side: Side):
+        tape = self.__tapes.get(instrument_symbol)
+        if tape is None:
+            tape = self.__tapes[instrument_symbol] = TradeTape(f'trades-{len(self.__tapes) + 1:06d}', self.spill_directory, spill_rows=self.spill_rows)
+        tape.append(timestamp, price, quantity, aggressor_side)
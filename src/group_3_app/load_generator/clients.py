@@ -0,0 +1,285 @@
+import logging
+import random
+import socket
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+from connection.connection_handler import ConnectionHandler
+from connection.ip_address import IpAddress
+from connection.message_dispatcher import MessageDispatcher
+from generated.proto.common_pb2 import Instrument, LoginRequest, LoginResponse, Side
+from generated.proto.info_pb2 import CreateInstrumentRequest, CreateInstrumentResponse, OrderBookSubscribeRequest, OrderBookSubscribeResponse, OnInstrument, OnTopOfBook, OnTrade, SubscriptionType, MessageType as InfoMessageType
+from generated.proto.risk_limits_pb2 import InsertOrderRequest, InsertOrderResponse, CancelOrderRequest, CancelOrderResponse, MessageType as RiskLimitsMessageType
+from group_3_app.common.price import to_price
+from group_3_app.common.service_names import INFO_SERVICE, RISK_LIMITS_SERVICE
+from group_3_app.load_generator.latency_histogram import LatencyHistogram
+logger = logging.getLogger(__name__)
+REQUEST_ID_BITS = 32  # Request ids of each trader start at its index shifted by this many bits
+
+@dataclass(frozen=True)
+class OrderFlow:
+    """Order flow of each trader around a fixed mid; prices are in ticks of tick_size"""
+    symbols: Tuple[str, ...]
+    tick_size: float = 0.01
+    mid_ticks: int = 10000
+    passive_depth_ticks: float = 10.0  # Mean distance of passive orders from the touch
+    aggressive_ratio: float = 0.1  # Share of inserts priced through the opposite touch
+    cancel_ratio: float = 0.4  # Share of operations cancelling one of the trader's resting orders
+    max_quantity: int = 100
+
+class TraderClient(ConnectionHandler):
+    """
+    Trading client of the risk gateway. Each tick it sends its share of the order flow and it records the
+    round trip of every insert and cancel until the gateway's response.
+    The gateway looks up the client connection by request id alone, so every trader uses its own id range.
+    """
+
+    def __init__(self, socket_fd: socket.socket, ip_address: IpAddress, close_callback: Callable[[], None], trader_index: int, flow: Optional[OrderFlow], seed: int, max_in_flight: int, insert_latency: LatencyHistogram, cancel_latency: LatencyHistogram):
+        super().__init__(socket_fd, ip_address, close_callback)
+        self.username = f'trader_{trader_index:03d}'
+        self.flow = flow
+        self.rng = random.Random(seed * 1000003 + trader_index)
+        self.max_in_flight = max_in_flight
+        self.insert_latency = insert_latency
+        self.cancel_latency = cancel_latency
+        self.next_request_id = trader_index << REQUEST_ID_BITS
+        self.logged_in = False
+        self.pending_inserts: Dict[int, Tuple[int, InsertOrderRequest]] = {}
+        self.pending_cancels: Dict[int, int] = {}
+        self.resting_orders: List[Tuple[str, int]] = []
+        self.rejected = 0
+        self.skipped = 0
+        self.on_insert_response: Optional[Callable[[InsertOrderRequest, InsertOrderResponse], None]] = None
+        self.dispatcher = MessageDispatcher()
+        self.dispatcher.register(RISK_LIMITS_SERVICE, RiskLimitsMessageType.LOGIN_RESPONSE, LoginResponse, self.__on_login_response)
+        self.dispatcher.register(RISK_LIMITS_SERVICE, RiskLimitsMessageType.INSERT_ORDER_RESPONSE, InsertOrderResponse, self.__on_insert_order_response)
+        self.dispatcher.register(RISK_LIMITS_SERVICE, RiskLimitsMessageType.CANCEL_ORDER_RESPONSE, CancelOrderResponse, self.__on_cancel_order_response)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self.pending_inserts) + len(self.pending_cancels)
+
+    def __request_id(self) -> int:
+        self.next_request_id += 1
+        return self.next_request_id
+
+    def login(self):
+        self.send_message(RiskLimitsMessageType.LOGIN_REQUEST, LoginRequest(request_id=self.__request_id(), username=self.username))
+
+    def send_orders(self, operations: int):
+        flow = self.flow
+        rng = self.rng
+        for _ in range(operations):
+            if self.in_flight >= self.max_in_flight:
+                self.skipped += 1
+                continue
+            if self.resting_orders and rng.random() < flow.cancel_ratio:
+                index = rng.randrange(len(self.resting_orders))
+                instrument_symbol, order_id = self.resting_orders[index]
+                self.resting_orders[index] = self.resting_orders[-1]
+                self.resting_orders.pop()
+                self.send_cancel(instrument_symbol, order_id)
+                continue
+            side = Side.BUY if rng.random() < 0.5 else Side.SELL
+            if rng.random() < flow.aggressive_ratio:
+                distance = -1 - rng.randrange(3)  # Through the opposite touch
+            else:
+                distance = 1 + int(rng.expovariate(1 / flow.passive_depth_ticks))
+            price_ticks = flow.mid_ticks - distance if side == Side.BUY else flow.mid_ticks + distance
+            self.send_insert(rng.choice(flow.symbols), side, to_price(price_ticks, flow.tick_size), rng.randint(1, flow.max_quantity))
+
+    def send_insert(self, instrument_symbol: str, side: Side, price: float, quantity: int) -> InsertOrderRequest:
+        request = InsertOrderRequest(request_id=self.__request_id(), instrument_symbol=instrument_symbol, side=side, price=price, quantity=quantity)
+        self.pending_inserts[request.request_id] = (time.perf_counter_ns(), request)
+        self.send_message(RiskLimitsMessageType.INSERT_ORDER_REQUEST, request)
+        return request
+
+    def send_cancel(self, instrument_symbol: str, order_id: int):
+        request = CancelOrderRequest(request_id=self.__request_id(), instrument_symbol=instrument_symbol, order_id=order_id)
+        self.pending_cancels[request.request_id] = time.perf_counter_ns()
+        self.send_message(RiskLimitsMessageType.CANCEL_ORDER_REQUEST, request)
+
+    def handle_message(self, message_type: int, message: bytes) -> None:
+        self.dispatcher.dispatch(RISK_LIMITS_SERVICE, message_type, message)
+
+    def __on_login_response(self, response: LoginResponse):
+        if response.error_message:
+            logger.error(f'{self.username} failed to log in: {response.error_message}')
+        self.logged_in = not response.error_message
+
+    def __on_insert_order_response(self, response: InsertOrderResponse):
+        sent = self.pending_inserts.pop(response.request_id, None)
+        if sent is None:
+            return
+        sent_ns, request = sent
+        self.insert_latency.record(time.perf_counter_ns() - sent_ns)
+        if response.error_message:
+            self.rejected += 1
+            logger.debug(f'{self.username} insert rejected: {response.error_message}')
+        elif response.traded_quantity < request.quantity:
+            self.resting_orders.append((request.instrument_symbol, response.order_id))
+        if self.on_insert_response is not None:
+            self.on_insert_response(request, response)
+
+    def __on_cancel_order_response(self, response: CancelOrderResponse):
+        sent_ns = self.pending_cancels.pop(response.request_id, None)
+        if sent_ns is None:
+            return
+        self.cancel_latency.record(time.perf_counter_ns() - sent_ns)
+        if response.error_message:
+            self.rejected += 1  # Usually an order that was filled while the cancel was on its way
+
+    def on_disconnect(self) -> None:
+        logger.warning(f'{self.username} disconnected from the risk gateway')
+
+class SubscriberClient(ConnectionHandler):
+    """
+    Market data client of the info service subscribed to top of book. Records how long each OnTopOfBook took from
+    being stamped by the info service to being read here, using the wall clock shared by all threads of the process.
+    """
+
+    def __init__(self, socket_fd: socket.socket, ip_address: IpAddress, close_callback: Callable[[], None], name: str, publish_latency: Optional[LatencyHistogram]):
+        super().__init__(socket_fd, ip_address, close_callback)
+        self.name = name
+        self.publish_latency = publish_latency
+        self.next_request_id = 0
+        self.subscribed = 0
+        self.top_of_book_updates = 0
+        self.trades = 0
+        self.on_top_of_book: Optional[Callable[[OnTopOfBook], None]] = None
+        self.on_create_instrument_response: Optional[Callable[[CreateInstrumentResponse], None]] = None
+        self.dispatcher = MessageDispatcher()
+        self.dispatcher.register(INFO_SERVICE, InfoMessageType.LOGIN_RESPONSE, LoginResponse, self.__on_login_response)
+        self.dispatcher.register(INFO_SERVICE, InfoMessageType.CREATE_INSTRUMENT_RESPONSE, CreateInstrumentResponse, self.__on_create_instrument_response)
+        self.dispatcher.register(INFO_SERVICE, InfoMessageType.ORDER_BOOK_SUBSCRIBE_RESPONSE, OrderBookSubscribeResponse, self.__on_subscribe_response)
+        self.dispatcher.register(INFO_SERVICE, InfoMessageType.ON_TOP_OF_BOOK, OnTopOfBook, self.__on_top_of_book)
+        self.dispatcher.register(INFO_SERVICE, InfoMessageType.ON_INSTRUMENT, OnInstrument, self.__on_instrument)
+        self.dispatcher.register(INFO_SERVICE, InfoMessageType.ON_TRADE, OnTrade, self.__on_trade)
+
+    def __request_id(self) -> int:
+        self.next_request_id += 1
+        return self.next_request_id
+
+    def login(self):
+        self.send_message(InfoMessageType.LOGIN_REQUEST, LoginRequest(request_id=self.__request_id(), username=self.name))
+
+    def create_instrument(self, instrument_symbol: str, tick_size: float):
+        request = CreateInstrumentRequest(request_id=self.__request_id(), instrument=Instrument(symbol=instrument_symbol), tick_size=tick_size)
+        self.send_message(InfoMessageType.CREATE_INSTRUMENT_REQUEST, request)
+
+    def subscribe(self, instrument_symbol: str):
+        request = OrderBookSubscribeRequest(request_id=self.__request_id(), instrument_symbol=instrument_symbol, subscription_type=SubscriptionType.TOP_OF_BOOK)
+        self.send_message(InfoMessageType.ORDER_BOOK_SUBSCRIBE_REQUEST, request)
+
+    def handle_message(self, message_type: int, message: bytes) -> None:
+        self.dispatcher.dispatch(INFO_SERVICE, message_type, message)
+
+    def __on_login_response(self, response: LoginResponse):
+        if response.error_message:
+            logger.error(f'{self.name} failed to log in: {response.error_message}')
+
+    def __on_create_instrument_response(self, response: CreateInstrumentResponse):
+        if self.on_create_instrument_response is not None:
+            self.on_create_instrument_response(response)
+
+    def __on_subscribe_response(self, response: OrderBookSubscribeResponse):
+        if response.error_message:
+            logger.error(f'{self.name} failed to subscribe: {response.error_message}')
+        else:
+            self.subscribed += 1
+
+    def __on_top_of_book(self, message: OnTopOfBook):
+        self.top_of_book_updates += 1
+        if self.publish_latency is not None:
+            self.publish_latency.record(time.time_ns() - message.timestamp * 1000)
+        if self.on_top_of_book is not None:
+            self.on_top_of_book(message)
+
+    def __on_instrument(self, message: OnInstrument):
+        return
+
+    def __on_trade(self, message: OnTrade):
+        self.trades += 1
+
+    def on_disconnect(self) -> None:
+        logger.warning(f'{self.name} disconnected from the info service')
+
+class MarketDataProbe:
+    """
+    Measures insert-to-OnTopOfBook latency on an instrument of its own, so that the rest of the flow cannot hide
+    the probe order. One probe is in flight at a time: a bid whose quantity is its sequence number is inserted
+    through the risk gateway and timed until a top of book showing it arrives, then cancelled and timed until
+    the bid is gone.
+    """
+    PRICE = 100.0
+
+    def __init__(self, trader: TraderClient, subscriber: SubscriberClient, instrument_symbol: str, insert_latency: LatencyHistogram, cancel_latency: LatencyHistogram, call_later: Callable[[float, Callable[[], None]], object], interval_seconds: float, timeout_seconds: float=1.0):
+        self.trader = trader
+        self.subscriber = subscriber
+        self.instrument_symbol = instrument_symbol
+        self.insert_latency = insert_latency
+        self.cancel_latency = cancel_latency
+        self.call_later = call_later
+        self.interval_seconds = interval_seconds
+        self.timeout_seconds = timeout_seconds
+        self.sequence = 0
+        self.lost = 0
+        self.running = False
+        self.__inserted_ns: Optional[int] = None
+        self.__cancelled_ns: Optional[int] = None
+        self.__order_id: Optional[int] = None
+        self.__seen = False
+        trader.on_insert_response = self.__on_insert_response
+        subscriber.on_top_of_book = self.__on_top_of_book
+
+    def start(self):
+        self.running = True
+        self.__send_probe()
+
+    def stop(self):
+        self.running = False
+
+    def __send_probe(self):
+        if not self.running:
+            return
+        self.sequence += 1
+        self.__order_id = None
+        self.__seen = False
+        self.__cancelled_ns = None
+        self.__inserted_ns = time.perf_counter_ns()
+        self.trader.send_insert(self.instrument_symbol, Side.BUY, self.PRICE, self.sequence)
+        sequence = self.sequence
+        self.call_later(self.timeout_seconds, lambda: self.__on_timeout(sequence))
+
+    def __on_timeout(self, sequence: int):
+        if sequence == self.sequence and (self.__inserted_ns is not None or self.__cancelled_ns is not None):
+            self.lost += 1
+            self.__inserted_ns = self.__cancelled_ns = None
+            if self.__order_id is not None:
+                self.trader.send_cancel(self.instrument_symbol, self.__order_id)
+            self.call_later(self.interval_seconds, self.__send_probe)
+
+    def __on_insert_response(self, request: InsertOrderRequest, response: InsertOrderResponse):
+        if request.instrument_symbol != self.instrument_symbol or request.quantity != self.sequence or response.error_message:
+            return
+        self.__order_id = response.order_id
+        self.trader.resting_orders.clear()  # The probe cancels its own orders
+        self.__cancel_if_seen()
+
+    def __on_top_of_book(self, message: OnTopOfBook):
+        now_ns = time.perf_counter_ns()
+        if self.__inserted_ns is not None and message.HasField('best_bid') and message.best_bid.quantity == self.sequence:
+            self.insert_latency.record(now_ns - self.__inserted_ns)
+            self.__inserted_ns = None
+            self.__seen = True
+            self.__cancel_if_seen()
+        elif self.__cancelled_ns is not None and not message.HasField('best_bid'):
+            self.cancel_latency.record(now_ns - self.__cancelled_ns)
+            self.__cancelled_ns = None
+            self.call_later(self.interval_seconds, self.__send_probe)
+
+    def __cancel_if_seen(self):
+        if self.__seen and self.__order_id is not None:
+            self.__seen = False
+            self.__cancelled_ns = time.perf_counter_ns()
+            self.trader.send_cancel(self.instrument_symbol, self.__order_id)
@@ -0,0 +1,54 @@
+from array import array
+from typing import Dict, List, Tuple
+
+PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+
+class LatencyHistogram:
+    """Latency samples in nanoseconds, summarised as percentiles and as a histogram of power of two microsecond buckets"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.samples = array('q')
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def record(self, latency_ns: int):
+        self.samples.append(latency_ns)
+
+    def summary(self) -> Dict[str, float]:
+        if not self.samples:
+            return {'count': 0}
+        ordered = sorted(self.samples)
+        summary = {'count': len(ordered), 'mean_us': round(sum(ordered) / len(ordered) / 1e3, 1)}
+        for percentile in PERCENTILES:
+            summary[f'p{percentile:g}_us'] = round(ordered[min(len(ordered) - 1, int(percentile / 100 * len(ordered)))] / 1e3, 1)
+        summary['max_us'] = round(ordered[-1] / 1e3, 1)
+        return summary
+
+    def buckets(self) -> List[Tuple[int, int]]:
+        """(upper bound in microseconds, samples) for every bucket from the fastest to the slowest non-empty one"""
+        counts: Dict[int, int] = {}
+        for latency_ns in self.samples:
+            upper_bound_us = 1 << max(0, (latency_ns // 1000).bit_length())
+            counts[upper_bound_us] = counts.get(upper_bound_us, 0) + 1
+        if not counts:
+            return []
+        bounds = sorted(counts)
+        result = []
+        upper_bound_us = bounds[0]
+        while upper_bound_us <= bounds[-1]:
+            result.append((upper_bound_us, counts.get(upper_bound_us, 0)))
+            upper_bound_us <<= 1
+        return result
+
+    def render(self, width: int=50) -> str:
+        buckets = self.buckets()
+        if not buckets:
+            return f'{self.name}: no samples'
+        summary = self.summary()
+        lines = [f"{self.name}: {summary['count']} samples, " + ', '.join((f'{key[:-3]} {value}us' for key, value in summary.items() if key.endswith('_us')))]
+        most = max((count for _, count in buckets))
+        for upper_bound_us, count in buckets:
+            lines.append(f"  <{upper_bound_us:>9}us {count:>9} {'#' * round(width * count / most)}")
+        return '\n'.join(lines)
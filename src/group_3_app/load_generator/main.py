@@ -0,0 +1,218 @@
+"""
+End-to-end loopback load generator for the order book, info and risk gateway services.
+
+Starts the three services on localhost, each with its own TcpConnectionManager on its own thread, wired together
+over TCP as in production. Then connects N trader clients to the risk gateway and M top of book subscribers to
+the info service, and replays seeded order flow from the traders for a fixed duration.
+
+Reports latency histograms for:
+- insert and cancel round trips through the risk gateway
+- insert to OnTopOfBook and cancel to OnTopOfBook, measured by a probe on an instrument of its own
+- info service stamp to subscriber read of every OnTopOfBook
+
+All clients share one event loop thread, and every thread shares the interpreter, so absolute numbers include
+GIL contention. Compare runs on the same machine rather than reading them as production latency.
+"""
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from connection.fan_out import FanOutWriterPool
+from connection.ip_address import IpAddress
+from connection.tcp_connection_manager import TcpConnectionManager
+from group_3_app.common.service_names import INFO_SERVICE, ORDER_BOOK_SERVICE
+from group_3_app.info_service.info_service import InfoService
+from group_3_app.info_service.shared_top_of_book import SharedTopOfBookWriter
+from group_3_app.info_service.info_service_connection import InfoServiceConnectionHandler, InfoServiceConnectionHandlerFactory
+from group_3_app.load_generator.clients import MarketDataProbe, OrderFlow, SubscriberClient, TraderClient
+from group_3_app.load_generator.latency_histogram import LatencyHistogram
+from group_3_app.orderbook_service.orderbook_connection_handler import OrderBookConnectionHandlerFactory
+from group_3_app.orderbook_service.journal import Journal
+from group_3_app.orderbook_service.orderbook_service import OrderBookService
+from group_3_app.risk_limits.risk_limits_connection_handler import RiskLimitsConnectionHandler, RiskLimitsConnectionHandlerFactory
+from group_3_app.risk_limits.risk_limits_service import RiskLimitsService
+from generated.proto.common_pb2 import LoginRequest
+from generated.proto.info_pb2 import MessageType as InfoMessageType
+logger = logging.getLogger(__name__)
+PROBE_SYMBOL = 'PROBE'
+LOOP_TIMEOUT_SECONDS = 0.05
+TICK_SECONDS = 0.001
+
+class _ServiceThread(threading.Thread):
+
+    def __init__(self, name: str, connection_manager: TcpConnectionManager):
+        super().__init__(name=name, daemon=True)
+        self.connection_manager = connection_manager
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.connection_manager.wait_for_events(LOOP_TIMEOUT_SECONDS)
+
+class Services:
+    """The order book service, the info service and the risk gateway, each serving from its own thread"""
+
+    def __init__(self, host: str, base_port: int, journal_directory: Optional[str]=None, shared_top_of_book_path: Optional[str]=None, fan_out_writers: int=0):
+        self.order_book_address = IpAddress(host=host, port=base_port)
+        self.info_address = IpAddress(host=host, port=base_port + 1)
+        self.risk_limits_address = IpAddress(host=host, port=base_port + 2)
+        self.threads: List[_ServiceThread] = []
+
+        order_book_manager = TcpConnectionManager()
+        order_book_factory = OrderBookConnectionHandlerFactory()
+        self.journal = None
+        if journal_directory is not None:
+            self.journal = Journal(journal_directory)
+            self.journal.schedule_commits(order_book_manager)
+        order_book_factory.service = OrderBookService(order_book_factory, order_book_manager.clock, self.journal)
+        order_book_manager.listen(self.order_book_address, order_book_factory)
+        self.threads.append(_ServiceThread('order-book-service', order_book_manager))
+
+        info_manager = TcpConnectionManager()
+        info_factory = InfoServiceConnectionHandlerFactory()
+        self.shared_top_of_book = None if shared_top_of_book_path is None else SharedTopOfBookWriter(shared_top_of_book_path)
+        self.writer_pool = FanOutWriterPool(fan_out_writers, 'info-fan-out-writer') if fan_out_writers else None
+        self.info_service = info_factory.service = InfoService(info_factory, self.writer_pool, clock=info_manager.clock, shared_top_of_book=self.shared_top_of_book)
+        self.info_service.schedule_expiry(info_manager)
+        info_manager.listen(self.info_address, info_factory)
+        self.info_service.orderbook_connection_handler = info_manager.connect(self.order_book_address, lambda socket_fd, ip_address, close_callback: InfoServiceConnectionHandler(socket_fd, ip_address, close_callback, self.info_service, ORDER_BOOK_SERVICE))
+        self.info_service.login_to_order_book_service()
+        self.threads.append(_ServiceThread('info-service', info_manager))
+
+        risk_limits_manager = TcpConnectionManager()
+        risk_limits_factory = RiskLimitsConnectionHandlerFactory()
+        self.risk_limits_service = risk_limits_factory.service = RiskLimitsService(risk_limits_factory, clock=risk_limits_manager.clock)
+        self.risk_limits_service.schedule_expiry(risk_limits_manager)
+        risk_limits_manager.listen(self.risk_limits_address, risk_limits_factory)
+        self.risk_limits_service.orderbook_connection_handler = risk_limits_manager.connect(self.order_book_address, lambda socket_fd, ip_address, close_callback: RiskLimitsConnectionHandler(socket_fd, ip_address, close_callback, self.risk_limits_service, ORDER_BOOK_SERVICE))
+        self.risk_limits_service.login_to_order_book_service()
+        info_connection = risk_limits_manager.connect(self.info_address, lambda socket_fd, ip_address, close_callback: RiskLimitsConnectionHandler(socket_fd, ip_address, close_callback, self.risk_limits_service, INFO_SERVICE))
+        info_connection.send_message(InfoMessageType.LOGIN_REQUEST, LoginRequest(request_id=0, username='risk_gateway'))
+        self.threads.append(_ServiceThread('risk-gateway', risk_limits_manager))
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        for thread in self.threads:
+            thread.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        if self.writer_pool is not None:
+            self.writer_pool.close()
+        for thread in self.threads:
+            thread.connection_manager.__exit__(None, None, None)
+        if self.journal is not None:
+            self.journal.close()
+        if self.shared_top_of_book is not None:
+            self.shared_top_of_book.close()
+
+def _run_until(connection_manager: TcpConnectionManager, condition: Callable[[], bool], timeout_seconds: float, what: str):
+    deadline = time.monotonic() + timeout_seconds
+    while not condition():
+        if time.monotonic() > deadline:
+            raise SystemExit(f'Timed out waiting for {what}')
+        connection_manager.wait_for_events(LOOP_TIMEOUT_SECONDS)
+
+def run(args: argparse.Namespace) -> Dict:
+    services = Services(args.host, args.base_port, args.journal, args.shared_top_of_book, args.fan_out_writers)
+    services.start()
+    histograms = {name: LatencyHistogram(name) for name in ('insert round trip', 'cancel round trip', 'insert to top of book', 'cancel to top of book', 'top of book publish to read')}
+    symbols = tuple((f'SYM{index:03d}' for index in range(args.instruments)))
+    flow = OrderFlow(symbols, tick_size=args.tick_size, aggressive_ratio=args.aggressive_ratio, cancel_ratio=args.cancel_ratio)
+    with TcpConnectionManager(high_water_mark_bytes=args.client_buffer_bytes) as client_manager:
+        admin = client_manager.connect(services.info_address, lambda socket_fd, ip_address, close_callback: SubscriberClient(socket_fd, ip_address, close_callback, 'admin', None))
+        created = []
+        admin.on_create_instrument_response = created.append
+        admin.login()
+        for instrument_symbol in symbols + (PROBE_SYMBOL,):
+            admin.create_instrument(instrument_symbol, args.tick_size)
+        _run_until(client_manager, lambda: len(created) == len(symbols) + 1, 10, 'the instruments to be created')
+        if any((response.error_message for response in created)):
+            raise SystemExit(f'Failed to create instruments: {[response.error_message for response in created]}')
+        # The gateway learns about instruments from its own info service feed; read its set only to know when it has caught up
+        _run_until(client_manager, lambda: len(services.risk_limits_service.instrument_symbol_to_order_book_id) == len(symbols) + 1, 10, 'the risk gateway to learn the instruments')
+
+        traders = [client_manager.connect(services.risk_limits_address, lambda socket_fd, ip_address, close_callback, index=index: TraderClient(socket_fd, ip_address, close_callback, index, flow, args.seed, args.max_in_flight, histograms['insert round trip'], histograms['cancel round trip'])) for index in range(1, args.traders + 1)]
+        subscribers = [client_manager.connect(services.info_address, lambda socket_fd, ip_address, close_callback, index=index: SubscriberClient(socket_fd, ip_address, close_callback, f'subscriber_{index:03d}', histograms['top of book publish to read'])) for index in range(args.subscribers)]
+        probe_trader = client_manager.connect(services.risk_limits_address, lambda socket_fd, ip_address, close_callback: TraderClient(socket_fd, ip_address, close_callback, 0, None, args.seed, 2, LatencyHistogram('probe insert'), LatencyHistogram('probe cancel')))
+        probe_subscriber = client_manager.connect(services.info_address, lambda socket_fd, ip_address, close_callback: SubscriberClient(socket_fd, ip_address, close_callback, 'probe', None))
+        for client in traders + subscribers + [probe_trader, probe_subscriber]:
+            client.login()
+        for subscriber in subscribers:
+            for instrument_symbol in symbols:
+                subscriber.subscribe(instrument_symbol)
+        probe_subscriber.subscribe(PROBE_SYMBOL)
+        _run_until(client_manager, lambda: all((trader.logged_in for trader in traders + [probe_trader])) and all((subscriber.subscribed == len(symbols) for subscriber in subscribers)) and probe_subscriber.subscribed == 1, 10, 'clients to log in and subscribe')
+
+        probe = MarketDataProbe(probe_trader, probe_subscriber, PROBE_SYMBOL, histograms['insert to top of book'], histograms['cancel to top of book'], client_manager.call_later, args.probe_interval)
+        rate_per_trader = args.rate / max(1, args.traders)
+        sent_per_trader = [0]
+
+        def send_orders():
+            # Paced by elapsed time rather than by timer runs, which are skipped when the loop falls behind
+            operations = int(rate_per_trader * (time.perf_counter() - started)) - sent_per_trader[0]
+            if operations > 0:
+                sent_per_trader[0] += operations
+                for trader in traders:
+                    trader.send_orders(operations)
+        logger.warning(f'Replaying {args.rate} operations/s from {args.traders} traders on {len(symbols)} instruments to {args.subscribers} subscribers for {args.duration}s')
+        started = time.perf_counter()
+        timer = client_manager.call_every(TICK_SECONDS, send_orders)
+        probe.start()
+        _run_until(client_manager, lambda: time.perf_counter() - started >= args.duration, args.duration + 1, 'the run to finish')
+        timer.cancel()
+        probe.stop()
+        elapsed = time.perf_counter() - started
+        try:
+            _run_until(client_manager, lambda: not any((trader.in_flight for trader in traders)), args.drain, 'in-flight requests to drain')
+        except SystemExit as e:
+            logger.warning(str(e))
+        operations = sum((len(histograms[name]) for name in ('insert round trip', 'cancel round trip')))
+        results = {'settings': {key: value for key, value in vars(args).items() if key != 'output'}, 'elapsed_seconds': round(elapsed, 3), 'completed_operations_per_second': round(operations / elapsed), 'rejected': sum((trader.rejected for trader in traders)), 'skipped_at_max_in_flight': sum((trader.skipped for trader in traders)), 'still_in_flight': sum((trader.in_flight for trader in traders)), 'top_of_book_updates_per_subscriber': round(sum((subscriber.top_of_book_updates for subscriber in subscribers)) / max(1, len(subscribers))), 'trades_per_subscriber': round(sum((subscriber.trades for subscriber in subscribers)) / max(1, len(subscribers))), 'probes_lost': probe.lost, 'latency': {name: histogram.summary() for name, histogram in histograms.items()}}
+    services.stop()
+    for histogram in histograms.values():
+        print(histogram.render(), file=sys.stderr)
+    return results
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--traders', type=int, default=4, help='Trader clients connected to the risk gateway')
+    parser.add_argument('--subscribers', type=int, default=4, help='Top of book subscribers connected to the info service, each subscribed to every instrument')
+    parser.add_argument('--instruments', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=2000, help='Operations per second over all traders')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of order flow')
+    parser.add_argument('--aggressive-ratio', type=float, default=0.1, help='Share of inserts priced through the opposite touch')
+    parser.add_argument('--cancel-ratio', type=float, default=0.4, help='Share of operations cancelling a resting order')
+    parser.add_argument('--tick-size', type=float, default=0.01)
+    parser.add_argument('--max-in-flight', type=int, default=100, help='Requests a trader may have awaiting a response before it skips operations')
+    parser.add_argument('--probe-interval', type=float, default=0.01, help='Seconds between market data probes')
+    parser.add_argument('--drain', type=float, default=5, help='Seconds to wait for in-flight requests after the run')
+    parser.add_argument('--client-buffer-bytes', type=int, default=64 * 1024 * 1024, help='Outbound queue limit of each client connection')
+    parser.add_argument('--journal', help='Journal the order book service into this empty or new directory, group committed once per event loop iteration')
+    parser.add_argument('--shared-top-of-book', help='Also have the info service publish top of book to this shared memory file, e.g. under /dev/shm')
+    parser.add_argument('--fan-out-writers', type=int, default=0, help='Writer threads that send the info service\'s market data to subscribers; 0 sends from its event loop thread')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--base-port', type=int, default=52301, help='Order book service port; info and risk gateway use the next two')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('-o', '--output', type=Path, help='Write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+    if args.journal is not None and Path(args.journal).is_dir() and any(Path(args.journal).iterdir()):
+        # The services start without order books, so journalling after an earlier run would reuse its order ids
+        parser.error(f'--journal directory {args.journal} is not empty')
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logging.getLogger().setLevel(args.log_level)  # The services configure the root logger on import
+    results = run(args)
+    encoded = json.dumps(results, indent=2)
+    if args.output is None:
+        print(encoded)
+    else:
+        args.output.write_text(encoded + '\n')
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+import logging
+import mmap
+import os
+import re
+import struct
+import zlib
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Union
+from generated.proto.common_pb2 import Side
+from group_3_app.common.order import Order
+from group_3_app.common.trade import Trade
+logger = logging.getLogger(__name__)
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+_SEGMENT_NAME = re.compile('^journal-(\\d{12})\\.seg$')
+_SNAPSHOT_NAME = re.compile('^snapshot-(\\d{12})\\.bin$')
+# Every record is framed as (payload length, CRC-32 of the payload); a zero length marks the unwritten end of a segment
+_FRAME = struct.Struct('<II')
+_SNAPSHOT_STATE = 0
+_BOOK_CREATED = 1
+_ORDER_INSERTED = 2
+_ORDER_CANCELLED = 3
+_TRADE = 4
+_SNAPSHOT_STATE_RECORD = struct.Struct('<BQQQQ')
+# Each followed by a variable length field whose length is the record's last field:
+# the serialized Instrument of a book, the UTF-8 username of an order
+_BOOK_CREATED_RECORD = struct.Struct('<BQdH')
+_ORDER_INSERTED_RECORD = struct.Struct('<BQQqBqqB')
+_ORDER_CANCELLED_RECORD = struct.Struct('<BQQq')
+_TRADE_RECORD = struct.Struct('<BQQqQQqqB')
+_MAX_RECORD_SIZE = _FRAME.size + max(_ORDER_INSERTED_RECORD.size + 0xFF, _BOOK_CREATED_RECORD.size + 0xFFFF)
+
+class JournalError(Exception):
+    pass
+
+class SnapshotState(NamedTuple):
+    """Counters of the service when the snapshot was taken, and the first journal segment written after it"""
+    next_segment: int
+    last_book_id: int
+    last_order_id: int
+    last_trade_id: int
+
+class BookCreated(NamedTuple):
+    order_book_id: int
+    tick_size: float
+    instrument: bytes
+
+class OrderInserted(NamedTuple):
+    """An accepted order with its quantity before matching, or a resting order with its remaining quantity in a snapshot"""
+    order_id: int
+    order_book_id: int
+    timestamp: int
+    side: Side
+    price_ticks: int
+    quantity: int
+    on_behalf_of_username: str
+
+class OrderCancelled(NamedTuple):
+    order_id: int
+    order_book_id: int
+    timestamp: int
+
+class TradeExecuted(NamedTuple):
+    trade_id: int
+    order_book_id: int
+    timestamp: int
+    buy_order_id: int
+    sell_order_id: int
+    price_ticks: int
+    quantity: int
+    aggressor_side: Side
+JournalRecord = Union[SnapshotState, BookCreated, OrderInserted, OrderCancelled, TradeExecuted]
+
+class Journal:
+    """
+    Append-only binary journal of the order book service, written through a memory-mapped, preallocated segment file.
+    Appends are plain stores into the mapping, so they survive a crash of the process as soon as they are made; commit
+    msyncs the pages written since the previous commit to survive a crash of the machine as well. Calling commit once
+    per event loop iteration (see schedule_commits) makes it a group commit: one msync covers every order handled in
+    that iteration, at the price of acknowledgements leaving up to one iteration before their record is on disk.
+
+    Each process run appends to a fresh segment, so a torn record at the end of the previous run's segment is never
+    written over. write_snapshot stores the complete state and deletes the segments it covers; recovery_records
+    yields the latest snapshot followed by every record journalled after it.
+    """
+
+    def __init__(self, directory: str, segment_size: int=DEFAULT_SEGMENT_SIZE, sync: bool=True):
+        """sync=False skips the msync in commit, leaving durability against machine crashes to the kernel's writeback"""
+        if segment_size < _MAX_RECORD_SIZE:
+            raise ValueError(f'Segment size must be at least {_MAX_RECORD_SIZE} bytes, got {segment_size}')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync = sync
+        self.__usernames: Dict[str, bytes] = {}
+        self.__segment_number = max(self.__segment_numbers(), default=0) + 1
+        self.__fd: Optional[int] = None
+        self.__map: Optional[mmap.mmap] = None
+        self.__view: Optional[memoryview] = None
+        self.__offset = 0
+        self.__committed_offset = 0
+        self.__open_segment()
+
+    def __path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def __segment_numbers(self) -> List[int]:
+        return sorted((int(match.group(1)) for match in map(_SEGMENT_NAME.match, os.listdir(self.directory)) if match))
+
+    def __snapshot_numbers(self) -> List[int]:
+        return sorted((int(match.group(1)) for match in map(_SNAPSHOT_NAME.match, os.listdir(self.directory)) if match))
+
+    def __open_segment(self):
+        fd = os.open(self.__path(f'journal-{self.__segment_number:012d}.seg'), os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            # Reserving the blocks up front keeps a full disk from surfacing as a SIGBUS on a store into the mapping
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, self.segment_size)
+            else:
+                os.ftruncate(fd, self.segment_size)
+            self.__map = mmap.mmap(fd, self.segment_size)
+        except OSError:
+            os.close(fd)
+            raise
+        self.__fd = fd
+        self.__view = memoryview(self.__map)
+        self.__offset = 0
+        self.__committed_offset = 0
+
+    def __close_segment(self):
+        self.commit()
+        self.__view.release()
+        self.__map.close()
+        os.close(self.__fd)
+        self.__view = self.__map = self.__fd = None
+
+    def roll(self) -> int:
+        """Commits the current segment and continues in a new one. Returns the number of the new segment."""
+        self.__close_segment()
+        self.__segment_number += 1
+        self.__open_segment()
+        return self.__segment_number
+
+    def __reserve(self, size: int) -> int:
+        offset = self.__offset
+        if offset + size > self.segment_size:
+            self.roll()
+            offset = 0
+        self.__offset = offset + size
+        return offset
+
+    def __seal(self, offset: int, size: int):
+        view = self.__view
+        _FRAME.pack_into(view, offset, size - _FRAME.size, zlib.crc32(view[offset + _FRAME.size:offset + size]))
+
+    def book_created(self, order_book_id: int, tick_size: float, instrument: bytes):
+        payload = _encode(BookCreated(order_book_id, tick_size, instrument))
+        size = _FRAME.size + len(payload)
+        offset = self.__reserve(size)
+        self.__view[offset + _FRAME.size:offset + size] = payload
+        self.__seal(offset, size)
+
+    def order_inserted(self, order: Order, quantity: int):
+        """quantity is the order's quantity before matching; order.quantity may already be what is left after it"""
+        username = self.__username_bytes(order.on_behalf_of_username)
+        size = _FRAME.size + _ORDER_INSERTED_RECORD.size + len(username)
+        offset = self.__reserve(size)
+        view = self.__view
+        username_offset = offset + _FRAME.size + _ORDER_INSERTED_RECORD.size
+        _ORDER_INSERTED_RECORD.pack_into(view, offset + _FRAME.size, _ORDER_INSERTED, order.order_id, order.order_book_id, order.timestamp, order.side, order.price_ticks, quantity, len(username))
+        view[username_offset:username_offset + len(username)] = username
+        self.__seal(offset, size)
+
+    def __username_bytes(self, username: Optional[str]) -> bytes:
+        encoded = self.__usernames.get(username)
+        if encoded is None:
+            encoded = (username or '').encode()
+            if len(encoded) > 255:
+                raise JournalError(f'Username of {len(encoded)} bytes cannot be journalled')
+            self.__usernames[username] = encoded
+        return encoded
+
+    def order_cancelled(self, order_id: int, order_book_id: int, timestamp: int):
+        size = _FRAME.size + _ORDER_CANCELLED_RECORD.size
+        offset = self.__reserve(size)
+        _ORDER_CANCELLED_RECORD.pack_into(self.__view, offset + _FRAME.size, _ORDER_CANCELLED, order_id, order_book_id, timestamp)
+        self.__seal(offset, size)
+
+    def trade(self, trade: Trade):
+        size = _FRAME.size + _TRADE_RECORD.size
+        offset = self.__reserve(size)
+        _TRADE_RECORD.pack_into(self.__view, offset + _FRAME.size, _TRADE, trade.trade_id, trade.order_book_id, trade.timestamp, trade.buy_order_id, trade.sell_order_id, trade.price_ticks, trade.quantity, trade.aggressor_side)
+        self.__seal(offset, size)
+
+    def commit(self):
+        """msyncs the pages written since the last commit; cheap when nothing was appended"""
+        if self.__offset == self.__committed_offset:
+            return
+        if self.sync:
+            start = self.__committed_offset - self.__committed_offset % mmap.PAGESIZE
+            self.__map.flush(start, self.__offset - start)
+        self.__committed_offset = self.__offset
+
+    def schedule_commits(self, connection_manager):
+        """Group commits at the end of every iteration of the connection manager's event loop"""
+        connection_manager.add_iteration_callback(self.commit)
+
+    def write_snapshot(self, state: SnapshotState, records: Iterable[JournalRecord]):
+        """
+        Durably writes a snapshot holding state and records, then deletes the older snapshots and the segments
+        before state.next_segment, which the snapshot makes redundant. Roll the journal first so that no record
+        after the snapshot ends up in a deleted segment.
+        """
+        if state.next_segment > self.__segment_number:
+            raise JournalError(f'Snapshot cannot cover segment {state.next_segment}, the journal is at segment {self.__segment_number}')
+        self.commit()
+        encoded = bytearray()
+        for record in (state, *records):
+            payload = _encode(record)
+            encoded += _FRAME.pack(len(payload), zlib.crc32(payload))
+            encoded += payload
+        path = self.__path(f'snapshot-{state.next_segment:012d}.bin')
+        with open(path + '.tmp', 'wb') as snapshot_file:
+            snapshot_file.write(encoded)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(path + '.tmp', path)
+        self.__sync_directory()
+        for snapshot_number in self.__snapshot_numbers():
+            if snapshot_number < state.next_segment:
+                os.remove(self.__path(f'snapshot-{snapshot_number:012d}.bin'))
+        for segment_number in self.__segment_numbers():
+            if segment_number < state.next_segment:
+                os.remove(self.__path(f'journal-{segment_number:012d}.seg'))
+
+    def __sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def recovery_records(self) -> Iterator[JournalRecord]:
+        """
+        The latest snapshot, starting with its SnapshotState, then the records of every segment written after it
+        in order. A segment ends at its first unwritten or torn record.
+        """
+        snapshot_numbers = self.__snapshot_numbers()
+        first_segment = 0
+        if snapshot_numbers:
+            first_segment = snapshot_numbers[-1]
+            with open(self.__path(f'snapshot-{first_segment:012d}.bin'), 'rb') as snapshot_file:
+                snapshot = snapshot_file.read()
+            yield from _decode_all(snapshot, f'snapshot {first_segment}', strict=True)
+        for segment_number in self.__segment_numbers():
+            if first_segment <= segment_number < self.__segment_number:
+                with open(self.__path(f'journal-{segment_number:012d}.seg'), 'rb') as segment_file:
+                    with mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ) as segment:
+                        yield from _decode_all(segment, f'segment {segment_number}', strict=False)
+
+    def close(self):
+        if self.__map is not None:
+            self.__close_segment()
+
+def _encode(record: JournalRecord) -> bytes:
+    if isinstance(record, OrderInserted):
+        username = (record.on_behalf_of_username or '').encode()
+        return _ORDER_INSERTED_RECORD.pack(_ORDER_INSERTED, record.order_id, record.order_book_id, record.timestamp, record.side, record.price_ticks, record.quantity, len(username)) + username
+    if isinstance(record, BookCreated):
+        if len(record.instrument) > 0xFFFF:
+            raise JournalError(f'Instrument of {len(record.instrument)} bytes cannot be journalled')
+        return _BOOK_CREATED_RECORD.pack(_BOOK_CREATED, record.order_book_id, record.tick_size, len(record.instrument)) + record.instrument
+    if isinstance(record, SnapshotState):
+        return _SNAPSHOT_STATE_RECORD.pack(_SNAPSHOT_STATE, *record)
+    if isinstance(record, OrderCancelled):
+        return _ORDER_CANCELLED_RECORD.pack(_ORDER_CANCELLED, *record)
+    if isinstance(record, TradeExecuted):
+        return _TRADE_RECORD.pack(_TRADE, *record)
+    raise JournalError(f'Cannot journal {type(record).__name__}')
+
+def _decode_all(buffer, source: str, strict: bool) -> Iterator[JournalRecord]:
+    """strict rejects a torn record instead of treating it as the end, for snapshots which are written atomically"""
+    offset = 0
+    while offset + _FRAME.size <= len(buffer):
+        length, crc = _FRAME.unpack_from(buffer, offset)
+        payload = buffer[offset + _FRAME.size:offset + _FRAME.size + length]
+        if length == 0 or len(payload) < length or zlib.crc32(payload) != crc:
+            if strict or length != 0:
+                message = f'Torn record at offset {offset} of {source}'
+                if strict:
+                    raise JournalError(message)
+                logger.warning(f'{message}, ignoring the rest of it')
+            return
+        yield _decode(payload, source, offset)
+        offset += _FRAME.size + length
+
+def _decode(payload: bytes, source: str, offset: int) -> JournalRecord:
+    record_type = payload[0]
+    if record_type == _ORDER_INSERTED:
+        _, order_id, order_book_id, timestamp, side, price_ticks, quantity, username_length = _ORDER_INSERTED_RECORD.unpack_from(payload)
+        username = payload[_ORDER_INSERTED_RECORD.size:_ORDER_INSERTED_RECORD.size + username_length].decode()
+        return OrderInserted(order_id, order_book_id, timestamp, side, price_ticks, quantity, username)
+    if record_type == _ORDER_CANCELLED:
+        return OrderCancelled(*_ORDER_CANCELLED_RECORD.unpack(payload)[1:])
+    if record_type == _TRADE:
+        return TradeExecuted(*_TRADE_RECORD.unpack(payload)[1:])
+    if record_type == _BOOK_CREATED:
+        _, order_book_id, tick_size, instrument_length = _BOOK_CREATED_RECORD.unpack_from(payload)
+        return BookCreated(order_book_id, tick_size, bytes(payload[_BOOK_CREATED_RECORD.size:_BOOK_CREATED_RECORD.size + instrument_length]))
+    if record_type == _SNAPSHOT_STATE:
+        return SnapshotState(*_SNAPSHOT_STATE_RECORD.unpack(payload)[1:])
+    raise JournalError(f'Unknown record type {record_type} at offset {offset} of {source}')
@@ -1,12 +1,16 @@
 import logging
 from connection.connection_handler import ConnectionHandler, ConnectionHandlerFactory
 from connection import message_codec
+from connection.message_codec import MESSAGE_TYPE_ATTRIBUTE
 from connection.ip_address import IpAddress
 import socket
 from typing import Callable, List, Optional, TypeVar
 from google.protobuf.message import Message
-from generated.proto.order_book_pb2 import CreateOrderBookRequest, CreateOrderBookResponse, InsertOrderRequest, InsertOrderResponse, CancelOrderRequest, CancelOrderResponse, MessageType
+from generated.proto.order_book_pb2 import CreateOrderBookRequest, CreateOrderBookResponse, InsertOrderRequest, InsertOrderResponse, CancelOrderRequest, CancelOrderResponse, BatchInsertOrderRequest, MassCancelRequest, MessageType
+from generated.proto.common_pb2 import LoginRequest, LoginResponse
 from group_3_app.common.connection_storer import ConnectionStorer
+from group_3_app.common.service_names import ORDER_BOOK_SERVICE
+from connection.message_dispatcher import MessageDispatcher
 from group_3_app.orderbook_service.orderbook_service import OrderBookService
 logger = logging.getLogger(__name__)
 ProtoMessage = TypeVar('ProtoMessage', bound=Message)
@@ -16,24 +20,56 @@ class OrderBookConnectionHandler(ConnectionHandler):
     def __init__(self, socket_fd, ip_address, close_callback, orderbook_service: OrderBookService):
         super().__init__(socket_fd, ip_address, close_callback)
         self.service = orderbook_service
+        self.dispatcher = MessageDispatcher()
+        self.dispatcher.register(ORDER_BOOK_SERVICE, MessageType.LOGIN_REQUEST, LoginRequest, self.__on_login_request)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, MessageType.CREATE_ORDER_BOOK_REQUEST, CreateOrderBookRequest, self.__on_create_order_book_request)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, MessageType.INSERT_ORDER_REQUEST, InsertOrderRequest, self.__on_insert_order_request)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, MessageType.CANCEL_ORDER_REQUEST, CancelOrderRequest, self.__on_cancel_order_request)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, MessageType.BATCH_INSERT_ORDER_REQUEST, BatchInsertOrderRequest, self.__on_batch_insert_order_request)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, MessageType.MASS_CANCEL_REQUEST, MassCancelRequest, self.__on_mass_cancel_request)
 
     def handle_message(self, message_type: int, message: bytes) -> None:
         try:
-            logger.info(f'Received message type {message_type} from {self.ip_address}')
-            if message_type == MessageType.CREATE_ORDER_BOOK_REQUEST:
-                request = self._deserialize_message(CreateOrderBookRequest, message)
-                response = self.service.create_order_book(request)
-                self.send_message(MessageType.CREATE_ORDER_BOOK_RESPONSE, response)
+            logger.info('Received message type %d from %s', message_type, self.ip_address, extra={MESSAGE_TYPE_ATTRIBUTE: message_type})
+            self.dispatcher.dispatch(ORDER_BOOK_SERVICE, message_type, message)
             return None
         except Exception as e:
             logger.exception(f'Error while handling message: {e}')
 
+    def __on_login_request(self, request: LoginRequest) -> None:
+        logger.info(f"User '{request.username}' logged in from {self.ip_address}")
+        self.send_message(MessageType.LOGIN_RESPONSE, LoginResponse(request_id=request.request_id, error_message=''))
+        # Changes broadcast before the login may already be queued to this connection; the snapshots tell by their sequence number
+        for snapshot in self.service.order_book_snapshots():
+            self.send_message(MessageType.ON_ORDER_BOOK_SNAPSHOT, snapshot)
+
+    def __on_create_order_book_request(self, request: CreateOrderBookRequest) -> None:
+        response = self.service.create_order_book(request)
+        self.send_message(MessageType.CREATE_ORDER_BOOK_RESPONSE, response)
+
+    def __on_insert_order_request(self, request: InsertOrderRequest) -> None:
+        response = self.service.insert_order(request)
+        self.send_message(MessageType.INSERT_ORDER_RESPONSE, response)
+
+    def __on_cancel_order_request(self, request: CancelOrderRequest) -> None:
+        response = self.service.cancel_order(request)
+        self.send_message(MessageType.CANCEL_ORDER_RESPONSE, response)
+
+    def __on_batch_insert_order_request(self, request: BatchInsertOrderRequest) -> None:
+        response = self.service.batch_insert_order(request)
+        self.send_message(MessageType.BATCH_INSERT_ORDER_RESPONSE, response)
+
+    def __on_mass_cancel_request(self, request: MassCancelRequest) -> None:
+        response = self.service.mass_cancel(request)
+        self.send_message(MessageType.MASS_CANCEL_RESPONSE, response)
+
     def on_disconnect(self) -> None:
         logger.info(f'Client {self.ip_address} disconnected')
 
 class OrderBookConnectionHandlerFactory(ConnectionHandlerFactory[OrderBookConnectionHandler], ConnectionStorer):
 
     def __init__(self):
+        super().__init__()
         self.connection_handlers = []
         self.service = None
 
@@ -55,5 +91,4 @@ class OrderBookConnectionHandlerFactory(ConnectionHandlerFactory[OrderBookConnec
         return None
 
     def broadcast_message(self, message_type: int, message: ProtoMessage):
-        for connection in self.connection_handlers:
-            connection.send_message(message_type, message)
+        self._broadcast_encoded(self.connection_handlers, message_type, message)
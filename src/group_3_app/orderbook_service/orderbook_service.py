@@ -1,44 +1,241 @@
-from generated.proto.order_book_pb2 import CreateOrderBookRequest, CreateOrderBookResponse, InsertOrderRequest, InsertOrderResponse, CancelOrderRequest, CancelOrderResponse, OnOrderBookCreated, OnOrderInserted, OnOrderCancelled, OnTrade, MessageType
-import time
-from typing import Dict, List
+from generated.proto.order_book_pb2 import CreateOrderBookRequest, CreateOrderBookResponse, InsertOrderRequest, InsertOrderResponse, CancelOrderRequest, CancelOrderResponse, BatchInsertOrderRequest, BatchInsertOrderResponse, InsertedOrder, MassCancelRequest, MassCancelResponse, OnOrderBookCreated, OnOrderInserted, OnOrderCancelled, OnOrdersInserted, OnOrdersCancelled, OnOrderBookSnapshot, OnTrade, MessageType
+from generated.proto.common_pb2 import Instrument, Side
+from typing import Dict, List, Optional
 from group_3_app.common.connection_storer import ConnectionStorer
 from group_3_app.common.order_book import OrderBook
 from group_3_app.common.order import Order
+from group_3_app.common.price import to_price, to_ticks
+from group_3_app.common.trade import Trade
+from group_3_app.orderbook_service.journal import BookCreated, Journal, JournalError, JournalRecord, OrderCancelled, OrderInserted, SnapshotState, TradeExecuted
+from group_3_app.orderbook_service.user_order_index import UserOrderIndex
+from connection.timer_wheel import SYSTEM_CLOCK, Clock
 
 class OrderBookService:
 
-    def __init__(self, connection_handler_factory: ConnectionStorer):
+    def __init__(self, connection_handler_factory: ConnectionStorer, clock: Clock=SYSTEM_CLOCK, journal: Optional[Journal]=None):
+        """With a journal every accepted change is journalled; call recover before serving to restore the journalled state"""
+        self.clock = clock
+        self.journal = journal
         self.order_books = {}
-        self.orders = {}
+        self.instruments: Dict[int, Instrument] = {}
+        self.sequence_number = 0
         self.last_book_id = 0
         self.last_order_id = 0
         self.last_trade_id = 0
+        self.user_orders = UserOrderIndex()
         self.connection_handler_factory = connection_handler_factory
 
     def create_order_book(self, request: CreateOrderBookRequest) -> CreateOrderBookResponse:
+        timestamp = self.clock.wall_ns // 1000
         if request.tick_size <= 0:
             error_msg = 'Tick size must be greater than zero'
             print(f'[ERROR] {error_msg}')
-            return CreateOrderBookResponse(request_id=request.request_id, order_book_id=0, timestamp=int(time.time() * 1000000), error_message=error_msg)
+            return CreateOrderBookResponse(request_id=request.request_id, order_book_id=0, timestamp=timestamp, error_message=error_msg)
+        self.last_book_id += 1
+        self.order_books[self.last_book_id] = OrderBook(self.last_book_id, request.tick_size, self.__next_trade_id)
+        instrument = self.instruments[self.last_book_id] = Instrument()
+        instrument.CopyFrom(request.instrument)
+        if self.journal is not None:
+            self.journal.book_created(self.last_book_id, request.tick_size, instrument.SerializeToString())
+        self.on_order_book_created(self.last_book_id, request.tick_size)
+        return CreateOrderBookResponse(request_id=request.request_id, order_book_id=self.last_book_id, timestamp=timestamp, error_message='')
+
+    def __next_trade_id(self) -> int:
+        self.last_trade_id += 1
+        return self.last_trade_id
 
     def insert_order(self, request: InsertOrderRequest) -> InsertOrderResponse:
-        return InsertOrderResponse(request_id=request.request_id, error_message='Invalid order_book_id') if request.order_book_id not in self.order_books else request.order_book_id
+        order_book = self.order_books.get(request.order_book_id)
+        if order_book is None:
+            return InsertOrderResponse(request_id=request.request_id, error_message='Invalid order_book_id')
+        timestamp = self.clock.wall_ns // 1000
+        try:
+            order = Order(self.last_order_id + 1, order_book.id, timestamp, request.side, to_ticks(request.price, order_book.tick_size), request.quantity, request.on_behalf_of_username)
+            trades = order_book.insert_order(order)
+        except ValueError as e:
+            return InsertOrderResponse(request_id=request.request_id, error_message=str(e))
+        self.last_order_id += 1
+        if self.journal is not None:
+            self.__journal_insert(order, request.quantity, trades)
+        self.__index_user_orders(order_book, order, trades)
+        traded_quantity = request.quantity - order.quantity
+        # Trades go out before the insert so that mirrors of the book never see the new order cross the passive ones
+        for trade in trades:
+            self.on_trade(trade)
+        self.on_order_inserted(order, order.trade_ids)
+        return InsertOrderResponse(request_id=request.request_id, error_message='', order_id=order.order_id, timestamp=timestamp, trade_ids=order.trade_ids, traded_quantity=traded_quantity)
+
+    def batch_insert_order(self, request: BatchInsertOrderRequest) -> BatchInsertOrderResponse:
+        """
+        Inserts all orders of the batch, in order, or none of them if any is invalid.
+        The whole batch goes out as a single OnOrdersInserted broadcast.
+        """
+        if not request.orders:
+            return BatchInsertOrderResponse(request_id=request.request_id, error_message='Batch contains no orders')
+        timestamp = self.clock.wall_ns // 1000
+        orders = []
+        for index, batch_order in enumerate(request.orders):
+            order_book = self.order_books.get(batch_order.order_book_id)
+            if order_book is None:
+                return BatchInsertOrderResponse(request_id=request.request_id, error_message=f'Invalid order_book_id in order {index}')
+            if batch_order.side not in (Side.BUY, Side.SELL):
+                return BatchInsertOrderResponse(request_id=request.request_id, error_message=f'Unknown order side: {batch_order.side} in order {index}')
+            if batch_order.quantity <= 0:
+                return BatchInsertOrderResponse(request_id=request.request_id, error_message=f'Order quantity must be positive, got {batch_order.quantity} in order {index}')
+            try:
+                price_ticks = to_ticks(batch_order.price, order_book.tick_size)
+            except ValueError as e:
+                return BatchInsertOrderResponse(request_id=request.request_id, error_message=f'{e} in order {index}')
+            orders.append((order_book, Order(self.last_order_id + index + 1, order_book.id, timestamp, batch_order.side, price_ticks, batch_order.quantity, request.on_behalf_of_username)))
+        self.last_order_id += len(orders)
+        message = OnOrdersInserted()
+        response = BatchInsertOrderResponse(request_id=request.request_id, error_message='', timestamp=timestamp)
+        for order_book, order in orders:
+            quantity = order.quantity
+            trades = order_book.insert_order(order)
+            if self.journal is not None:
+                self.__journal_insert(order, quantity, trades)
+            self.__index_user_orders(order_book, order, trades)
+            message.trades.extend((self.__on_trade_message(trade) for trade in trades))
+            message.orders.append(self.__on_order_inserted_message(order, order.trade_ids))
+            response.orders.append(InsertedOrder(order_id=order.order_id, trade_ids=order.trade_ids, traded_quantity=quantity - order.quantity))
+        self.__broadcast(MessageType.ON_ORDERS_INSERTED, message)
+        return response
+
+    def __journal_insert(self, order: Order, quantity: int, trades: List[Trade]):
+        self.journal.order_inserted(order, quantity)
+        for trade in trades:
+            self.journal.trade(trade)
+
+    def __index_user_orders(self, order_book: OrderBook, order: Order, trades: List[Trade]):
+        for trade in trades:
+            passive_order_id = trade.sell_order_id if trade.buy_order_id == order.order_id else trade.buy_order_id
+            if order_book.get_order(passive_order_id) is None:
+                self.user_orders.remove(passive_order_id)
+        if order.quantity > 0:
+            self.user_orders.add(order.on_behalf_of_username, order.order_id, order_book.id)
 
     def cancel_order(self, request: CancelOrderRequest) -> CancelOrderResponse:
-        return CancelOrderResponse(request_id=request.request_id, error_message='Order not found') if request.order_id not in self.orders else request.order_id
+        order_book = self.order_books.get(request.order_book_id)
+        if order_book is None:
+            return CancelOrderResponse(request_id=request.request_id, error_message='Invalid order_book_id')
+        if order_book.cancel_order(request.order_id) is None:
+            return CancelOrderResponse(request_id=request.request_id, error_message='Order not found')
+        self.user_orders.remove(request.order_id)
+        timestamp = self.clock.wall_ns // 1000
+        if self.journal is not None:
+            self.journal.order_cancelled(request.order_id, order_book.id, timestamp)
+        self.on_order_cancelled(request.order_id, timestamp)
+        return CancelOrderResponse(request_id=request.request_id, error_message='')
+
+    def mass_cancel(self, request: MassCancelRequest) -> MassCancelResponse:
+        """Cancels every resting order of a book, of a user, or of a user in a book, with a single OnOrdersCancelled broadcast"""
+        username = request.on_behalf_of_username
+        if request.order_book_id == 0 and not username:
+            return MassCancelResponse(request_id=request.request_id, error_message='Mass cancel needs an order_book_id, a username or both')
+        if request.order_book_id != 0 and request.order_book_id not in self.order_books:
+            return MassCancelResponse(request_id=request.request_id, error_message='Invalid order_book_id')
+        if username:
+            candidates = [(order_id, order_book_id) for order_id, order_book_id in self.user_orders.orders_of(username) if request.order_book_id in (0, order_book_id)]
+        else:
+            candidates = [(order_id, request.order_book_id) for order_id in list(self.order_books[request.order_book_id].orders)]
+        cancelled_order_ids = []
+        timestamp = self.clock.wall_ns // 1000
+        for order_id, order_book_id in candidates:
+            if self.order_books[order_book_id].cancel_order(order_id) is not None:
+                self.user_orders.remove(order_id)
+                cancelled_order_ids.append(order_id)
+                if self.journal is not None:
+                    self.journal.order_cancelled(order_id, order_book_id, timestamp)
+        if cancelled_order_ids:
+            message = OnOrdersCancelled(order_ids=cancelled_order_ids, cancellation_timestamp=timestamp)
+            self.__broadcast(MessageType.ON_ORDERS_CANCELLED, message)
+        return MassCancelResponse(request_id=request.request_id, error_message='', order_ids=cancelled_order_ids, timestamp=timestamp)
+
+    def recover(self) -> int:
+        """
+        Rebuilds the order books from the journal's latest snapshot and the records journalled after it, without
+        broadcasting or journalling anything. Inserts are matched again, so the trades they produce must be the
+        journalled ones. Returns the number of records applied.
+        """
+        if self.order_books:
+            raise JournalError('Recovery needs a service without order books')
+        applied = 0
+        for record in self.journal.recovery_records():
+            self.__apply(record)
+            applied += 1
+        return applied
+
+    def __apply(self, record: JournalRecord):
+        if isinstance(record, OrderInserted):
+            order_book = self.order_books[record.order_book_id]
+            order = Order(record.order_id, record.order_book_id, record.timestamp, record.side, record.price_ticks, record.quantity, record.on_behalf_of_username)
+            self.__index_user_orders(order_book, order, order_book.insert_order(order))
+            self.last_order_id = max(self.last_order_id, record.order_id)
+        elif isinstance(record, TradeExecuted):
+            if record.trade_id > self.last_trade_id:
+                raise JournalError(f'Trade {record.trade_id} was journalled but not reproduced by replaying the orders')
+        elif isinstance(record, OrderCancelled):
+            self.order_books[record.order_book_id].cancel_order(record.order_id)
+            self.user_orders.remove(record.order_id)
+        elif isinstance(record, BookCreated):
+            self.order_books[record.order_book_id] = OrderBook(record.order_book_id, record.tick_size, self.__next_trade_id)
+            self.instruments[record.order_book_id] = Instrument.FromString(record.instrument)
+            self.last_book_id = max(self.last_book_id, record.order_book_id)
+        elif isinstance(record, SnapshotState):
+            self.last_book_id, self.last_order_id, self.last_trade_id = (record.last_book_id, record.last_order_id, record.last_trade_id)
+
+    def write_snapshot(self):
+        """
+        Snapshots every book and resting order, in time priority, so that recovery no longer replays the journal
+        before this point. Must run on the thread that handles the requests.
+        """
+        state = SnapshotState(self.journal.roll(), self.last_book_id, self.last_order_id, self.last_trade_id)
+        records: List[JournalRecord] = [BookCreated(order_book.id, order_book.tick_size, self.instruments[order_book.id].SerializeToString()) for order_book in self.order_books.values()]
+        for order_book in self.order_books.values():
+            records.extend((OrderInserted(order.order_id, order.order_book_id, order.timestamp, order.side, order.price_ticks, order.quantity, order.on_behalf_of_username) for order in order_book.orders.values()))
+        self.journal.write_snapshot(state, records)
+
+    def order_book_snapshots(self) -> List[OnOrderBookSnapshot]:
+        """Every book as of the current sequence number, for a consumer that just logged in, then the end of snapshot marker"""
+        snapshots = [self.__order_book_snapshot(order_book) for order_book in self.order_books.values()]
+        snapshots.append(OnOrderBookSnapshot(sequence_number=self.sequence_number))
+        return snapshots
+
+    def __order_book_snapshot(self, order_book: OrderBook) -> OnOrderBookSnapshot:
+        orders = order_book.orders.values()
+        username_indices: Dict[str, int] = {}
+        snapshot = OnOrderBookSnapshot(sequence_number=self.sequence_number, order_book_id=order_book.id, tick_size=order_book.tick_size, instrument=self.instruments[order_book.id])
+        snapshot.order_ids.extend([order.order_id for order in orders])
+        snapshot.sides.extend([order.side for order in orders])
+        snapshot.price_ticks.extend([order.price_ticks for order in orders])
+        snapshot.quantities.extend([order.quantity for order in orders])
+        snapshot.timestamps.extend([order.timestamp for order in orders])
+        snapshot.username_indices.extend([username_indices.setdefault(order.on_behalf_of_username or '', len(username_indices)) for order in orders])
+        snapshot.usernames.extend(username_indices)
+        return snapshot
+
+    def __broadcast(self, message_type: int, message):
+        self.sequence_number += 1
+        message.sequence_number = self.sequence_number
+        self.connection_handler_factory.broadcast_message(message_type, message)
 
     def on_order_book_created(self, order_book_id: int, tick_size: float):
-        message = OnOrderBookCreated(order_book_id=order_book_id, tick_size=tick_size)
-        self.connection_handler_factory.broadcast_message(MessageType.ON_ORDER_BOOK_CREATED, message)
+        message = OnOrderBookCreated(order_book_id=order_book_id, tick_size=tick_size, instrument=self.instruments[order_book_id])
+        self.__broadcast(MessageType.ON_ORDER_BOOK_CREATED, message)
 
     def on_order_inserted(self, order: Order, trade_ids: List[int]):
-        message = OnOrderInserted(order_id=order.order_id, order_book_id=order.order_book_id, timestamp=order.timestamp, side=order.side, price=order.price, quantity=order.quantity, trade_ids=trade_ids)
-        self.connection_handler_factory.broadcast_message(MessageType.ON_ORDER_INSERTED, message)
+        self.__broadcast(MessageType.ON_ORDER_INSERTED, self.__on_order_inserted_message(order, trade_ids))
+
+    def __on_order_inserted_message(self, order: Order, trade_ids: List[int]) -> OnOrderInserted:
+        return OnOrderInserted(order_id=order.order_id, order_book_id=order.order_book_id, timestamp=order.timestamp, side=order.side, price=to_price(order.price_ticks, self.order_books[order.order_book_id].tick_size), quantity=order.quantity, trade_ids=trade_ids)
 
     def on_order_cancelled(self, order_id: int, cancellation_timestamp: int):
         message = OnOrderCancelled(order_id=order_id, cancellation_timestamp=cancellation_timestamp)
-        self.connection_handler_factory.broadcast_message(MessageType.ON_ORDER_CANCELLED, message)
+        self.__broadcast(MessageType.ON_ORDER_CANCELLED, message)
 
     def on_trade(self, trade):
-        message = OnTrade(trade_id=trade.trade_id, order_book_id=trade.order_book_id, timestamp=trade.timestamp, buy_order_id=trade.buy_order_id, sell_order_id=trade.sell_order_id, price=trade.price, quantity=trade.quantity, aggressor_side=trade.aggressor_side)
-        self.connection_handler_factory.broadcast_message(MessageType.ON_TRADE, message)
+        self.__broadcast(MessageType.ON_TRADE, self.__on_trade_message(trade))
+
+    def __on_trade_message(self, trade: Trade) -> OnTrade:
+        return OnTrade(trade_id=trade.trade_id, order_book_id=trade.order_book_id, timestamp=trade.timestamp, buy_order_id=trade.buy_order_id, sell_order_id=trade.sell_order_id, price=to_price(trade.price_ticks, self.order_books[trade.order_book_id].tick_size), quantity=trade.quantity, aggressor_side=trade.aggressor_side)
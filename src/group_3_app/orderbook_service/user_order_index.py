@@ -0,0 +1,33 @@
+from typing import Dict, List, Tuple
+
+class UserOrderIndex:
+    """
+    Resting orders of each user across all order books, so that a mass cancel by user does not scan every book.
+    Orders entered without a username are not indexed.
+    """
+
+    def __init__(self):
+        self.__order_book_ids_by_user: Dict[str, Dict[int, int]] = {}
+        self.__usernames: Dict[int, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.__usernames)
+
+    def add(self, username: str, order_id: int, order_book_id: int):
+        if not username:
+            return
+        self.__order_book_ids_by_user.setdefault(username, {})[order_id] = order_book_id
+        self.__usernames[order_id] = username
+
+    def remove(self, order_id: int):
+        username = self.__usernames.pop(order_id, None)
+        if username is None:
+            return
+        order_book_ids = self.__order_book_ids_by_user[username]
+        del order_book_ids[order_id]
+        if not order_book_ids:
+            del self.__order_book_ids_by_user[username]
+
+    def orders_of(self, username: str) -> List[Tuple[int, int]]:
+        """(order id, order book id) of every resting order of the user, oldest first"""
+        return list(self.__order_book_ids_by_user.get(username, {}).items())
@@ -3,31 +3,93 @@ from typing import Dict
 import socket
 from typing import Callable
 from connection import message_codec
+from connection.message_codec import MESSAGE_TYPE_ATTRIBUTE
 from connection.connection_handler import ConnectionHandler, ConnectionHandlerFactory
 from connection.ip_address import IpAddress
 from group_3_app.risk_limits.risk_limits_service import RiskLimitsService
-from generated.proto.risk_limits_pb2 import MessageType as RiskLimitsMessageType, InsertOrderRequest, CancelOrderRequest, SetUserRiskLimitsRequest, GetInstrumentRiskLimitsRequest, SetInstrumentRiskLimitsRequest, GetUserRiskLimitsRequest
+from generated.proto.risk_limits_pb2 import MessageType as RiskLimitsMessageType, InsertOrderRequest, CancelOrderRequest, BatchInsertOrderRequest, MassCancelRequest, SetUserRiskLimitsRequest, GetInstrumentRiskLimitsRequest, SetInstrumentRiskLimitsRequest, GetUserRiskLimitsRequest
 from generated.proto.info_pb2 import MessageType as InfoMessageType, OnInstrument
-from generated.proto.order_book_pb2 import CancelOrderResponse as ObCancelOrderResponse, MessageType as OrderBookServiceMessageType, InsertOrderResponse as OBInsertOrderResponse
+from generated.proto.order_book_pb2 import CancelOrderResponse as ObCancelOrderResponse, MessageType as OrderBookServiceMessageType, InsertOrderResponse as OBInsertOrderResponse, BatchInsertOrderResponse as OBBatchInsertOrderResponse, MassCancelResponse as OBMassCancelResponse, OnOrderBookSnapshot, OnOrderBookCreated, OnOrderInserted, OnOrderCancelled, OnTrade as OBOnTrade, OnOrdersInserted, OnOrdersCancelled
+from generated.proto.common_pb2 import LoginRequest, LoginResponse
+from group_3_app.common.service_names import INFO_SERVICE, ORDER_BOOK_SERVICE, RISK_LIMITS_SERVICE
+from connection.message_dispatcher import MessageDispatcher
 logger = logging.getLogger(__name__)
 
 class RiskLimitsConnectionHandler(ConnectionHandler):
 
-    def __init__(self, socket_fd: socket.socket, ip_address: IpAddress, close_callback: Callable[[], None], service: RiskLimitsService):
+    def __init__(self, socket_fd: socket.socket, ip_address: IpAddress, close_callback: Callable[[], None], service: RiskLimitsService, protocol: str=RISK_LIMITS_SERVICE):
+        """protocol is RISK_LIMITS_SERVICE for trading clients, ORDER_BOOK_SERVICE or INFO_SERVICE for the gateway's upstream connections"""
         super().__init__(socket_fd, ip_address, close_callback)
         self.service = service
         self.username = None
+        self.protocol = protocol
+        self.dispatcher = MessageDispatcher()
+        self.dispatcher.register(RISK_LIMITS_SERVICE, RiskLimitsMessageType.LOGIN_REQUEST, LoginRequest, self.__on_login_request)
+        self.dispatcher.register(RISK_LIMITS_SERVICE, RiskLimitsMessageType.INSERT_ORDER_REQUEST, InsertOrderRequest, self.__on_insert_order_request, reuse_message=False)
+        self.dispatcher.register(RISK_LIMITS_SERVICE, RiskLimitsMessageType.CANCEL_ORDER_REQUEST, CancelOrderRequest, self.__on_cancel_order_request, reuse_message=False)
+        self.dispatcher.register(RISK_LIMITS_SERVICE, RiskLimitsMessageType.BATCH_INSERT_ORDER_REQUEST, BatchInsertOrderRequest, self.__on_batch_insert_order_request, reuse_message=False)
+        self.dispatcher.register(RISK_LIMITS_SERVICE, RiskLimitsMessageType.MASS_CANCEL_REQUEST, MassCancelRequest, self.__on_mass_cancel_request, reuse_message=False)
+        self.dispatcher.register(RISK_LIMITS_SERVICE, RiskLimitsMessageType.GET_USER_RISK_LIMITS_REQUEST, GetUserRiskLimitsRequest, self.__on_get_user_risk_limits_request)
+        self.dispatcher.register(RISK_LIMITS_SERVICE, RiskLimitsMessageType.SET_USER_RISK_LIMITS_REQUEST, SetUserRiskLimitsRequest, self.__on_set_user_risk_limits_request, reuse_message=False)
+        self.dispatcher.register(RISK_LIMITS_SERVICE, RiskLimitsMessageType.GET_INSTRUMENT_RISK_LIMITS_REQUEST, GetInstrumentRiskLimitsRequest, self.__on_get_instrument_risk_limits_request)
+        self.dispatcher.register(RISK_LIMITS_SERVICE, RiskLimitsMessageType.SET_INSTRUMENT_RISK_LIMITS_REQUEST, SetInstrumentRiskLimitsRequest, self.__on_set_instrument_risk_limits_request, reuse_message=False)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.LOGIN_RESPONSE, LoginResponse, self.__on_upstream_login_response)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.INSERT_ORDER_RESPONSE, OBInsertOrderResponse, self.service.insert_order_response)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.CANCEL_ORDER_RESPONSE, ObCancelOrderResponse, self.service.cancel_order_response)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.BATCH_INSERT_ORDER_RESPONSE, OBBatchInsertOrderResponse, self.service.batch_insert_order_response)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.MASS_CANCEL_RESPONSE, OBMassCancelResponse, self.service.mass_cancel_response)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.ON_ORDER_BOOK_SNAPSHOT, OnOrderBookSnapshot, self.service.on_order_book_snapshot)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.ON_ORDER_BOOK_CREATED, OnOrderBookCreated, self.service.on_order_book_created)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.ON_ORDER_INSERTED, OnOrderInserted, self.service.on_order_inserted)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.ON_ORDER_CANCELLED, OnOrderCancelled, self.service.on_order_cancelled)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.ON_TRADE, OBOnTrade, self.service.on_trade)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.ON_ORDERS_INSERTED, OnOrdersInserted, self.service.on_orders_inserted)
+        self.dispatcher.register(ORDER_BOOK_SERVICE, OrderBookServiceMessageType.ON_ORDERS_CANCELLED, OnOrdersCancelled, self.service.on_orders_cancelled)
+        self.dispatcher.register(INFO_SERVICE, InfoMessageType.LOGIN_RESPONSE, LoginResponse, self.__on_upstream_login_response)
+        self.dispatcher.register(INFO_SERVICE, InfoMessageType.ON_INSTRUMENT, OnInstrument, self.service.on_instrument)
 
     def handle_message(self, message_type: int, message: bytes) -> None:
         """Handles incoming messages"""
-        logger.info(f'Received message of type {message_type}')
-        logger.debug(f'Message: {str(message)}')
-        if message_type == RiskLimitsMessageType.LOGIN_REQUEST:
-            self.username = message.username
-            self.service.add_client(message.username, self)
-            logger.info(f"User '{self.username}' logged in from {self.ip_address}")
+        logger.info('Received message of type %d', message_type, extra={MESSAGE_TYPE_ATTRIBUTE: message_type})
+        self.dispatcher.dispatch(self.protocol, message_type, message)
         return None
 
+    def __on_login_request(self, request: LoginRequest) -> None:
+        self.username = request.username
+        response = self.service.login_request(request.username, self.ip_address, request)
+        logger.info(f"User '{self.username}' logged in from {self.ip_address}")
+        self.send_message(RiskLimitsMessageType.LOGIN_RESPONSE, response)
+
+    def __on_upstream_login_response(self, response: LoginResponse) -> None:
+        if response.error_message:
+            logger.error(f'Login to {self.protocol} service failed: {response.error_message}')
+        else:
+            logger.info(f'Logged in to {self.protocol} service')
+
+    def __on_insert_order_request(self, request: InsertOrderRequest) -> None:
+        self.service.insert_order(self.username, request, self)
+
+    def __on_cancel_order_request(self, request: CancelOrderRequest) -> None:
+        self.service.cancel_order(self.username, request, self)
+
+    def __on_batch_insert_order_request(self, request: BatchInsertOrderRequest) -> None:
+        self.service.batch_insert_order(self.username, request, self)
+
+    def __on_mass_cancel_request(self, request: MassCancelRequest) -> None:
+        self.service.mass_cancel(self.username, request, self)
+
+    def __on_get_user_risk_limits_request(self, request: GetUserRiskLimitsRequest) -> None:
+        self.send_message(RiskLimitsMessageType.GET_USER_RISK_LIMITS_RESPONSE, self.service.get_user_risk_limits(self.username, request))
+
+    def __on_set_user_risk_limits_request(self, request: SetUserRiskLimitsRequest) -> None:
+        self.send_message(RiskLimitsMessageType.SET_USER_RISK_LIMITS_RESPONSE, self.service.set_user_risk_limits(self.username, request))
+
+    def __on_get_instrument_risk_limits_request(self, request: GetInstrumentRiskLimitsRequest) -> None:
+        self.send_message(RiskLimitsMessageType.GET_INSTRUMENT_RISK_LIMITS_RESPONSE, self.service.get_instrument_risk_limits(self.username, request))
+
+    def __on_set_instrument_risk_limits_request(self, request: SetInstrumentRiskLimitsRequest) -> None:
+        self.send_message(RiskLimitsMessageType.SET_INSTRUMENT_RISK_LIMITS_RESPONSE, self.service.set_instrument_risk_limits(self.username, request))
+
     def _send_proto(self, message_type: int, proto_msg) -> None:
         encoded = message_codec.encode_message(message_type, proto_msg.SerializeToString())
         self._send_message(encoded)
@@ -44,14 +106,9 @@ class RiskLimitsConnectionHandlerFactory(ConnectionHandlerFactory[RiskLimitsConn
 
     def __init__(self):
         self.service = None
-        self.insert_order_request_id_to_connection_handler = {}
-        self.cancel_order_request_id_to_connection_handler = {}
 
     def on_new_connection(self, socket_fd: socket.socket, ip_address: IpAddress, close_callback: Callable[[], None]) -> RiskLimitsConnectionHandler:
         return RiskLimitsConnectionHandler(socket_fd, ip_address, close_callback, self.service)
 
     def on_connection_closed(self, connection_handler: RiskLimitsConnectionHandler):
         return
-
-    def add_insert_order_request_connection_handler(self, request_id: int, connection_handler: RiskLimitsConnectionHandler):
-        self.insert_order_request_id_to_connection_handler[request_id] = connection_handler
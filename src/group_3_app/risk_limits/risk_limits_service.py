@@ -1,26 +1,67 @@
 import logging
 from collections import defaultdict
-from typing import Dict, Optional, Set, Any
-import time
+from dataclasses import dataclass
+from typing import Dict, List, NamedTuple, Optional, Set, Any, Tuple, Union
+from connection.connection_handler import ConnectionHandler
 from connection.ip_address import IpAddress
+from connection.tcp_connection_manager import TcpConnectionManager
+from connection.timer_wheel import SYSTEM_CLOCK, Clock
 from generated.proto.common_pb2 import Side
 from generated.proto.common_pb2 import Instrument, LoginRequest, LoginResponse
-from generated.proto.risk_limits_pb2 import InsertOrderRequest, InsertOrderResponse, UserRiskLimits, InstrumentRiskLimits, CancelOrderRequest, CancelOrderResponse, GetUserRiskLimitsRequest, GetUserRiskLimitsResponse, SetUserRiskLimitsRequest, SetUserRiskLimitsResponse, GetInstrumentRiskLimitsRequest, GetInstrumentRiskLimitsResponse, SetInstrumentRiskLimitsRequest, SetInstrumentRiskLimitsResponse, UserRiskLimits, RollingWindowLimit, MessageType
-from generated.proto.order_book_pb2 import InsertOrderRequest as OBInsertOrderRequest, InsertOrderResponse as OBInsertOrderResponse, CancelOrderRequest as OBCancelOrderRequest, CancelOrderResponse as OBCancelOrderResponse, MessageType as OBMessageType
+from generated.proto.risk_limits_pb2 import InsertOrderRequest, InsertOrderResponse, UserRiskLimits, InstrumentRiskLimits, CancelOrderRequest, CancelOrderResponse, GetUserRiskLimitsRequest, GetUserRiskLimitsResponse, SetUserRiskLimitsRequest, SetUserRiskLimitsResponse, GetInstrumentRiskLimitsRequest, GetInstrumentRiskLimitsResponse, SetInstrumentRiskLimitsRequest, SetInstrumentRiskLimitsResponse, BatchInsertOrderRequest, BatchInsertOrderResponse, InsertedOrder, MassCancelRequest, MassCancelResponse, UserRiskLimits, RollingWindowLimit, MessageType
+from generated.proto.order_book_pb2 import OnOrderBookCreated, OnOrderInserted, OnOrderCancelled, OnTrade as OBOnTrade, OnOrdersInserted, OnOrdersCancelled
+from generated.proto.order_book_pb2 import InsertOrderRequest as OBInsertOrderRequest, InsertOrderResponse as OBInsertOrderResponse, CancelOrderRequest as OBCancelOrderRequest, CancelOrderResponse as OBCancelOrderResponse, BatchInsertOrderRequest as OBBatchInsertOrderRequest, BatchInsertOrderResponse as OBBatchInsertOrderResponse, BatchOrder as OBBatchOrder, MassCancelRequest as OBMassCancelRequest, MassCancelResponse as OBMassCancelResponse, OnOrderBookSnapshot, MessageType as OBMessageType
 from generated.proto.info_pb2 import OnInstrument
 from group_3_app.risk_limits.rolling_window_order_limit import RollingOrderLimit
 from group_3_app.risk_limits.rolling_window_message_rate_limit import RollingMessageRateLimit
 from group_3_app.common.connection_storer import ConnectionStorer
+from group_3_app.common.price import PRICE_TOLERANCE, to_price, to_ticks
+from group_3_app.common.correlation_table import CorrelationTable, CorrelationTableMetrics, DEFAULT_REQUEST_TIMEOUT_SECONDS, EXPIRY_INTERVAL_SECONDS
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
+ORDER_BOOK_SERVICE_USERNAME = 'risk_gateway'
+# How long the requests that timed out are remembered, so that a late response still updates the open orders
+TIMED_OUT_REQUEST_RETENTION_SECONDS = 60.0
+
+class PendingOrder(NamedTuple):
+    username: str
+    request: InsertOrderRequest
+    price_ticks: int
+    connection_handler: ConnectionHandler
+
+@dataclass
+class OpenOrder:
+    """A user's order resting in the book. quantity is what is left of it, which is what counts towards the limits."""
+    username: str
+    order_book_id: int
+    side: Side
+    price_ticks: int
+    quantity: int
+
+class PendingBatch(NamedTuple):
+    username: str
+    request: BatchInsertOrderRequest
+    orders: List[PendingOrder]
+    connection_handler: ConnectionHandler
+
+class PendingRequest(NamedTuple):
+    """A cancel or mass cancel request forwarded to the order book service, and the client connection to answer"""
+    request: Union[CancelOrderRequest, MassCancelRequest]
+    connection_handler: ConnectionHandler
 
 class RiskLimitsService:
+    """
+    Instruments are known by symbol to clients, but everything kept per instrument is keyed by order book id, so that
+    requests that name their instrument by order book id are handled without a single lookup by symbol.
+    Every request forwarded to the order book service remembers the client connection it came from, as request ids
+    are chosen by the clients and are only unique per connection.
+    """
 
-    def __init__(self, connection_storer: ConnectionStorer):
+    def __init__(self, connection_storer: ConnectionStorer, request_timeout_seconds: float=DEFAULT_REQUEST_TIMEOUT_SECONDS, clock: Clock=SYSTEM_CLOCK):
         self.connection_storer = connection_storer
-        self.user_per_instrument_risk_limits = defaultdict(lambda: defaultdict(InstrumentRiskLimits))
+        self.clock = clock
+        self.user_per_instrument_risk_limits: Dict[str, Dict[int, InstrumentRiskLimits]] = defaultdict(dict)
         self.total_user_risk_limits = defaultdict(UserRiskLimits)
-        self.instrument_symbols = set()
         self.ip_to_username = defaultdict(str)
         self.user_outstanding_quantity = defaultdict(int)
         self.user_instrument_outstanding_quantity = defaultdict(lambda: defaultdict(int))
@@ -28,80 +69,281 @@ class RiskLimitsService:
         self.user_instrument_qty_rolling_window = defaultdict(RollingOrderLimit)
         self.user_instrument_amount_rolling_window = defaultdict(RollingOrderLimit)
         self.user_message_rate_rolling_window = defaultdict(RollingMessageRateLimit)
-        self.req_id_to_insert_order_req = defaultdict(InsertOrderRequest)
-        self.order_id_to_insert_order_req = defaultdict(InsertOrderRequest)
-        self.order_id_to_username = defaultdict(str)
-        self.cancel_order_request_id_to_cancel_order_request = {}
+        self.open_orders: CorrelationTable[int, OpenOrder] = CorrelationTable('risk open orders', None, clock=clock.monotonic)
+        self.cancel_order_requests = CorrelationTable('risk cancel order requests', request_timeout_seconds, self.__on_cancel_order_request_timeout, clock.monotonic)
         self.next_cancel_order_request_id = 0
         self.orderbook_connection_handler = None
-        self.instrument_symbol_to_order_book_id = {}
-        self.insert_order_request_id_to_insert_order_request = {}
+        self.instrument_symbol_to_order_book_id: Dict[str, int] = {}
+        self.order_book_id_to_tick_size: Dict[int, float] = {}
+        self.order_book_id_to_instrument_symbol: Dict[int, str] = {}
+        self.insert_order_requests = CorrelationTable('risk insert order requests', request_timeout_seconds, self.__on_insert_order_request_timeout, clock.monotonic)
         self.next_insert_order_request_id = 0
+        self.batch_insert_order_requests = CorrelationTable('risk batch insert order requests', request_timeout_seconds, self.__on_batch_insert_order_request_timeout, clock.monotonic)
+        self.next_batch_insert_order_request_id = 0
+        self.mass_cancel_requests = CorrelationTable('risk mass cancel requests', request_timeout_seconds, self.__on_mass_cancel_request_timeout, clock.monotonic)
+        self.next_mass_cancel_request_id = 0
+        self.timed_out_requests = CorrelationTable('risk timed out requests', TIMED_OUT_REQUEST_RETENTION_SECONDS, clock=clock.monotonic)
+        # Sequence number of the last change applied from the order book service, None while waiting for snapshots
+        self.order_book_sequence_number: Optional[int] = None
+        # Quantity of each order of the last batch broadcast that later orders of the batch traded against
+        self.batch_passive_fills: Dict[int, int] = {}
         self.orderbook_connection_handler = None
 
+    def login_to_order_book_service(self):
+        """
+        The order book service answers with a snapshot of every book, and then streams every change of them. Open
+        orders are tracked from the snapshots and the responses to this gateway's requests, then kept up to date by
+        the trades and cancels of the stream, so that fills and cancels made elsewhere free up the users' limits.
+        """
+        self.orderbook_connection_handler.send_message(OBMessageType.LOGIN_REQUEST, LoginRequest(request_id=0, username=ORDER_BOOK_SERVICE_USERNAME))
+
     def login_request(self, username: str, ip_address: IpAddress, request: LoginRequest) -> LoginResponse:
         """add client connection"""
         self.ip_to_username[ip_address] = username
-        message = LoginResponse(request_id=request.request_id, error_message='')
+        message = LoginResponse(request_id=request.request_id, error_message='', compact_instrument_ids=request.compact_instrument_ids)
         return message
 
     def remove_client(self, ip_address: IpAddress):
         """remove client connection"""
         del self.ip_to_username[ip_address]
 
-    def insert_order(self, username: str, request: InsertOrderRequest) -> bool:
+    def __resolve_instrument(self, request: Union[InsertOrderRequest, CancelOrderRequest]) -> str:
+        """
+        Fills in the order book id of a request that names its instrument by symbol, which is all that is used of it
+        from then on. Returns an error message if the instrument is unknown.
+        """
+        if request.order_book_id:
+            if request.order_book_id not in self.order_book_id_to_tick_size:
+                return f'Unknown order book id: {request.order_book_id}'
+            return ''
+        order_book_id = self.instrument_symbol_to_order_book_id.get(request.instrument_symbol)
+        if order_book_id is None:
+            return f'Unknown instrument: {request.instrument_symbol}'
+        request.order_book_id = order_book_id
+        return ''
+
+    def insert_order(self, username: str, request: InsertOrderRequest, connection_handler: ConnectionHandler) -> bool:
         """Process an insert order request, checking risk limits"""
-        if request.instrument_symbol not in self.instrument_symbols:
-            error_msg = f'Unknown instrument: {request.instrument_symbol}'
+        error_msg = self.__resolve_instrument(request)
+        if error_msg:
             logger.warning(f'User {username}: {error_msg}')
-        return False
+            self.__reject_insert_order_request(connection_handler, request, error_msg)
+            return False
+        try:
+            price_ticks = to_ticks(request.price, self.order_book_id_to_tick_size[request.order_book_id])
+        except ValueError as e:
+            self.__reject_insert_order_request(connection_handler, request, str(e))
+            return False
+        pending_order = PendingOrder(username, request, price_ticks, connection_handler)
+        error_msg = self.__check_outstanding_limits(username, [pending_order])
+        if error_msg:
+            logger.warning(f'User {username}: insert rejected: {error_msg}')
+            self.__reject_insert_order_request(connection_handler, request, error_msg)
+            return False
+        self.send_insert_order_request(pending_order)
+        return True
+
+    def __reject_insert_order_request(self, connection_handler: ConnectionHandler, request: InsertOrderRequest, error_message: str):
+        connection_handler.send_message(MessageType.INSERT_ORDER_RESPONSE, InsertOrderResponse(request_id=request.request_id, error_message=error_message))
 
-    def send_insert_order_request(self, request: InsertOrderRequest) -> None:
-        order_book_id = self.instrument_symbol_to_order_book_id[request.instrument_symbol]
-        logger.info(f'-------Order book id: {order_book_id}-------')
-        ob_insert_order_request = OBInsertOrderRequest(request_id=self.next_insert_order_request_id, order_book_id=order_book_id, side=request.side, price=request.price, quantity=request.quantity)
-        self.insert_order_request_id_to_insert_order_request[self.next_insert_order_request_id] = request
+    def send_insert_order_request(self, pending_order: PendingOrder) -> None:
+        request = pending_order.request
+        order_book_id = request.order_book_id
+        logger.debug('Sending insert order request for order book id %d', order_book_id)
+        ob_insert_order_request = OBInsertOrderRequest(request_id=self.next_insert_order_request_id, order_book_id=order_book_id, side=request.side, price=to_price(pending_order.price_ticks, self.order_book_id_to_tick_size[order_book_id]), quantity=request.quantity, on_behalf_of_username=pending_order.username)
+        self.insert_order_requests.insert(self.next_insert_order_request_id, pending_order)
         self.orderbook_connection_handler.send_message(OBMessageType.INSERT_ORDER_REQUEST, ob_insert_order_request)
         self.next_insert_order_request_id += 1
 
     def insert_order_response(self, response: OBInsertOrderResponse) -> InsertOrderResponse:
-        response_id = response.request_id
-        insert_order_request = self.insert_order_request_id_to_insert_order_request[response_id]
-        original_request_id = insert_order_request.request_id
-        insert_order_response = InsertOrderResponse(request_id=original_request_id, error_message=response.error_message, order_id=response.order_id, timestamp=response.timestamp, trade_ids=response.trade_ids, traded_quantity=response.traded_quantity)
-        original_connection_handler = self.connection_storer.insert_order_request_id_to_connection_handler[original_request_id]
-        original_connection_handler.send_message(MessageType.INSERT_ORDER_RESPONSE, insert_order_response)
-        self.order_id_to_insert_order_req[response.order_id] = self.req_id_to_insert_order_req[response.request_id]
-
-    def cancel_order(self, username: str, request: CancelOrderRequest) -> None:
+        pending_order, timed_out = self.__complete_request(self.insert_order_requests, OBMessageType.INSERT_ORDER_REQUEST, response.request_id)
+        if pending_order is None:
+            return
+        if not timed_out:
+            insert_order_response = InsertOrderResponse(request_id=pending_order.request.request_id, error_message=response.error_message, order_id=response.order_id, timestamp=response.timestamp, trade_ids=response.trade_ids, traded_quantity=response.traded_quantity)
+            pending_order.connection_handler.send_message(MessageType.INSERT_ORDER_RESPONSE, insert_order_response)
+        if not response.error_message:
+            self.__track_open_order(response.order_id, pending_order, response.traded_quantity)
+
+    def __track_open_order(self, order_id: int, pending_order: PendingOrder, traded_quantity: int):
+        """
+        Counts what rests of an accepted order towards the user's outstanding limits, until it is cancelled.
+        Orders that traded in full on insert never rest, so there is nothing to cancel and nothing to track.
+        """
+        request = pending_order.request
+        quantity = request.quantity - traded_quantity
+        if quantity <= 0:
+            return
+        open_order = OpenOrder(pending_order.username, request.order_book_id, request.side, pending_order.price_ticks, quantity)
+        self.open_orders.insert(order_id, open_order)
+        self.__update_limits_on_insert(open_order)
+
+    def __complete_request(self, requests: CorrelationTable, message_type: int, request_id: int) -> Tuple[Any, bool]:
+        """
+        The pending value of an order book service request and whether it timed out, or None if it is unknown.
+        The order book service still acts on requests that timed out here, so their late responses must update the
+        open orders all the same, even though the client already got its timeout error.
+        """
+        pending = requests.complete(request_id)
+        if pending is not None:
+            return pending, False
+        pending = self.timed_out_requests.complete((message_type, request_id))
+        if pending is None:
+            logger.warning(f'Dropping response to unknown request {request_id} of {requests.name}')
+        else:
+            logger.warning(f'Response to request {request_id} of {requests.name} arrived after it timed out')
+        return pending, True
+
+    def __on_insert_order_request_timeout(self, insert_order_request_id: int, pending_order: 'PendingOrder'):
+        self.timed_out_requests.insert((OBMessageType.INSERT_ORDER_REQUEST, insert_order_request_id), pending_order)
+        self.__reject_insert_order_request(pending_order.connection_handler, pending_order.request, 'Timed out waiting for the order book service')
+
+    def cancel_order(self, username: str, request: CancelOrderRequest, connection_handler: ConnectionHandler) -> None:
         """Cancel an existing order and update risk limits accordingly"""
-        if request.instrument_symbol not in self.instrument_symbols:
-            error_msg = f'Unknown instrument: {request.instrument_symbol}'
+        error_msg = self.__resolve_instrument(request)
+        if error_msg:
             logger.warning(f'User {username}: {error_msg}')
-        try:
-            self.send_cancel_order_request(request)
-        except Exception as e:
-            logger.error(error_message=f'Order cancellation failed: {str(e)}')
-
-    def send_cancel_order_request(self, request: CancelOrderRequest) -> None:
-        order_book_id = self.instrument_symbol_to_order_book_id[request.instrument_symbol]
-        ob_cancel_order_request = OBCancelOrderRequest(request_id=self.next_cancel_order_request_id, order_book_id=order_book_id, order_id=request.order_id)
-        self.cancel_order_request_id_to_cancel_order_request[self.next_cancel_order_request_id] = request
+            connection_handler.send_message(MessageType.CANCEL_ORDER_RESPONSE, CancelOrderResponse(request_id=request.request_id, error_message=error_msg))
+            return
+        self.send_cancel_order_request(request, connection_handler)
+
+    def send_cancel_order_request(self, request: CancelOrderRequest, connection_handler: ConnectionHandler) -> None:
+        ob_cancel_order_request = OBCancelOrderRequest(request_id=self.next_cancel_order_request_id, order_book_id=request.order_book_id, order_id=request.order_id)
+        self.cancel_order_requests.insert(self.next_cancel_order_request_id, PendingRequest(request, connection_handler))
         self.orderbook_connection_handler.send_message(OBMessageType.CANCEL_ORDER_REQUEST, ob_cancel_order_request)
         self.next_cancel_order_request_id += 1
 
     def cancel_order_response(self, response: OBCancelOrderResponse) -> CancelOrderResponse:
-        response_id = response.request_id
-        cancel_order_request = self.cancel_order_request_id_to_cancel_order_request[response_id]
-        original_request_id = cancel_order_request.request_id
-        cancel_order_response = CancelOrderResponse(request_id=original_request_id, error_message=response.error_message)
-        original_connection_handler = self.connection_storer.cancel_order_request_id_to_connection_handler[original_request_id]
-        original_connection_handler.send_message(MessageType.CANCEL_ORDER_RESPONSE, cancel_order_response)
-        order_id = cancel_order_request.order_id
-        insert_order_request = self.order_id_to_insert_order_req[order_id]
-        username = self.order_id_to_username[order_id]
-        self.__update_limits_on_order_cancel(username, insert_order_request)
-        del self.req_id_to_insert_order_req[response.request_id]
+        pending_cancel, timed_out = self.__complete_request(self.cancel_order_requests, OBMessageType.CANCEL_ORDER_REQUEST, response.request_id)
+        if pending_cancel is None:
+            return
+        if not timed_out:
+            cancel_order_response = CancelOrderResponse(request_id=pending_cancel.request.request_id, error_message=response.error_message)
+            pending_cancel.connection_handler.send_message(MessageType.CANCEL_ORDER_RESPONSE, cancel_order_response)
+        if response.error_message:
+            return
+        self.__untrack_open_order(pending_cancel.request.order_id)
+
+    def __on_cancel_order_request_timeout(self, cancel_order_request_id: int, pending_cancel: PendingRequest):
+        self.timed_out_requests.insert((OBMessageType.CANCEL_ORDER_REQUEST, cancel_order_request_id), pending_cancel)
+        pending_cancel.connection_handler.send_message(MessageType.CANCEL_ORDER_RESPONSE, CancelOrderResponse(request_id=pending_cancel.request.request_id, error_message='Timed out waiting for the order book service'))
+
+    def batch_insert_order(self, username: str, request: BatchInsertOrderRequest, connection_handler: ConnectionHandler) -> None:
+        """Checks the batch as one unit and forwards it to the order book service, or rejects all of it"""
+        pending_orders = []
+        for index, batch_order in enumerate(request.orders):
+            order_book_id = self.instrument_symbol_to_order_book_id.get(batch_order.instrument_symbol)
+            if order_book_id is None:
+                self.__respond_to_batch_insert_order_request(connection_handler, BatchInsertOrderResponse(request_id=request.request_id, error_message=f'Unknown instrument: {batch_order.instrument_symbol} in order {index}'))
+                return
+            if batch_order.side not in (Side.BUY, Side.SELL):
+                self.__respond_to_batch_insert_order_request(connection_handler, BatchInsertOrderResponse(request_id=request.request_id, error_message=f'Unknown order side: {batch_order.side} in order {index}'))
+                return
+            try:
+                price_ticks = to_ticks(batch_order.price, self.order_book_id_to_tick_size[order_book_id])
+            except ValueError as e:
+                self.__respond_to_batch_insert_order_request(connection_handler, BatchInsertOrderResponse(request_id=request.request_id, error_message=f'{e} in order {index}'))
+                return
+            order_request = InsertOrderRequest(request_id=request.request_id, instrument_symbol=batch_order.instrument_symbol, order_book_id=order_book_id, side=batch_order.side, price=batch_order.price, quantity=batch_order.quantity)
+            pending_orders.append(PendingOrder(username, order_request, price_ticks, connection_handler))
+        error_message = 'Batch contains no orders' if not pending_orders else self.__check_outstanding_limits(username, pending_orders)
+        if error_message:
+            logger.warning(f'User {username}: batch insert rejected: {error_message}')
+            self.__respond_to_batch_insert_order_request(connection_handler, BatchInsertOrderResponse(request_id=request.request_id, error_message=error_message))
+            return
+        self.send_batch_insert_order_request(PendingBatch(username, request, pending_orders, connection_handler))
+
+    def send_batch_insert_order_request(self, pending_batch: PendingBatch) -> None:
+        ob_batch_insert_order_request = OBBatchInsertOrderRequest(request_id=self.next_batch_insert_order_request_id, on_behalf_of_username=pending_batch.username)
+        for pending_order in pending_batch.orders:
+            request = pending_order.request
+            tick_size = self.order_book_id_to_tick_size[request.order_book_id]
+            ob_batch_insert_order_request.orders.append(OBBatchOrder(order_book_id=request.order_book_id, side=request.side, price=to_price(pending_order.price_ticks, tick_size), quantity=request.quantity))
+        self.batch_insert_order_requests.insert(self.next_batch_insert_order_request_id, pending_batch)
+        self.orderbook_connection_handler.send_message(OBMessageType.BATCH_INSERT_ORDER_REQUEST, ob_batch_insert_order_request)
+        self.next_batch_insert_order_request_id += 1
+
+    def batch_insert_order_response(self, response: OBBatchInsertOrderResponse) -> None:
+        pending_batch, timed_out = self.__complete_request(self.batch_insert_order_requests, OBMessageType.BATCH_INSERT_ORDER_REQUEST, response.request_id)
+        if pending_batch is None:
+            return
+        if not timed_out:
+            batch_insert_order_response = BatchInsertOrderResponse(request_id=pending_batch.request.request_id, error_message=response.error_message, timestamp=response.timestamp, orders=[InsertedOrder(order_id=inserted.order_id, trade_ids=inserted.trade_ids, traded_quantity=inserted.traded_quantity) for inserted in response.orders])
+            self.__respond_to_batch_insert_order_request(pending_batch.connection_handler, batch_insert_order_response)
+        if response.error_message:
+            return
+        for pending_order, inserted in zip(pending_batch.orders, response.orders):
+            self.__track_open_order(inserted.order_id, pending_order, inserted.traded_quantity + self.batch_passive_fills.pop(inserted.order_id, 0))
+
+    def __on_batch_insert_order_request_timeout(self, batch_insert_order_request_id: int, pending_batch: PendingBatch):
+        self.timed_out_requests.insert((OBMessageType.BATCH_INSERT_ORDER_REQUEST, batch_insert_order_request_id), pending_batch)
+        self.__respond_to_batch_insert_order_request(pending_batch.connection_handler, BatchInsertOrderResponse(request_id=pending_batch.request.request_id, error_message='Timed out waiting for the order book service'))
+
+    def __respond_to_batch_insert_order_request(self, connection_handler: ConnectionHandler, response: BatchInsertOrderResponse):
+        connection_handler.send_message(MessageType.BATCH_INSERT_ORDER_RESPONSE, response)
+
+    def __check_outstanding_limits(self, username: str, pending_orders: List[PendingOrder]) -> Optional[str]:
+        """
+        Checks the outstanding quantity and amount limits against the orders at once, as if all of them were resting,
+        so that a batch passes or fails as a whole. Limits left at zero are not enforced.
+        """
+        batch_quantity = defaultdict(int)
+        batch_amount = defaultdict(int)
+        for pending_order in pending_orders:
+            order_book_id = pending_order.request.order_book_id
+            batch_quantity[order_book_id] += pending_order.request.quantity
+            batch_amount[order_book_id] += pending_order.price_ticks * pending_order.request.quantity
+        user_limits = self.total_user_risk_limits.get(username)
+        if user_limits is not None and user_limits.max_outstanding_quantity and self.user_outstanding_quantity[username] + sum(batch_quantity.values()) > user_limits.max_outstanding_quantity:
+            return 'User risk limits violated: max outstanding quantity'
+        instrument_limits = self.user_per_instrument_risk_limits.get(username, {})
+        for order_book_id, quantity in batch_quantity.items():
+            limits = instrument_limits.get(order_book_id)
+            if limits is None:
+                continue
+            if limits.max_outstanding_quantity and self.user_instrument_outstanding_quantity[username][order_book_id] + quantity > limits.max_outstanding_quantity:
+                return f'Instrument risk limits violated for {self.order_book_id_to_instrument_symbol[order_book_id]}: max outstanding quantity'
+            amount = (self.user_instrument_outstanding_amount[username][order_book_id] + batch_amount[order_book_id]) * self.order_book_id_to_tick_size[order_book_id]
+            if limits.max_outstanding_amount and amount > limits.max_outstanding_amount + PRICE_TOLERANCE:
+                return f'Instrument risk limits violated for {self.order_book_id_to_instrument_symbol[order_book_id]}: max outstanding amount'
+        return None
+
+    def mass_cancel(self, username: str, request: MassCancelRequest, connection_handler: ConnectionHandler) -> None:
+        """Cancels all of the user's resting orders, or only those in the requested instrument"""
+        order_book_id = 0
+        if request.instrument_symbol:
+            order_book_id = self.instrument_symbol_to_order_book_id.get(request.instrument_symbol)
+            if order_book_id is None:
+                self.__respond_to_mass_cancel_request(connection_handler, MassCancelResponse(request_id=request.request_id, error_message=f'Unknown instrument: {request.instrument_symbol}'))
+                return
+        ob_mass_cancel_request = OBMassCancelRequest(request_id=self.next_mass_cancel_request_id, order_book_id=order_book_id, on_behalf_of_username=username)
+        self.mass_cancel_requests.insert(self.next_mass_cancel_request_id, PendingRequest(request, connection_handler))
+        self.orderbook_connection_handler.send_message(OBMessageType.MASS_CANCEL_REQUEST, ob_mass_cancel_request)
+        self.next_mass_cancel_request_id += 1
+
+    def mass_cancel_response(self, response: OBMassCancelResponse) -> None:
+        pending_mass_cancel, timed_out = self.__complete_request(self.mass_cancel_requests, OBMessageType.MASS_CANCEL_REQUEST, response.request_id)
+        if pending_mass_cancel is None:
+            return
+        if not timed_out:
+            self.__respond_to_mass_cancel_request(pending_mass_cancel.connection_handler, MassCancelResponse(request_id=pending_mass_cancel.request.request_id, error_message=response.error_message, order_ids=response.order_ids))
+        for order_id in response.order_ids:
+            self.__untrack_open_order(order_id)
+
+    def __on_mass_cancel_request_timeout(self, mass_cancel_request_id: int, pending_mass_cancel: PendingRequest):
+        self.timed_out_requests.insert((OBMessageType.MASS_CANCEL_REQUEST, mass_cancel_request_id), pending_mass_cancel)
+        self.__respond_to_mass_cancel_request(pending_mass_cancel.connection_handler, MassCancelResponse(request_id=pending_mass_cancel.request.request_id, error_message='Timed out waiting for the order book service'))
+
+    def __respond_to_mass_cancel_request(self, connection_handler: ConnectionHandler, response: MassCancelResponse):
+        connection_handler.send_message(MessageType.MASS_CANCEL_RESPONSE, response)
+
+    def request_table_metrics(self) -> List[CorrelationTableMetrics]:
+        return [self.insert_order_requests.metrics(), self.cancel_order_requests.metrics(), self.batch_insert_order_requests.metrics(), self.mass_cancel_requests.metrics(), self.timed_out_requests.metrics(), self.open_orders.metrics()]
+
+    def schedule_expiry(self, connection_manager: TcpConnectionManager) -> None:
+        """Registers the expiry of every request table with the event loop that feeds this service"""
+        for requests in (self.insert_order_requests, self.cancel_order_requests, self.batch_insert_order_requests, self.mass_cancel_requests, self.timed_out_requests):
+            connection_manager.call_every(EXPIRY_INTERVAL_SECONDS, requests.expire)
 
     def get_user_risk_limits(self, username: str, request: GetUserRiskLimitsRequest) -> GetUserRiskLimitsResponse:
         """Get current risk limits for a user"""
@@ -113,92 +355,184 @@ class RiskLimitsService:
         new_user_risk_limits = request.user_risk_limits
         self.total_user_risk_limits[username] = new_user_risk_limits
         message_rate_rolling_window_limit = new_user_risk_limits.message_rate_rolling_limit
-        self.user_message_rate_rolling_window[username] = RollingMessageRateLimit(message_rate_rolling_window_limit.limit, message_rate_rolling_window_limit.window_in_seconds)
+        self.user_message_rate_rolling_window[username] = RollingMessageRateLimit(message_rate_rolling_window_limit.limit, message_rate_rolling_window_limit.window_in_seconds, self.clock)
         response = SetUserRiskLimitsResponse(request_id=request.request_id, error_message='')
         return response
 
     def get_instrument_risk_limits(self, username: str, request: GetInstrumentRiskLimitsRequest) -> GetInstrumentRiskLimitsResponse:
         """Get current instrument risk limits for a user"""
         response = GetInstrumentRiskLimitsResponse(request_id=request.request_id, error_message='')
-        response.risk_limits_by_instrument.update(self.user_per_instrument_risk_limits[username])
+        for order_book_id, limits in self.user_per_instrument_risk_limits[username].items():
+            response.risk_limits_by_instrument[self.order_book_id_to_instrument_symbol[order_book_id]].CopyFrom(limits)
         return response
 
     def set_instrument_risk_limits(self, username: str, request: SetInstrumentRiskLimitsRequest) -> SetInstrumentRiskLimitsResponse:
         """Set new risk limits for a specific instrument for a user"""
         new_instrument_risk_limits = request.instrument_risk_limits
-        if request.instrument_symbol not in self.instrument_symbols:
+        order_book_id = self.instrument_symbol_to_order_book_id.get(request.instrument_symbol)
+        if order_book_id is None:
             error_msg = f'Unknown instrument: {request.instrument_symbol}'
             logger.warning(f'User {username}: {error_msg}')
-        instrument_symbol = request.instrument_symbol
-        self.user_per_instrument_risk_limits[username][instrument_symbol] = new_instrument_risk_limits
+            return SetInstrumentRiskLimitsResponse(request_id=request.request_id, error_message=error_msg)
+        self.user_per_instrument_risk_limits[username][order_book_id] = new_instrument_risk_limits
         response = SetInstrumentRiskLimitsResponse(request_id=request.request_id, error_message='')
         quantity_rolling_window_limit = new_instrument_risk_limits.order_quantity_rolling_limit
         amount_rolling_window_limit = new_instrument_risk_limits.order_amount_rolling_limit
-        self.user_instrument_qty_rolling_window[username] = RollingOrderLimit(quantity_rolling_window_limit.limit, quantity_rolling_window_limit.window_in_seconds)
-        self.user_instrument_amount_rolling_window[username] = RollingOrderLimit(amount_rolling_window_limit.limit, amount_rolling_window_limit.window_in_seconds)
+        self.user_instrument_qty_rolling_window[username] = RollingOrderLimit(quantity_rolling_window_limit.limit, quantity_rolling_window_limit.window_in_seconds, self.clock)
+        self.user_instrument_amount_rolling_window[username] = RollingOrderLimit(amount_rolling_window_limit.limit, amount_rolling_window_limit.window_in_seconds, self.clock)
         return response
 
     def on_instrument(self, request: OnInstrument) -> None:
         """Add new instrument symbol to set"""
         logger.info(f'----------Received new instrument: {request} from info service')
-        new_instrument = request.instrument
-        self.instrument_symbols.add(new_instrument.symbol)
-        self.instrument_symbol_to_order_book_id[new_instrument.symbol] = request.order_book_id
-        logger.info(f'---------- New instrument added: {new_instrument.symbol} with order book id: {request.order_book_id}')
+        self.__add_instrument(request.instrument.symbol, request.order_book_id, request.tick_size)
+        logger.info(f'---------- New instrument added: {request.instrument.symbol} with order book id: {request.order_book_id}')
 
-    def on_trade(self) -> None:
-        """update tracking data on trade"""
-        return
+    def __add_instrument(self, instrument_symbol: str, order_book_id: int, tick_size: float):
+        self.instrument_symbol_to_order_book_id[instrument_symbol] = order_book_id
+        self.order_book_id_to_tick_size[order_book_id] = tick_size
+        self.order_book_id_to_instrument_symbol[order_book_id] = instrument_symbol
 
-    def __check_limits(self, username: str, request: InsertOrderRequest) -> Optional[str]:
-        if not self.__check_user_limits(username, request):
-            error_message = 'User risk limits violated'
-            return error_message
+    def on_order_book_snapshot(self, snapshot: OnOrderBookSnapshot) -> None:
+        """
+        Learns the book's instrument and tracks the resting orders entered through a gateway that this one does not know
+        of yet, so that a restarted gateway checks limits against what its users already have in the market.
+        Tracked orders of the book that the snapshot shows filled or cancelled, e.g. in changes missed before a
+        resynchronisation, are brought in line with it. Changes up to the snapshot's sequence number are skipped.
+        """
+        if snapshot.order_book_id == 0:
+            self.order_book_sequence_number = snapshot.sequence_number
+            return
+        instrument_symbol = snapshot.instrument.symbol
+        if not instrument_symbol:
+            return
+        order_book_id = snapshot.order_book_id
+        if order_book_id not in self.order_book_id_to_tick_size:
+            self.__add_instrument(instrument_symbol, order_book_id, snapshot.tick_size)
+        quantities = dict(zip(snapshot.order_ids, snapshot.quantities))
+        for order_id, open_order in self.open_orders.items():
+            if open_order.order_book_id == order_book_id and quantities.get(order_id, 0) < open_order.quantity:
+                self.__reduce_open_order(order_id, open_order, open_order.quantity - quantities.get(order_id, 0))
+        usernames = snapshot.usernames
+        restored = 0
+        for order_id, side, price_ticks, quantity, username_index in zip(snapshot.order_ids, snapshot.sides, snapshot.price_ticks, snapshot.quantities, snapshot.username_indices):
+            username = usernames[username_index]
+            if not username or order_id in self.open_orders:
+                continue
+            open_order = OpenOrder(username, order_book_id, side, price_ticks, quantity)
+            self.open_orders.insert(order_id, open_order)
+            self.__update_limits_on_insert(open_order)
+            restored += 1
+        if restored:
+            logger.info(f'Tracking {restored} resting orders of {instrument_symbol} from the order book snapshot at sequence number {snapshot.sequence_number}')
 
-    def __check_user_limits(self, username: str, request: InsertOrderRequest) -> bool:
+    def __in_sequence(self, sequence_number: int) -> bool:
         """
-        Checks if the user is within overall risk limits.
-        Returns True if within limits, False otherwise.
+        Whether to apply a change of the order book service: changes are skipped while waiting for snapshots and when
+        a snapshot already reflects them, and a gap in the sequence asks for fresh snapshots.
         """
-        if username not in self.total_user_risk_limits:
-            pass
-        return False
+        last_sequence_number = self.order_book_sequence_number
+        if last_sequence_number is None or sequence_number <= last_sequence_number:
+            return False
+        if sequence_number != last_sequence_number + 1:
+            logger.warning(f'Missed order book changes {last_sequence_number + 1} to {sequence_number - 1}, resynchronising')
+            self.order_book_sequence_number = None
+            self.login_to_order_book_service()
+            return False
+        self.order_book_sequence_number = sequence_number
+        return True
+
+    def on_order_book_created(self, on_order_book_created: OnOrderBookCreated) -> None:
+        if not self.__in_sequence(on_order_book_created.sequence_number):
+            return
+        instrument_symbol = on_order_book_created.instrument.symbol
+        if instrument_symbol and on_order_book_created.order_book_id not in self.order_book_id_to_tick_size:
+            self.__add_instrument(instrument_symbol, on_order_book_created.order_book_id, on_order_book_created.tick_size)
 
-    def __check_instrument_limits(self, username: str, instrument: str, request: InsertOrderRequest) -> bool:
+    def on_order_inserted(self, on_order_inserted: OnOrderInserted) -> None:
+        """New orders are tracked from the insert responses, which say whose they are"""
+        self.__in_sequence(on_order_inserted.sequence_number)
+
+    def on_trade(self, on_trade: OBOnTrade) -> None:
+        """update tracking data on trade"""
+        if self.__in_sequence(on_trade.sequence_number):
+            self.__fill(on_trade)
+
+    def __fill(self, on_trade: OBOnTrade):
         """
-        Checks if the user is within instrument-specific risk limits.
-        Returns True if within limits, False otherwise.
+        Takes the traded quantity off whichever of the two orders was resting and tracked. The aggressor is not
+        tracked yet: its insert response comes after its trades, with the traded quantity already deducted.
         """
-        if username not in self.user_per_instrument_risk_limits:
-            pass
-        return False
+        for order_id in (on_trade.buy_order_id, on_trade.sell_order_id):
+            open_order = self.open_orders.get(order_id)
+            if open_order is not None:
+                self.__reduce_open_order(order_id, open_order, on_trade.quantity)
 
-    def __update_limits_on_insert(self, username: str, request: InsertOrderRequest) -> None:
+    def on_orders_inserted(self, on_orders_inserted: OnOrdersInserted) -> None:
+        """
+        Later orders of a batch may trade against earlier ones, which the batch insert response does not count in the
+        earlier orders' traded quantity. The response follows this broadcast directly, so their fills are kept for it.
         """
-        Update tracking user outstanding quantity and message count
+        if not self.__in_sequence(on_orders_inserted.sequence_number):
+            return
+        batch_order_ids = {on_order_inserted.order_id for on_order_inserted in on_orders_inserted.orders}
+        batch_passive_fills = self.batch_passive_fills = {}
+        for on_trade in on_orders_inserted.trades:
+            self.__fill(on_trade)
+            passive_order_id = on_trade.sell_order_id if on_trade.aggressor_side == Side.BUY else on_trade.buy_order_id
+            if passive_order_id in batch_order_ids:
+                batch_passive_fills[passive_order_id] = batch_passive_fills.get(passive_order_id, 0) + on_trade.quantity
+
+    def on_order_cancelled(self, on_order_cancelled: OnOrderCancelled) -> None:
+        if self.__in_sequence(on_order_cancelled.sequence_number):
+            self.__untrack_open_order(on_order_cancelled.order_id)
+
+    def on_orders_cancelled(self, on_orders_cancelled: OnOrdersCancelled) -> None:
+        if not self.__in_sequence(on_orders_cancelled.sequence_number):
+            return
+        for order_id in on_orders_cancelled.order_ids:
+            self.__untrack_open_order(order_id)
+
+    def __untrack_open_order(self, order_id: int):
+        open_order = self.open_orders.complete(order_id)
+        if open_order is not None:
+            self.__update_limits_on_order_cancel(open_order)
+
+    def __reduce_open_order(self, order_id: int, open_order: OpenOrder, quantity: int):
+        """Frees up the limits held by part of an open order, and stops tracking it once nothing is left"""
+        quantity = min(quantity, open_order.quantity)
+        username = open_order.username
+        order_book_id = open_order.order_book_id
+        self.user_outstanding_quantity[username] -= quantity
+        self.user_instrument_outstanding_quantity[username][order_book_id] -= quantity
+        self.user_instrument_outstanding_amount[username][order_book_id] -= open_order.price_ticks * quantity
+        open_order.quantity -= quantity
+        if open_order.quantity == 0:
+            self.open_orders.complete(order_id)
+
+    def __update_limits_on_insert(self, open_order: OpenOrder) -> None:
+        """
+        Update tracking user outstanding quantity
         Update tracking instrument outstanding quantity and amount
+        Amounts are kept in price ticks times quantity, and both sides count, as in the limit checks
         """
-        side = request.side
-        quantity = request.quantity
-        instrument_symbol = request.instrument_symbol
-        amount = request.price
-        if side == Side.BUY:
-            self.user_outstanding_quantity[username] += quantity
-            self.user_instrument_outstanding_amount[username][instrument_symbol] += quantity
-            self.user_instrument_amount_rolling_window[username][instrument_symbol] += amount
+        username = open_order.username
+        order_book_id = open_order.order_book_id
+        quantity = open_order.quantity
+        self.user_outstanding_quantity[username] += quantity
+        self.user_instrument_outstanding_quantity[username][order_book_id] += quantity
+        self.user_instrument_outstanding_amount[username][order_book_id] += open_order.price_ticks * quantity
         return None
 
-    def __update_limits_on_order_cancel(self, username: str, request: InsertOrderRequest) -> None:
+    def __update_limits_on_order_cancel(self, open_order: OpenOrder) -> None:
         """
         Update tracking data after a successful order cancellation
-        Update tracking data after a successful order cancellation
+        Takes off exactly what __update_limits_on_insert added for the order's remaining quantity
         """
-        side = request.side
-        instrument_symbol = request.instrument_symbol
-        quantity = request.quantity
-        amount = request.price
-        if side == Side.BUY:
-            self.user_outstanding_quantity[username] -= quantity
-            self.user_instrument_outstanding_quantity[username][instrument_symbol] -= quantity
-            self.user_instrument_outstanding_amount[username][instrument_symbol] -= amount
+        username = open_order.username
+        order_book_id = open_order.order_book_id
+        quantity = open_order.quantity
+        self.user_outstanding_quantity[username] -= quantity
+        self.user_instrument_outstanding_quantity[username][order_book_id] -= quantity
+        self.user_instrument_outstanding_amount[username][order_book_id] -= open_order.price_ticks * quantity
         return None
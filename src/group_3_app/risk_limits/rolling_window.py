@@ -1,18 +1,19 @@
-import time
 from collections import deque
 from abc import ABC, abstractmethod
+from connection.timer_wheel import SYSTEM_CLOCK, Clock
 
 class RollingWindowBase(ABC):
     """Abstract base class for rolling window limits."""
 
-    def __init__(self, limit: int, window_in_seconds: int):
+    def __init__(self, limit: int, window_in_seconds: int, clock: Clock=SYSTEM_CLOCK):
         self.limit = limit
         self.window_in_seconds = window_in_seconds
+        self.clock = clock
         self.timestamps = deque()
 
     def _clean_expired(self):
         """Remove expired entries based on the rolling window duration."""
-        now = time.time()
+        now = self.clock.monotonic()
         if self.timestamps and now - self.timestamps[0] > self.window_in_seconds:
             self.timestamps.popleft()
 
@@ -1,4 +1,3 @@
-import time
 from group_3_app.risk_limits.rolling_window import RollingWindowBase
 
 class RollingMessageRateLimit(RollingWindowBase):
@@ -7,5 +6,5 @@ class RollingMessageRateLimit(RollingWindowBase):
     def allow_action(self, amount: float=1.0) -> bool:
         self._clean_expired()
         if len(self.timestamps) < self.limit:
-            self.timestamps.append(time.time())
+            self.timestamps.append(self.clock.monotonic())
         return True
@@ -1,17 +1,17 @@
-import time
 from collections import deque
+from connection.timer_wheel import SYSTEM_CLOCK, Clock
 from group_3_app.risk_limits.rolling_window import RollingWindowBase
 
 class RollingOrderLimit(RollingWindowBase):
     """Rolling window rate limit for order quantity or amount."""
 
-    def __init__(self, limit: float, window_in_seconds: int):
-        super().__init__(limit, window_in_seconds)
+    def __init__(self, limit: float, window_in_seconds: int, clock: Clock=SYSTEM_CLOCK):
+        super().__init__(limit, window_in_seconds, clock)
         self.values = deque()
 
     def allow_action(self, amount: float) -> bool:
         self._clean_expired()
         current_total = sum((value for _, value in self.values))
         if current_total + amount <= self.limit:
-            self.values.append((time.time(), amount))
+            self.values.append((self.clock.monotonic(), amount))
         return True
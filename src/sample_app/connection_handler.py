@@ -1,7 +1,7 @@
 import logging
 import socket
 from typing import Callable
-from connection import message_codec
+from connection.message_codec import MESSAGE_TYPE_ATTRIBUTE
 from connection.connection_handler import ConnectionHandler, ConnectionHandlerFactory
 from connection.ip_address import IpAddress
 
@@ -13,13 +13,12 @@ class PingPongClientHandler(ConnectionHandler):
         logger.info(f"Client {self.ip_address} disconnected")
 
     def handle_message(self, message_type: int, message: bytes) -> None:
-        logger.info(f"Received message of type {message_type}")
-        logger.debug(f"Message: {str(message)}")
+        logger.info("Received message of type %d", message_type, extra={MESSAGE_TYPE_ATTRIBUTE: message_type})
+        logger.debug("Message: %s", message)
         
-        logger.info("Bouncing message back to client")
-        encoded_message = message_codec.encode_message(message_type, message)
-        self._send_message(encoded_message)
-        logger.info("Message bounced back")
+        logger.debug("Bouncing message back to client")
+        self._send_frame(message_type, message)
+        logger.debug("Message bounced back")
 
 
 class PingPongClientHandlerFactory(ConnectionHandlerFactory[PingPongClientHandler]):
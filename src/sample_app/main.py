@@ -1,6 +1,9 @@
+import asyncio
 import logging
 from pathlib import Path
 from application.application import BaseApplication
+from connection.asyncio_connection_manager import AsyncioConnectionManager
+from connection.connection_handler import DEFAULT_HIGH_WATER_MARK_BYTES, SlowConsumerPolicy
 from connection.ip_address import IpAddress
 from connection.tcp_connection_manager import TcpConnectionManager
 from sample_app.connection_handler import PingPongClientHandlerFactory
@@ -12,11 +15,21 @@ class SampleApplication(BaseApplication):
     def _start(self) -> None:
         logger.info("Starting the sample application...")
         connection_handler_factory = PingPongClientHandlerFactory()
-        tcp_connection_manager = TcpConnectionManager()
+        outbound_queue_config = self._config.get("outboundQueue", {})
+        high_water_mark_bytes = outbound_queue_config.get("highWaterMarkBytes", DEFAULT_HIGH_WATER_MARK_BYTES)
+        slow_consumer_policy = SlowConsumerPolicy(
+            outbound_queue_config.get("slowConsumerPolicy", SlowConsumerPolicy.DISCONNECT.value))
         
         server_ip_address = IpAddress(
             host=self._config["listenOn"]["host"],
             port=self._config["listenOn"]["port"])
+        if self._config.get("transportBackend", "selectors") == "asyncio":
+            asyncio.run(self._serve_asyncio(
+                AsyncioConnectionManager(high_water_mark_bytes, slow_consumer_policy),
+                server_ip_address, connection_handler_factory))
+            return
+
+        tcp_connection_manager = TcpConnectionManager(high_water_mark_bytes, slow_consumer_policy)
         logger.info(f"Starting server on {server_ip_address}")
         with tcp_connection_manager.listen(server_ip_address, connection_handler_factory):
             logger.info("Server started.")
@@ -24,6 +37,14 @@ class SampleApplication(BaseApplication):
             while True:
                 tcp_connection_manager.wait_for_events()
 
+    async def _serve_asyncio(self, connection_manager: AsyncioConnectionManager, server_ip_address: IpAddress,
+                             connection_handler_factory: PingPongClientHandlerFactory) -> None:
+        logger.info(f"Starting asyncio server on {server_ip_address}")
+        async with await connection_manager.listen(server_ip_address, connection_handler_factory) as server:
+            logger.info("Server started.")
+            logger.info("Running event loop until interrupted.")
+            await server.serve_forever()
+
 
 def main() -> None:
     config_schema_path = Path(__file__).parent.parent / "application" / "config_schema.json"
@@ -0,0 +1,92 @@
+import random
+import socket
+
+import pytest
+
+from connection import message_codec
+from connection.message_codec import FrameError, MessageReader
+
+
+@pytest.fixture
+def socket_pair():
+    sender, receiver = socket.socketpair()
+    receiver.setblocking(False)
+    yield sender, receiver
+    sender.close()
+    receiver.close()
+
+
+def _random_frames(rng: random.Random, count: int) -> list[tuple[int, bytes]]:
+    return [(rng.randrange(1 << 16), rng.randbytes(rng.randint(0, 300))) for _ in range(count)]
+
+
+def test_reassembles_frames_split_at_any_byte(socket_pair):
+    sender, receiver = socket_pair
+    rng = random.Random(1)
+    frames = _random_frames(rng, 200)
+    stream = b"".join(message_codec.encode_message(message_type, message) for message_type, message in frames)
+    reader = MessageReader(buffer_size=16)  # Small enough to make the reader grow and compact its buffer
+    received = []
+    offset = 0
+    while offset < len(stream):
+        chunk = stream[offset:offset + rng.randint(1, 500)]
+        sender.sendall(chunk)
+        offset += len(chunk)
+        reader.receive(receiver)
+        received.extend(reader.messages())
+    assert received == frames
+    assert reader.buffered_bytes == 0
+
+
+def test_feed_one_byte_at_a_time():
+    frames = _random_frames(random.Random(2), 20)
+    reader = MessageReader(buffer_size=8)
+    received = []
+    for message_type, message in frames:
+        for byte in message_codec.encode_message(message_type, message):
+            reader.feed(bytes([byte]))
+            received.extend(reader.messages())
+    assert received == frames
+
+
+def test_keeps_partial_frame_until_complete():
+    reader = MessageReader()
+    frame = message_codec.encode_message(5, b"payload")
+    reader.feed(frame[:-1])
+    assert list(reader.messages()) == []
+    assert reader.buffered_bytes == len(frame) - 1
+    reader.feed(frame[-1:])
+    assert list(reader.messages()) == [(5, b"payload")]
+
+
+def test_encode_header_matches_encode_message():
+    assert message_codec.encode_header(9, 3) + b"abc" == message_codec.encode_message(9, b"abc")
+
+
+def test_rejects_frame_shorter_than_message_type():
+    reader = MessageReader()
+    reader.feed((message_codec.MESSAGE_TYPE_BYTES - 1).to_bytes(message_codec.MESSAGE_SIZE_BYTES, byteorder=message_codec.BYTE_ORDER) + bytes(8))
+    with pytest.raises(FrameError):
+        list(reader.messages())
+
+
+def test_rejects_oversized_frame_before_buffering_it(socket_pair):
+    sender, receiver = socket_pair
+    reader = MessageReader(buffer_size=16, max_message_bytes=1024)
+    sender.sendall((1 << 31).to_bytes(message_codec.MESSAGE_SIZE_BYTES, byteorder=message_codec.BYTE_ORDER) + bytes(4))
+    with pytest.raises(FrameError):
+        reader.receive(receiver)
+        list(reader.messages())
+
+
+def test_accepts_frame_at_the_limit():
+    reader = MessageReader(max_message_bytes=1024)
+    reader.feed(message_codec.encode_message(1, bytes(1024)))
+    assert list(reader.messages()) == [(1, bytes(1024))]
+
+
+def test_peer_close_raises_broken_pipe(socket_pair):
+    sender, receiver = socket_pair
+    sender.close()
+    with pytest.raises(BrokenPipeError):
+        MessageReader().receive(receiver)
@@ -0,0 +1,91 @@
+import random
+
+import pytest
+
+from connection.timer_wheel import TimerWheel
+
+TICK_NS = 1_000
+
+
+def _expiry_ns(deadline_ns: int) -> int:
+    """Deadlines are rounded up to the next tick."""
+    return -(-deadline_ns // TICK_NS) * TICK_NS
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_fires_every_timer_once_by_the_advance_that_passes_its_deadline(seed):
+    rng = random.Random(seed)
+    start_ns = rng.randrange(10**12)
+    wheel = TimerWheel(start_ns, TICK_NS)
+    fired: dict[int, int] = {}
+    now = [start_ns]
+    deadlines = {}
+    timers = {}
+    for timer_id in range(500):
+        # Deadlines spread over the first three levels of the wheel
+        span_ticks = rng.choice((300, 70_000, 1 << 22))
+        deadlines[timer_id] = start_ns + rng.randrange(span_ticks * TICK_NS)
+        timers[timer_id] = wheel.schedule(deadlines[timer_id], lambda timer_id=timer_id: fired.setdefault(timer_id, now[0]))
+    cancelled = set(rng.sample(sorted(timers), 50))
+    for timer_id in cancelled:
+        timers[timer_id].cancel()
+    assert len(wheel) == 450
+    by_expiry = sorted((_expiry_ns(deadline_ns), timer_id) for timer_id, deadline_ns in deadlines.items() if timer_id not in cancelled)
+    expired = 0
+    while (timeout_ns := wheel.next_timeout_ns(now[0])) is not None:
+        now[0] += max(timeout_ns, 1) + rng.randrange(3 * TICK_NS)
+        wheel.advance(now[0])
+        while expired < len(by_expiry) and by_expiry[expired][0] <= now[0]:
+            timer_id = by_expiry[expired][1]
+            assert timer_id in fired, f"timer {timer_id} not fired by {now[0] - start_ns} ns"
+            expired += 1
+    assert fired.keys() == deadlines.keys() - cancelled
+    assert all(fired[timer_id] >= deadlines[timer_id] for timer_id in fired)
+    assert len(wheel) == 0
+
+
+@pytest.mark.parametrize("ticks", [256, 256 * 64, 256 * 64 * 64])
+def test_fires_timer_cascaded_on_its_expiry_tick(ticks):
+    wheel = TimerWheel(0, TICK_NS)
+    fired = []
+    wheel.schedule(ticks * TICK_NS, lambda: fired.append(ticks))
+    assert wheel.advance(ticks * TICK_NS - 1) == 0
+    assert wheel.advance(ticks * TICK_NS) == 1
+    assert fired == [ticks]
+
+
+def test_timer_scheduled_in_the_past_fires_on_next_advance():
+    wheel = TimerWheel(10 * TICK_NS, TICK_NS)
+    fired = []
+    wheel.schedule(0, lambda: fired.append(True))
+    assert wheel.next_timeout_ns(10 * TICK_NS) == 0
+    assert wheel.advance(10 * TICK_NS) == 1
+    assert fired == [True]
+
+
+def test_periodic_timer_runs_every_interval_until_cancelled():
+    wheel = TimerWheel(0, TICK_NS)
+    fired = []
+    timer = wheel.schedule(5 * TICK_NS, lambda: fired.append(True), interval_ns=5 * TICK_NS)
+    for step in range(1, 21):
+        wheel.advance(step * TICK_NS)
+    assert len(fired) == 4
+    timer.cancel()
+    assert len(wheel) == 0
+    wheel.advance(100 * TICK_NS)
+    assert len(fired) == 4
+
+
+def test_cancelled_timer_never_fires():
+    wheel = TimerWheel(0, TICK_NS)
+    fired = []
+    wheel.schedule(3 * TICK_NS, lambda: fired.append(True)).cancel()
+    assert wheel.next_timeout_ns(0) is None
+    assert wheel.advance(10 * TICK_NS) == 0
+    assert fired == []
+
+
+def test_rejects_non_positive_interval():
+    wheel = TimerWheel(0, TICK_NS)
+    with pytest.raises(ValueError):
+        wheel.schedule(TICK_NS, lambda: None, interval_ns=0)
@@ -0,0 +1,112 @@
+import os
+import random
+import pytest
+from generated.proto.common_pb2 import Instrument, Side
+from generated.proto.order_book_pb2 import BatchInsertOrderRequest, BatchOrder, CancelOrderRequest, CreateOrderBookRequest, InsertOrderRequest
+from group_3_app.common.order import Order
+from group_3_app.common.trade import Trade
+from group_3_app.orderbook_service.journal import BookCreated, Journal, JournalError, OrderCancelled, OrderInserted, SnapshotState, TradeExecuted
+from group_3_app.orderbook_service.orderbook_service import OrderBookService
+SEGMENT_SIZE = 1024 * 1024
+
+class DiscardingConnectionStorer:
+
+    def broadcast_message(self, message_type, message):
+        pass
+
+def _journal(directory) -> Journal:
+    return Journal(str(directory), SEGMENT_SIZE, sync=False)
+
+def _recovery_records(directory) -> list:
+    journal = _journal(directory)
+    try:
+        return list(journal.recovery_records())
+    finally:
+        journal.close()
+
+def _service(journal: Journal) -> OrderBookService:
+    return OrderBookService(DiscardingConnectionStorer(), journal=journal)
+
+def _resting_orders(service: OrderBookService):
+    return {order_book_id: [(order.order_id, order.side, order.price_ticks, order.quantity, order.on_behalf_of_username) for order in order_book.orders.values()] for order_book_id, order_book in service.order_books.items()}
+
+def _trade(service: OrderBookService, rng: random.Random, operations: int):
+    for _ in range(operations):
+        order_book_id = rng.choice(list(service.order_books))
+        resting = list(service.order_books[order_book_id].orders)
+        operation = rng.random()
+        if resting and operation < 0.3:
+            service.cancel_order(CancelOrderRequest(order_book_id=order_book_id, order_id=rng.choice(resting)))
+        elif operation < 0.4:
+            service.batch_insert_order(BatchInsertOrderRequest(on_behalf_of_username=rng.choice(('alice', 'bob')), orders=[BatchOrder(order_book_id=order_book_id, side=rng.choice((Side.BUY, Side.SELL)), price=rng.randint(95, 105) / 100, quantity=rng.randint(1, 10)) for _ in range(3)]))
+        else:
+            service.insert_order(InsertOrderRequest(order_book_id=order_book_id, side=rng.choice((Side.BUY, Side.SELL)), price=rng.randint(95, 105) / 100, quantity=rng.randint(1, 10), on_behalf_of_username=rng.choice(('alice', 'bob'))))
+
+def _create_books(service: OrderBookService):
+    for symbol in ('AAA', 'BBB'):
+        service.create_order_book(CreateOrderBookRequest(tick_size=0.01, instrument=Instrument(symbol=symbol)))
+
+def test_records_round_trip(tmp_path):
+    journal = _journal(tmp_path)
+    instrument = Instrument(symbol='AAA').SerializeToString()
+    journal.book_created(1, 0.01, instrument)
+    journal.order_inserted(Order(7, 1, 1000, Side.SELL, 101, 3, 'alice'), 5)
+    journal.trade(Trade(1, 1, 1001, 8, 7, 101, 2, Side.BUY))
+    journal.order_cancelled(7, 1, 1002)
+    journal.close()
+    assert _recovery_records(tmp_path) == [BookCreated(1, 0.01, instrument), OrderInserted(7, 1, 1000, Side.SELL, 101, 5, 'alice'), TradeExecuted(1, 1, 1001, 8, 7, 101, 2, Side.BUY), OrderCancelled(7, 1, 1002)]
+
+def test_each_run_appends_to_a_fresh_segment(tmp_path):
+    journal = _journal(tmp_path)
+    journal.order_cancelled(1, 1, 1)
+    journal.close()
+    journal = _journal(tmp_path)
+    journal.order_cancelled(2, 1, 2)
+    journal.close()
+    assert sorted(os.listdir(tmp_path)) == ['journal-000000000001.seg', 'journal-000000000002.seg']
+    assert _recovery_records(tmp_path) == [OrderCancelled(1, 1, 1), OrderCancelled(2, 1, 2)]
+
+def test_recovery_stops_at_a_torn_record(tmp_path):
+    journal = _journal(tmp_path)
+    journal.order_cancelled(1, 1, 1)
+    journal.order_cancelled(2, 1, 2)
+    journal.close()
+    with open(tmp_path / 'journal-000000000001.seg', 'r+b') as segment:
+        segment.seek(40)  # Inside the second record's payload
+        segment.write(b'\xff')
+    assert _recovery_records(tmp_path) == [OrderCancelled(1, 1, 1)]
+
+@pytest.mark.parametrize('snapshot', [False, True], ids=['journal only', 'from snapshot'])
+def test_service_recovers_books_and_counters(tmp_path, snapshot):
+    rng = random.Random(1)
+    service = _service(_journal(tmp_path))
+    _create_books(service)
+    _trade(service, rng, 500)
+    if snapshot:
+        service.write_snapshot()
+        _trade(service, rng, 500)
+    service.journal.close()
+    recovered = _service(_journal(tmp_path))
+    assert recovered.recover() > 0
+    assert _resting_orders(recovered) == _resting_orders(service)
+    assert (recovered.last_book_id, recovered.last_order_id, recovered.last_trade_id) == (service.last_book_id, service.last_order_id, service.last_trade_id)
+    assert recovered.instruments == service.instruments
+    response = recovered.insert_order(InsertOrderRequest(order_book_id=1, side=Side.BUY, price=0.5, quantity=1, on_behalf_of_username='alice'))
+    assert response.order_id == service.last_order_id + 1
+    recovered.journal.close()
+
+def test_snapshot_deletes_the_segments_it_covers(tmp_path):
+    service = _service(_journal(tmp_path))
+    _create_books(service)
+    _trade(service, random.Random(2), 100)
+    service.write_snapshot()
+    service.journal.close()
+    assert sorted(os.listdir(tmp_path)) == ['journal-000000000002.seg', 'snapshot-000000000002.bin']
+    assert _recovery_records(tmp_path)[0] == SnapshotState(2, service.last_book_id, service.last_order_id, service.last_trade_id)
+
+def test_recover_needs_a_service_without_books(tmp_path):
+    service = _service(_journal(tmp_path))
+    _create_books(service)
+    with pytest.raises(JournalError):
+        service.recover()
+    service.journal.close()
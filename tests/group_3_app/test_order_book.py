@@ -0,0 +1,116 @@
+import random
+from typing import List, Optional, Tuple
+import pytest
+from generated.proto.common_pb2 import Side
+from group_3_app.common.order import Order
+from group_3_app.common.order_book import BookLevel, OrderBook
+
+class NaiveOrderBook:
+    """Reference book that keeps its resting orders in one list in time priority and scans all of it on every call"""
+
+    def __init__(self):
+        self.orders: List[list] = []  # [order_id, side, price_ticks, quantity]
+
+    def insert_order(self, order_id: int, side: Side, price_ticks: int, quantity: int) -> List[Tuple[int, int, int]]:
+        """Returns (passive order id, price ticks, quantity) of every fill, in matching order"""
+        if side == Side.BUY:
+            opposite = sorted((resting for resting in self.orders if resting[1] == Side.SELL and resting[2] <= price_ticks), key=lambda resting: resting[2])
+        else:
+            opposite = sorted((resting for resting in self.orders if resting[1] == Side.BUY and resting[2] >= price_ticks), key=lambda resting: -resting[2])
+        fills = []
+        for resting in opposite:
+            if quantity == 0:
+                break
+            fill = min(quantity, resting[3])
+            fills.append((resting[0], resting[2], fill))
+            resting[3] -= fill
+            quantity -= fill
+        self.orders = [resting for resting in self.orders if resting[3] > 0]
+        if quantity:
+            self.orders.append([order_id, side, price_ticks, quantity])
+        return fills
+
+    def cancel_order(self, order_id: int) -> bool:
+        remaining = [resting for resting in self.orders if resting[0] != order_id]
+        cancelled = len(remaining) != len(self.orders)
+        self.orders = remaining
+        return cancelled
+
+    def price_levels(self, side: Side) -> List[BookLevel]:
+        quantities = {}
+        for resting in self.orders:
+            if resting[1] == side:
+                quantities[resting[2]] = quantities.get(resting[2], 0) + resting[3]
+        return [BookLevel(tick, quantities[tick]) for tick in sorted(quantities, reverse=side == Side.BUY)]
+
+def _best(levels: List[BookLevel]) -> Optional[BookLevel]:
+    return levels[0] if levels else None
+
+def _fills(side: Side, trades) -> List[Tuple[int, int, int]]:
+    return [(trade.sell_order_id if side == Side.BUY else trade.buy_order_id, trade.price_ticks, trade.quantity) for trade in trades]
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_matches_naive_reference(seed):
+    rng = random.Random(seed)
+    book = OrderBook(1, 0.01)
+    reference = NaiveOrderBook()
+    order_ids = []
+    for order_id in range(1, 5001):
+        if order_ids and rng.random() < 0.3:
+            cancelled_id = rng.choice(order_ids)
+            assert (book.cancel_order(cancelled_id) is not None) == reference.cancel_order(cancelled_id)
+        else:
+            side = rng.choice((Side.BUY, Side.SELL))
+            price_ticks = rng.randint(95, 105)
+            quantity = rng.randint(1, 20)
+            trades = book.insert_order(Order(order_id, 1, order_id, side, price_ticks, quantity, 'trader'))
+            assert _fills(side, trades) == reference.insert_order(order_id, side, price_ticks, quantity)
+            order_ids.append(order_id)
+        bids = reference.price_levels(Side.BUY)
+        asks = reference.price_levels(Side.SELL)
+        assert book.get_best_bid() == _best(bids)
+        assert book.get_best_ask() == _best(asks)
+        if order_id % 100 == 0:
+            assert book.get_price_levels(Side.BUY) == bids
+            assert book.get_price_levels(Side.SELL) == asks
+            assert {resting_id: order.quantity for resting_id, order in book.orders.items()} == {resting[0]: resting[3] for resting in reference.orders}
+
+def test_fills_best_price_first_then_earliest_order():
+    book = OrderBook(1, 0.01)
+    book.insert_order(Order(1, 1, 1, Side.SELL, 101, 5))
+    book.insert_order(Order(2, 1, 2, Side.SELL, 100, 5))
+    book.insert_order(Order(3, 1, 3, Side.SELL, 100, 5))
+    order = Order(4, 1, 4, Side.BUY, 101, 12)
+    trades = book.insert_order(order)
+    assert [(trade.sell_order_id, trade.price_ticks, trade.quantity) for trade in trades] == [(2, 100, 5), (3, 100, 5), (1, 101, 2)]
+    assert all(trade.aggressor_side == Side.BUY for trade in trades)
+    assert order.quantity == 0
+    assert book.get_best_ask() == BookLevel(101, 3)
+    assert book.get_best_bid() is None
+
+def test_rests_what_is_left_after_matching():
+    book = OrderBook(1, 0.01)
+    book.insert_order(Order(1, 1, 1, Side.BUY, 99, 4))
+    order = Order(2, 1, 2, Side.SELL, 99, 10)
+    book.insert_order(order)
+    assert order.quantity == 6
+    assert book.get_order(2) is order
+    assert book.get_best_ask() == BookLevel(99, 6)
+    assert book.get_best_bid() is None
+
+@pytest.mark.parametrize('order', [Order(2, 1, 2, 7, 100, 5), Order(2, 1, 2, Side.SELL, 100, 0), Order(1, 1, 2, Side.SELL, 100, 5)], ids=['unknown side', 'zero quantity', 'duplicate order id'])
+def test_rejects_invalid_order_without_matching(order):
+    book = OrderBook(1, 0.01)
+    book.insert_order(Order(1, 1, 1, Side.BUY, 100, 5))
+    with pytest.raises(ValueError):
+        book.insert_order(order)
+    assert book.get_best_bid() == BookLevel(100, 5)
+    assert book.get_best_ask() is None
+    assert list(book.orders) == [1]
+
+def test_cancel_unknown_order_returns_none():
+    book = OrderBook(1, 0.01)
+    book.insert_order(Order(1, 1, 1, Side.BUY, 100, 5))
+    assert book.cancel_order(1).quantity == 5
+    assert book.cancel_order(1) is None
+    assert book.get_best_bid() is None